@@ -13,6 +13,8 @@ import torch
 import pandas as pd
 import tqdm
 import cv2
+import rendering
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 #Import Tuple
 
@@ -347,56 +349,20 @@ class DataDLC:
                     plot_prev_coords (bool): If True, the previous coordinates of the body parts will be plotted.
                     frames (Tuple): The range of frames to plot. If None, all the frames will be plotted. '''
         
-        # Open the video
-        cap = cv2.VideoCapture(video_path)
-
-        # Get the width and height of the video
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-        # Define the codec and create a VideoWriter object
-        fourcc = cv2.VideoWriter_fourcc(*'XVID')
-        out = cv2.VideoWriter(output_path, fourcc, 20.0, (width, height))
+        # The coordinates are extracted once, the drawing and the video I/O run in a pipeline (see rendering)
+        points = rendering.coordinates_array(self.coords, self.individuals, self.body_parts)
+        colors = [(255, 255, min(j*255, 255)) for j in range(self.n_individuals)]
+        previous_points, previous_colors = None, None
+        if plot_prev_coords:
+            previous_points = rendering.coordinates_array(self.old_coords, self.individuals, self.body_parts)
+            previous_colors = [(120, 120, min(j*120, 255)) for j in range(self.n_individuals)]
+        overlay = rendering.PoseOverlay(points, self.individuals, colors, 4, previous_points, previous_colors, 6)
 
         if frames is None:
-            frames = range(self.n_frames)
-        else:
-            frames = range(frames[0], frames[1])
-
-        # set the frame position to the first frame
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frames[0])
-        # Iterate over the frames
-        for i in tqdm.tqdm(frames):#tqdm.tqdm(range(self.n_frames)):
-            # Read the frame
-            ret, frame = cap.read()
-
-            # Get the coordinates of the individuals
-            for j, ind in enumerate(self.individuals):
-                for body_part in self.body_parts:
-                    x = self.coords[ind].loc[i, (body_part, 'x')]
-                    y = self.coords[ind].loc[i, (body_part, 'y')]
-
-                    if plot_prev_coords:
-                        x_old = self.old_coords[ind].loc[i, (body_part, 'x')]
-                        y_old = self.old_coords[ind].loc[i, (body_part, 'y')]
-                        # If Nan, skip                    
-                        if not (np.isnan(x_old) or np.isnan(y_old)):
-                            # Draw the body parts
-                            cv2.circle(frame, (int(x_old), int(y_old)), 6, (120, 120, j*120), -1)
-                    if not (np.isnan(x) or np.isnan(y)):
-                        # Draw the body parts
-                        cv2.circle(frame, (int(x), int(y)), 4, (255, 255, j*255), -1)
-                # Add legend to the frame
-                cv2.putText(frame, ind, (50, 50 + 50*j), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, j*255), 2, cv2.LINE_AA)
+            frames = (0, self.n_frames)
 
-            
-            # Write the frame
-            out.write(frame)
-
-        # Release everything if job is finished
-        cap.release()
-        out.release()
-        cv2.destroyAllWindows()
+        with tqdm.tqdm(total=frames[1] - frames[0]) as progress:
+            rendering.render_video(video_path, output_path, overlay, frames, fps=20.0, progress=progress.update)
 
     def get_statistics_on_jumps(self, plot = False, individual = None, body_part = None):
         ''' This function will give the mean and standard deviation of the jumps between points for adjency frames. This assumes Gaussian distribution jumps.
@@ -447,62 +413,69 @@ class DataDLC:
                 split_behaviour (bool): If True, the video will be splitted by the events.
         '''
         
-        # Open the video
-        cap = cv2.VideoCapture(video_path)
-
-        # Get the width and height of the video
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-       
-
-        # Define the individuals
-        colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
-
-        # set the frame position to the first frame
-        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-        # Iterate over the frames
-
         # ckeck if the frames of the df are the same as the video
         if len(events) != self.n_frames:
             print('The number of frames in the events dataframe is different than the video')
             return
-        
-        event_names = events.columns.tolist()
+
+        # The first column is the frame
+        event_names = np.array(events.columns[1:])
+        active = events[event_names].to_numpy() == 1
+        video_name = os.path.splitext(os.path.basename(video_path))[0]
+
         if split_behaviour:
-            for event_name in event_names[1:]:
-                # set the frame position to the first frame
-                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                
-                if events[event_name].sum() == 0:
-                    print(f'The event {event_name} is not present in the video')
-                    continue
-
-                output_video = os.path.join(output_path, video_path.split('\\')[-1].split('.')[0] + f'_{event_name}.avi')
-                out = cv2.VideoWriter(output_video, cv2.VideoWriter_fourcc(*'XVID'), 20.0, (width, height))
-                for i in tqdm.tqdm(range(self.n_frames)):
-                    # Read the frame
-                    ret, frame = cap.read()
-                    # Get the event
-                    event = events.loc[i, event_name]
-                    if event == 1:
-                        # write the event in the frame
-                        out.write(frame)
-                out.release()
+            for event_name in event_names[~active.any(axis=0)]:
+                print(f'The event {event_name} is not present in the video')
+            # One decoding for all the behaviours, only the frames with an event are decoded
+            output_videos = [os.path.join(output_path, video_name + f'_{event_name}.avi') for event_name in event_names]
+            with tqdm.tqdm(total=int(active.any(axis=1).sum())) as progress:
+                rendering.extract_clips(video_path, active, output_videos, fps=20.0, progress=progress.update)
         else:
-            output_path = os.path.join(output_path, video_path.split('/')[-1].split('.')[0] + f'_events.avi')
-            out = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'XVID'), 20.0, (width, height))
-            for i in tqdm.tqdm(range(self.n_frames)):
-                # Read the frame
-                ret, frame = cap.read()
-                # Get the event
-                events_in_frame = event_names[np.where(events.loc[i].values)[0]]
+            output_path = os.path.join(output_path, video_name + f'_events.avi')
+
+            def draw(i, frame):
+                events_in_frame = event_names[active[i]]
                 for e, event in enumerate(events_in_frame):
                     # write the event in the frame
                     cv2.putText(frame, event, (50 + 2*e, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 0), 2, cv2.LINE_AA)
-                out.write(frame)
-            out.release()
+                return frame
+
+            with tqdm.tqdm(total=self.n_frames) as progress:
+                rendering.render_video(video_path, output_path, draw, (0, self.n_frames), fps=20.0, progress=progress.update)
+
+
+    def create_pose_video(self, output_path, events = None, video_path = None, background = 'blank', frames = None, fps = 15.0):
+        ''' Function that creates a video of the skeletons, the centers of mass and the events from the coordinates alone,
+            without decoding the video (much faster than create_video, for quality checks).
+
+            Args:
+                output_path (str): The path to save the video (.avi, MJPG).
+                events (pd.DataFrame): The events to write on the frames, the first column is the frame (optional).
+                video_path (str): The path to the video, for the size of the frames and the 'video' background (optional).
+                background (str): 'blank' (black frames) or 'video' (median of a few frames of the video, cached next to it).
+                frames (Tuple): The range of frames to plot. If None, all the frames will be plotted.
+                fps (float): The frame rate of the video.'''
+        points = rendering.coordinates_array(self.coords, self.individuals, self.body_parts)
+        colors = [(255, 255, min(j*255, 255)) for j in range(self.n_individuals)]
+        labels, label_names = None, None
+        if events is not None:
+            if len(events) != self.n_frames:
+                print('The number of frames in the events dataframe is different than the video')
+                return
+            label_names = list(events.columns[1:])
+            labels = events[label_names].to_numpy() == 1
+        overlay = rendering.SkeletonOverlay(points, self.individuals, self.body_parts, colors, labels, label_names)
+
+        image, size = None, rendering.FRAME_SIZE
+        if video_path is not None:
+            if background == 'video':
+                image = rendering.cached_background(video_path)
+            else:
+                size = rendering.video_size(video_path)
 
+        if frames is None:
+            frames = (0, self.n_frames)
+        return rendering.render_pose_video(output_path, overlay, self.n_frames, image, size, frames, fps)
 
     def save(self, path):
         ''' Function that saves the data to a .h5 file.
@@ -512,3 +485,26 @@ class DataDLC:
         # Add scorer on first level of the columns
         a = pd.concat({self.scorer[0]: self.coords.T}, names=['scorer'])
         a.T.to_hdf(path, key='df', mode='w')
+
+
+def _create_pose_video(args):
+    ''' Creates the pose video of a session (run in a worker process). '''
+    file, output_path, events_path, video_path, background = args
+    events = pd.read_csv(events_path) if events_path is not None else None
+    return DataDLC(file).create_pose_video(output_path, events, video_path, background)
+
+
+def create_pose_videos(sessions, n_workers = 1):
+    ''' Creates the pose videos of many sessions in parallel (one process per session, no display needed).
+
+        Args:
+            sessions (list): One tuple (h5 file, output path, events csv path or None, video path or None, background) per session,
+                see DataDLC.create_pose_video.
+            n_workers (int): The number of processes.
+
+        Returns:
+            n_frames (list): The number of frames written for each session.'''
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(_create_pose_video, sessions))
+    return [_create_pose_video(session) for session in sessions]
@@ -11,6 +11,15 @@ import os
 import matplotlib.pyplot as plt
 import joblib
 import dataloader
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import behaviour_stats
+import bouts
+import postprocessing
+import probability_store
 
 GAT_MASK = {'General_Contacts': "GAT", 'Sniffing': "Linear", 'Sniffing_head': "Linear", 'Sniffing_body': "Linear", 'Sniffing_anogenital': "Linear", 'Following': "GAT", 'Dominance': "Linear", 'Grooming': "GAT"}
 
@@ -96,7 +105,132 @@ def create_csv_with_output_behaviour(output, behaviour, path):
     df = pd.DataFrame(output, columns = ['Frame', behaviour])
     df.to_csv(path, index = False)
 
-def inference(behaviour, data, gat = True, save = False, path_to_save = None, video = None):
+_BASELINE_MODELS = {} # Loaded Linear models, by (model path, modification time)
+_BASELINE_CACHE = OrderedDict() # Outputs of the Linear models, by (video, hash of the coordinates, model path, modification time, behaviour)
+_BASELINE_CACHE_SIZE = 512 # Number of outputs (one per video and behaviour) kept, the least recently used are dropped
+_BASELINE_LOCK = threading.Lock() # The videos can be processed in concurrent threads
+
+def model_signature(behaviour):
+    ''' Returns (path, modification time) of the Linear model of the behaviour, a regenerated model has a new signature. '''
+    model_path = MODELS_PATH[behaviour][1]
+    return model_path, os.path.getmtime(model_path)
+
+def get_baseline_model(behaviour):
+    ''' Returns the Linear model of the behaviour, it is loaded only once.
+    Args:
+        behaviour: str, the behaviour of the model
+    Returns:
+        model: the loaded scikit-learn model
+    '''
+    signature = model_signature(behaviour)
+    if signature not in _BASELINE_MODELS:
+        _BASELINE_MODELS[signature] = load_model(signature[0], DEVICE, behaviour, gat = False)
+    return _BASELINE_MODELS[signature]
+
+def build_baseline_features(data):
+    ''' Builds the features of the Linear models for both individuals in a single array.
+        The first n_frames rows are the coordinates as given (resident view), the last n_frames rows
+        have the two halves of the coordinates swapped (visitor view).
+    Args:
+        data: np.ndarray, the coordinates of the video (n_frames, n_features)
+    Returns:
+        features: np.ndarray, the stacked features (2 * n_frames, n_features)
+    '''
+    n_frames, n_features = data.shape
+    half = n_features // 2
+    features = np.empty((2 * n_frames, n_features), dtype=data.dtype)
+    features[:n_frames] = data
+    features[n_frames:, :half] = data[:, half:]
+    features[n_frames:, half:] = data[:, :half]
+    return features
+
+def baseline_inference(behaviours, data, video = None):
+    ''' This function runs the Linear models of several behaviours on the same video in one sweep.
+        The features of both individuals are built once, and each model is run once over them.
+        If the video is given, the results are cached (across calls) so running again a subset of the behaviours is free.
+        The cache key holds a hash of the coordinates and the path and modification time of the model, so new pose data
+        or a regenerated model are never served stale results. The cache keeps the _BASELINE_CACHE_SIZE most recently used
+        outputs, see clear_baseline_cache to empty it.
+    Args:
+        behaviours: list of str, the behaviours on which to run the inference
+        data: np.ndarray, the coordinates of the video (n_frames, n_features), it is not modified
+        video: str, the name of the video (used as cache key)
+    Returns:
+        outputs: dict of pd.DataFrame, the results of the inference per behaviour
+    '''
+    n_frames = len(data)
+    outputs = {}
+    features = None
+    digest = hashlib.blake2b(np.ascontiguousarray(data).tobytes(), digest_size=16).hexdigest() if video is not None else None
+    for behaviour in behaviours:
+        key = (video, digest) + model_signature(behaviour) + (behaviour,)
+        if video is not None:
+            with _BASELINE_LOCK:
+                cached = _BASELINE_CACHE.get(key)
+                if cached is not None:
+                    _BASELINE_CACHE.move_to_end(key)
+            if cached is not None:
+                outputs[behaviour] = cached.copy()
+                continue
+        if features is None:
+            features = build_baseline_features(data)
+        model = get_baseline_model(behaviour)
+        if behaviour == 'General_Contacts':
+            y_pred = model.predict(features[:n_frames])
+            output = pd.DataFrame({'Frame': np.arange(n_frames), behaviour: y_pred})
+        else:
+            y_pred = model.predict(features)
+            output = pd.DataFrame({'Frame': np.arange(n_frames), behaviour + '_R': y_pred[:n_frames], behaviour + '_V': y_pred[n_frames:]})
+        if video is not None:
+            with _BASELINE_LOCK:
+                _BASELINE_CACHE[key] = output
+                _BASELINE_CACHE.move_to_end(key)
+                while len(_BASELINE_CACHE) > _BASELINE_CACHE_SIZE:
+                    _BASELINE_CACHE.popitem(last=False)
+        outputs[behaviour] = output.copy()
+    return outputs
+
+def clear_baseline_cache():
+    ''' Empties the cache of the Linear models outputs. '''
+    with _BASELINE_LOCK:
+        _BASELINE_CACHE.clear()
+
+def bf16_supported():
+    ''' Returns whether the CPU supports bfloat16 natively (AVX512-BF16 or AMX), where bfloat16 autocast is faster than fp32. '''
+    if DEVICE.type == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+def predict_gat(model, data, bf16 = False, verbose = True):
+    ''' This function runs a GAT model over a list of graphs.
+    Args:
+        model: nn.Module, the GAT model
+        data: list of torch_geometric.data.Data, the graphs
+        bf16: bool, whether to run the model in bfloat16 autocast
+            (the channels-last memory format is not used: it only applies to the 4D tensors of convolutions,
+            a GAT works on 2D node feature matrices and edge lists)
+        verbose: bool, whether to show the progress bar
+    Returns:
+        frames: np.ndarray, the central frame of each graph
+        probabilities: np.ndarray, the softmax output of the model for each graph (n_graphs, n_classes),
+            or (n_graphs, n_tasks, n_classes) for a MultiTaskGraphClassifier
+    '''
+    loader = DataLoader(data, batch_size=1, shuffle=False) # create the DataLoader
+    softmax = nn.Softmax(dim=-1) # create the softmax function
+    frames = np.zeros(len(loader), dtype=int)
+    probabilities = []
+    with torch.no_grad(), torch.autocast(device_type=DEVICE.type, dtype=torch.bfloat16, enabled=bf16):
+        for i, batch in enumerate(tqdm.tqdm(loader, disable=not verbose)):
+            frames[i] = int(batch.frame_mask.median().item()) # get the frame
+            out = model(batch.to(DEVICE))
+            probabilities.append(softmax(out.float()))
+    probabilities = torch.cat(probabilities).cpu().numpy()
+    return frames, probabilities
+
+def inference(behaviour, data, gat = True, save = False, path_to_save = None, video = None, bf16 = False, return_probabilities = False, verbose = True):
     ''' This function runs the inference on the specified behavior, and save
         the results in the specified path.
     Args:
@@ -105,98 +239,192 @@ def inference(behaviour, data, gat = True, save = False, path_to_save = None, vi
         gat: bool, whether to use the GAT model or not (if False, the model is the Linear model)
         save: bool, whether to save the results or not
         path_to_save: str, the path where to save the results (if save is True)
-        video: str, the name of the video (if save is True)
+        video: str, the name of the video (if save is True), also used to cache the results of the Linear models
+        bf16: bool, whether to run the GAT model in bfloat16 autocast (ignored if the CPU does not support it)
+        return_probabilities: bool, whether to return the probabilities of the behaviour too (None for the Linear models)
+        verbose: bool, whether to print the progress (messages and progress bars)
     Returns:
         outputs: pd.DataFrame, the results of the inference
+        probabilities: pd.DataFrame, the probability of the behaviour per frame, same layout as outputs (if return_probabilities)
     ''' 
     if gat:
         model_path = MODELS_PATH[behaviour][0] # get the model path
-    else:
-        model_path = MODELS_PATH[behaviour][1] # get the model path
-    model = load_model(model_path, DEVICE, behaviour, gat) # load the model
-    if gat:
-        loader = DataLoader(data, batch_size=1, shuffle=False) # create the DataLoader
+        model = load_model(model_path, DEVICE, behaviour, gat) # load the model
+        if bf16 and not bf16_supported():
+            if verbose:
+                print('bfloat16 is not supported on this device, running the inference in fp32')
+            bf16 = False
 
 
     if behaviour == 'General_Contacts':
         if gat:
-            outputs = pd.DataFrame(np.zeros((len(loader), 2)), columns = ['Frame', behaviour]) # create the DataFrame to store the results
-            softmax = nn.Softmax(dim=1) # create the softmax function
-            print('Running inference on General_Contacts')
-            for i, batch in enumerate(tqdm.tqdm(loader)):
-                outputs.loc[i, 'Frame'] = int(batch.frame_mask.median().item()) # get the frame
-                with torch.no_grad():
-                    out = model(batch)
-                    out = softmax(out)
-                    outputs.loc[i, behaviour] = out.argmax(dim=1).cpu().numpy() # get the prediction
+            if verbose:
+                print('Running inference on General_Contacts')
+            frames, probabilities = predict_gat(model, data, bf16, verbose)
+            outputs = pd.DataFrame({'Frame': frames, behaviour: probabilities.argmax(axis=1)}) # get the prediction
+            scores = pd.DataFrame({'Frame': frames, behaviour: probabilities[:, 1]})
 
         else:
-            outputs = pd.DataFrame(np.zeros((len(data), 2)), columns = ['Frame', behaviour])
-            outputs['Frame'] = range(len(data))
-
-            print('Running inference on General_Contacts')
-            
-            y_pred = model.predict(data)
-            outputs[behaviour] = y_pred
+            if verbose:
+                print('Running inference on General_Contacts')
+            outputs = baseline_inference([behaviour], data, video)[behaviour]
+            scores = None
 
     else:
        
         if gat:
-            outputs = pd.DataFrame(np.zeros((len(loader), 3)), columns = ['Frame', behaviour + '_R', behaviour + '_V']) # create the DataFrame to store the results
-            softmax = nn.Softmax(dim=1)
-            print('Running inference on', behaviour + '_R')
-            for i, batch in enumerate(tqdm.tqdm(loader)):
-                outputs.loc[i, 'Frame'] = int(batch.frame_mask.median().item()) 
-                with torch.no_grad():
-                    out = model(batch)
-                    out = softmax(out)
-                    outputs.loc[i, behaviour + '_R'] = out.argmax(dim=1).cpu().numpy()
+            if verbose:
+                print('Running inference on', behaviour + '_R')
+            frames, probabilities_R = predict_gat(model, data, bf16, verbose)
         
-            # Swap identities
-            utils.swap_identities(data)
-            loader = DataLoader(data, batch_size=1, shuffle=False)
-            print('Running inference on', behaviour + '_V')
-            for i, batch in enumerate(tqdm.tqdm(loader)):
-                with torch.no_grad():
-                    out = model(batch)
-                    out = softmax(out)
-                    outputs.loc[i, behaviour + '_V'] = out.argmax(dim=1).cpu().numpy()
-
-        else:
-            outputs = pd.DataFrame(np.zeros((len(data), 3)), columns = ['Frame', behaviour + '_R', behaviour + '_V'])
-            outputs['Frame'] = range(len(data))
-            coords_R = data.copy()
-            coords_ind2 = data[:, data.shape[1]//2:].copy()
-            data[:, data.shape[1]//2:] = data[:, :data.shape[1]//2]
-            data[:, :data.shape[1]//2] = coords_ind2
-
-            coords_V = data.copy()
-
-            del data
+            # Swap identities (on copies, data is reused by the other behaviours)
+            if verbose:
+                print('Running inference on', behaviour + '_V')
+            _, probabilities_V = predict_gat(model, utils.swap_identities(data), bf16, verbose)
 
-            print('Running inference on', behaviour + '_R')
-            
-            y_pred_R = model.predict(coords_R)
-            outputs[behaviour + '_R'] = y_pred_R
+            outputs = pd.DataFrame({'Frame': frames, behaviour + '_R': probabilities_R.argmax(axis=1), behaviour + '_V': probabilities_V.argmax(axis=1)})
+            scores = pd.DataFrame({'Frame': frames, behaviour + '_R': probabilities_R[:, 1], behaviour + '_V': probabilities_V[:, 1]})
 
-            print('Running inference on', behaviour + '_V')
-            y_pred_V = model.predict(coords_V)
-            outputs[behaviour + '_V'] = y_pred_V
+        else:
+            if verbose:
+                print('Running inference on', behaviour + '_R', 'and', behaviour + '_V')
+            outputs = baseline_inference([behaviour], data, video)[behaviour]
+            scores = None # the Linear models only give the prediction
             
     if save:
         outputs.to_csv(os.path.join(path_to_save, video + '_' + behaviour + '_output.csv'), index = False)
+    elif return_probabilities:
+        return outputs, scores
     else:
         return outputs
     
 
   
 
-def inference_all_behaviors(path_to_data, path_to_save, gat_mask = GAT_MASK):
+def load_multitask_model(model_path, device):
+    ''' This function loads a MultiTaskGraphClassifier trained by train.py (--multitask).
+    Args:
+        model_path: str, the path to the checkpoint
+        device: device on which the model should be loaded
+    Returns:
+        model: the loaded model
+        behaviour_names: list of str, the behaviour of each head of the model
+    '''
+    checkpoint = torch.load(model_path, map_location=device)
+    behaviour_names = checkpoint['behaviour_names']
+    # The architecture is rebuilt from the configuration saved by train.py (the defaults of build_model if absent)
+    model = models.build_model(**dict(checkpoint.get('model_config', {}), n_tasks=len(behaviour_names)))
+    model.load_state_dict(checkpoint['model_state_dict'])
+    model.to(device)
+    model.eval()
+    return model, behaviour_names
+
+def inference_multitask(model_path, data, save = False, path_to_save = None, video = None, bf16 = False):
+    ''' This function runs a multi-task model on a video: the graphs are encoded once and all the
+        behaviours of the model are predicted from the same embeddings.
+    Args:
+        model_path: str, the path to the checkpoint of the MultiTaskGraphClassifier
+        data: list of torch_geometric.data.Data, the graphs of the video
+        save: bool, whether to save the results or not
+        path_to_save: str, the path where to save the results (if save is True)
+        video: str, the name of the video (if save is True)
+        bf16: bool, whether to run the model in bfloat16 autocast (ignored if the CPU does not support it)
+    Returns:
+        outputs: pd.DataFrame, the prediction of each behaviour per frame
+    '''
+    model, behaviour_names = load_multitask_model(model_path, DEVICE)
+    if bf16 and not bf16_supported():
+        print('bfloat16 is not supported on this device, running the inference in fp32')
+        bf16 = False
+    print('Running inference on', behaviour_names)
+    frames, probabilities = predict_gat(model, data, bf16)
+    predictions = probabilities.argmax(axis=-1) # (n_graphs, n_tasks)
+    outputs = pd.DataFrame(predictions, columns = behaviour_names)
+    outputs.insert(0, 'Frame', frames)
+    if save:
+        outputs.to_csv(os.path.join(path_to_save, video + '_multitask_output.csv'), index = False)
+    else:
+        return outputs
+
+def inference_video(video, data_graph, data_coords, path_to_save, gat_mask = GAT_MASK, bf16 = False, save_bouts = True, save_probabilities = True, verbose = True):
+    ''' This function runs the inference of all behaviors on a single video, and save
+        the results in the specified path.
+    Args:
+        video: str, the name of the video
+        data_graph: list of torch_geometric.data.Data, the graphs of the video
+        data_coords: np.ndarray, the coordinates of the video (used by the Linear models)
+        path_to_save: str, the path where to save the results
+        gat_mask: dict, for each behavior whether to use the GAT model or the Linear model
+        bf16: bool, whether to run the GAT models in bfloat16 autocast
+        save_bouts: bool, whether to save the bouts of the behaviours too (video + '_bouts.npz', see bouts.BoutTable)
+        save_probabilities: bool, whether to save the probabilities of the GAT models too (video + '_probabilities.npy', see probability_store)
+        verbose: bool, whether to print the progress (False when the videos run in concurrent threads)
+    Returns:
+        elapsed: float, the time (in seconds) spent on the video
+    '''
+    start = time.perf_counter()
+    if verbose:
+        print('Running inference on video', video)
+    outputs = []
+    probabilities = []
+
+    # All the Linear models are run in one sweep over the same features
+    linear_behaviours = [behaviour for behaviour in MODELS_PATH.keys() if gat_mask[behaviour] not in (True, 'GAT')]
+    if verbose:
+        print('Running inference on', linear_behaviours)
+    linear_outputs = baseline_inference(linear_behaviours, data_coords, video)
+
+    for behaviour in MODELS_PATH.keys():
+        if behaviour in linear_outputs:
+            outputs.append(linear_outputs[behaviour])
+        else:
+            output, scores = inference(behaviour, data_graph, save = False, gat = True, bf16 = bf16, return_probabilities = True, verbose = verbose)
+            outputs.append(output)
+            probabilities.append(scores)
+
+    # Concatenate the outputs using the column 'frame' as index
+    outputs = [output.set_index('Frame') for output in outputs] # Set the column 'Frame' as index
+
+    # Concatenate the outputs
+    output = pd.concat(outputs, axis=1) 
+
+    # Sort by frame
+    output.sort_values(by = 'Frame', inplace = True)
+
+    # Fill the missing values with 0
+    output.fillna(0, inplace = True)
+
+    # Save the outputs
+    output.to_csv(os.path.join(path_to_save, video + '_output.csv'))
+    # No probabilities for the Linear models: their bouts have no confidence (NaN)
+    probabilities = pd.concat([p.set_index('Frame') for p in probabilities], axis=1).sort_index() if probabilities else None
+    if save_probabilities and probabilities is not None:
+        probability_store.save_probabilities(probabilities, probability_store.probabilities_path(path_to_save, video))
+    if save_bouts:
+        bouts.BoutTable.from_dense(output, probabilities).save(os.path.join(path_to_save, video + '_bouts.npz'))
+
+    elapsed = time.perf_counter() - start
+    if verbose:
+        print(f'Inference on video {video} took {elapsed:.2f} seconds')
+    return elapsed
+
+def inference_all_behaviors(path_to_data, path_to_save, gat_mask = GAT_MASK, n_workers = 1, threads_per_worker = None, bf16 = False, clear_cache = False):
     ''' This function runs the inference on all behaviors, and save
         the results in the specified path.
+        Several videos can be processed concurrently: n_workers videos run at the same time, and each
+        of them uses threads_per_worker torch intra-op threads (n_workers * threads_per_worker should
+        not exceed the number of cores). The time spent on each video is saved in 'timings.csv' to tune the split.
     Args:
         path_to_data: str, the path to the dataset to run the inference on, it should be a folder with a .pkl file and the .h5 files
         path_to_save: str, the path where to save the results
+        gat_mask: dict, for each behavior whether to use the GAT model or the Linear model
+        n_workers: int, the number of videos processed concurrently
+        threads_per_worker: int, the number of torch intra-op threads per video (if None, the cores are split evenly between the workers)
+        bf16: bool, whether to run the GAT models in bfloat16 autocast (see compare_precision for its effect on the predictions)
+        clear_cache: bool, whether to empty the cache of the Linear models outputs at the end (it is kept by default,
+            so running again a subset of the behaviours on the same data is free)
+    Returns:
+        timings: pd.DataFrame, the time spent on each video
     ''' 
 
     data_coords = dataloader.DLCDataLoader(path_to_data, build_graph=False) # create the DataLoader
@@ -220,38 +448,76 @@ def inference_all_behaviors(path_to_data, path_to_save, gat_mask = GAT_MASK):
     for video in videos:
         data_per_video_graph.append([d for d in data_graph if d.file == video])
         data_per_video_coords.append([d[0] for d in data_coords.data_list if d[2] == video])
-    for i, video in enumerate(videos):
-        print('Running inference on video', video)
-        outputs = []
 
-        for behaviour in MODELS_PATH.keys():
-            if gat_mask[behaviour]:
-                outputs.append(inference(behaviour, data_per_video_graph[i], save = False, gat = True))
-            else:
-                outputs.append(inference(behaviour, data_per_video_coords[i][0], save = False, gat = False))
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+
+    # torch.set_num_threads is process-wide, each worker thread running an op uses its own pool of this size
+    previous_threads = torch.get_num_threads()
+    torch.set_num_threads(threads_per_worker)
+    print(f'Running inference on {len(videos)} videos with {n_workers} workers and {threads_per_worker} threads per worker')
+    if bf16 and n_workers > 1 and not bf16_supported():
+        print('bfloat16 is not supported on this device, running the inference in fp32')
+    try:
+        # With concurrent videos, their messages and progress bars would interleave: a single bar over the videos
+        verbose = n_workers == 1
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(inference_video, video, data_per_video_graph[i], data_per_video_coords[i][0], path_to_save, gat_mask, bf16,
+                                       verbose=verbose)
+                       for i, video in enumerate(videos)]
+            for _ in tqdm.tqdm(as_completed(futures), total=len(futures), desc='Videos', disable=verbose):
+                pass
+            elapsed = [future.result() for future in futures]
+    finally:
+        torch.set_num_threads(previous_threads)
+        if clear_cache:
+            clear_baseline_cache()
+
+    timings = pd.DataFrame({'video': videos, 'n_windows': [len(d) for d in data_per_video_graph], 'seconds': elapsed})
+    timings['n_workers'] = n_workers
+    timings['threads_per_worker'] = threads_per_worker
+    timings.to_csv(os.path.join(path_to_save, 'timings.csv'), index = False)
+
+    return timings
         
-        # Concatenate the outputs using the column 'frame' as index
-        outputs = [output.set_index('Frame') for output in outputs] # Set the column 'Frame' as index
-        
-        # Concatenate the outputs
-        output = pd.concat(outputs, axis=1) 
-
-        # Sort by frame
-        output.sort_values(by = 'Frame', inplace = True)
-
-        # Fill the missing values with 0
-        output.fillna(0, inplace = True)
+def compare_precision(data, behaviours = None):
+    ''' This function compares the predictions of the GAT models in fp32 and in bfloat16 autocast, per behavior.
+        Only the resident view is compared.
+    Args:
+        data: list of torch_geometric.data.Data, the graphs on which to run the comparison
+        behaviours: list of str, the behaviors to compare (if None, all the behaviors with a GAT model)
+    Returns:
+        comparison: pd.DataFrame, per behavior the agreement of the predicted labels, the maximal absolute difference
+                    of the probabilities and the time spent in each precision
+    '''
+    if behaviours is None:
+        behaviours = [behaviour for behaviour in MODELS_PATH.keys() if MODELS_PATH[behaviour][0] is not None]
+    if not bf16_supported():
+        print('bfloat16 is not supported natively on this device, the timings of bf16 are emulated')
+
+    rows = []
+    for behaviour in behaviours:
+        model = load_model(MODELS_PATH[behaviour][0], DEVICE, behaviour, gat = True)
+        start = time.perf_counter()
+        _, probabilities_fp32 = predict_gat(model, data, bf16 = False)
+        time_fp32 = time.perf_counter() - start
+        start = time.perf_counter()
+        _, probabilities_bf16 = predict_gat(model, data, bf16 = True)
+        time_bf16 = time.perf_counter() - start
+
+        rows.append({'behavior': behaviour,
+                     'agreement': (probabilities_fp32.argmax(axis=1) == probabilities_bf16.argmax(axis=1)).mean(),
+                     'max_abs_diff': np.abs(probabilities_fp32 - probabilities_bf16).max(),
+                     'time_fp32 (s)': time_fp32,
+                     'time_bf16 (s)': time_bf16})
+    comparison = pd.DataFrame(rows)
+    print(comparison)
+    return comparison
 
-        # Save the outputs
-        output.to_csv(os.path.join(path_to_save, video + '_output.csv'))
-        
 def get_number_of_occurrences(data):
     ''' This function returns the number of occurrences of a behavior in the data. i.e. the number of times a 0 is followed by a 1. '''
-    count = 0
-    for i in range(len(data)-1):
-        if data[i] == 0 and data[i+1] == 1:
-            count += 1
-    return count
+    data = np.asarray(data)
+    return int(np.sum((data[:-1] == 0) & (data[1:] == 1)))
 
 def distribution_of_ocurrencies(data, column, num_interv = 6):
     ''' This function computes the distribution of the number of occurrences of a behavior per decil. 
@@ -282,60 +548,52 @@ def plot_distribution(distribution, column, path, video_name):
     plt.close()
 
 
-def get_statistics(path_to_files, num_intervals = 6):
-    ''' This function computes the statistics of the model outputs per video and save them in a csv file. 
+def get_statistics(path_to_files, num_intervals = 6, fps = behaviour_stats.FPS, plot = True, n_workers = 1, smoothing = None):
+    ''' This function computes the statistics of the model outputs per video and save them in csv files.
+        All the statistics (latency, duration, number of bouts, bout lengths, intervals between bouts, distribution over the video)
+        are computed by behaviour_stats for all the behaviours of a video at once, and saved in one tidy table statistics_long.csv.
     
     Args:
         path_to_files: str, the path to the folder containing the csv files
         num_intervals: int, the number of intervals to consider for the distribution plots
+        fps: float, the frame rate of the videos
+        plot: bool, whether to save the distribution plots
+        n_workers: int, the number of processes rendering the plots
+        smoothing: dict, the parameters of postprocessing.postprocess_outputs applied to the outputs before the statistics
+            (e.g. {'window': 5, 'min_length': 3, 'max_gap': 5}), None to use the raw outputs
+    Returns:
+        statistics: pd.DataFrame, the main statistics, one row per video and behavior
         '''
 
     # Get the list of csv files
-    files = [f for f in os.listdir(path_to_files) if f.endswith('.csv')]
-
-    # Create a DataFrame to store the statistics
-    statistics = pd.DataFrame(columns = ['video', 'behavior', 'latancy', 'duration (s)', 'duration (frames)', 'number_of_occurrences'])
-
-    # Make a folder for each video
-    for file in files:
-        video = file.split('_output')[0]
-        if not os.path.exists(os.path.join(path_to_files, video)):
-            os.makedirs(os.path.join(path_to_files, video))
+    files = [f for f in os.listdir(path_to_files) if f.endswith('_output.csv')]
 
+    tables = []
     for file in files:
         # Load the data
         data = pd.read_csv(os.path.join(path_to_files, file))
         video = file.split('_output')[0]
-        statistics_per_video = pd.DataFrame(columns = ['video', 'behavior', 'latancy', 'duration (s)', 'duration (frames)', 'number_of_occurrences'])
-        distribution = pd.DataFrame(columns = ['Behavior', 'interval 0', 'interval 1', 'interval 2', 'intarval 3', 'interval 4', 'interval 5'])
-        for column in data.columns[1:]:
-            # Get the statistics
-            latancy = data[column].idxmax()
-            duration = data[column].sum()
-            number_of_occurrences = get_number_of_occurrences(data[column])
-
-            # Append the statistics to the DataFrame
-            new_row = pd.DataFrame({'video': [video], 'behavior': [column], 'latancy': [latancy], 'duration (s)': [duration / 15 ], 'duration (frames)': [duration], 'number_of_occurrences': [number_of_occurrences]})
-            #statistics = pd.concat([statistics, new_row], ignore_index=True)
-            statistics_per_video = pd.concat([statistics_per_video, new_row], ignore_index=True)
-        
-            decils_dist = distribution_of_ocurrencies(data, column)
-            dist = pd.DataFrame({'Behavior': [column], 'interval 0': [decils_dist[0]], 'interval 1': [decils_dist[1]], 'interval 2': [decils_dist[2]], 'interval 3': [decils_dist[3]], 'interval 4': [decils_dist[4]], 'interval 5': [decils_dist[5]]})
-            distribution = pd.concat([distribution, dist], ignore_index=True)
-
-            # Build images with the distribution 
-            plot_distribution(decils_dist, column, os.path.join(path_to_files, video, column + '_distribution.png'), video)
-        
-        # Save the distribution
-        distribution.to_csv(os.path.join(path_to_files, video, 'distribution.csv'), index = False, sep=';')
-        
-        statistics = pd.concat([statistics, statistics_per_video], ignore_index=True)
-
-        # Save the statistics per video
-        statistics_per_video.to_csv(os.path.join(path_to_files, video, 'statistics.csv'), index = False, sep=';')               
-
+        if smoothing is not None:
+            # The probabilities saved by the inference are used by the median and viterbi smoothing
+            path = probability_store.probabilities_path(path_to_files, video)
+            probabilities = probability_store.load_probabilities(path) if os.path.exists(path) else None
+            data = postprocessing.postprocess_outputs(data, probabilities, **smoothing)
+        tables.append(behaviour_stats.compute_statistics(data, video, fps, num_intervals))
+    statistics_long = pd.concat(tables, ignore_index=True)
+    statistics = behaviour_stats.summary(statistics_long)
+
+    # Make a folder for each video, with its statistics and distribution
+    for video, statistics_per_video in statistics.groupby('video', sort=False):
+        os.makedirs(os.path.join(path_to_files, video), exist_ok=True)
+        statistics_per_video.to_csv(os.path.join(path_to_files, video, 'statistics.csv'), index = False, sep=';')
+        behaviour_stats.distribution(statistics_long, video).to_csv(os.path.join(path_to_files, video, 'distribution.csv'), index = False, sep=';')
+
+    if plot:
+        # Build images with the distribution
+        behaviour_stats.plot_distributions(statistics_long, path_to_files, n_workers)
 
     # Save the statistics
+    statistics_long.to_csv(os.path.join(path_to_files, 'statistics_long.csv'), index = False, sep=';')
     statistics.to_csv(os.path.join(path_to_files, 'statistics.csv'), index = False, sep=';')
 
     return statistics
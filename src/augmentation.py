@@ -1,5 +1,206 @@
+import copy
+
 import numpy as np
 import torch
+from torch_geometric.data import Batch
+
+import samplers
+
+IDENTITY_FEATURE = 3 # Column of the node features holding the identity of the individual (0: resident, 1: visitor)
+IDENTITY_PERMUTATION = torch.tensor([1., 0.]) # Swap of the identities, new identity = IDENTITY_PERMUTATION[identity]
+
+
+def stack_labels(dataset):
+    ''' Stacks the behaviour vectors of the graphs.
+
+        Args:
+            dataset (list): The graphs, each with its behaviour vector in data.behaviour.
+
+        Returns:
+            labels (torch.Tensor): The labels (n_graphs, n_behaviours).'''
+    return torch.stack([data.behaviour.view(-1) for data in dataset])
+
+
+def swap_identity_features(x, node_mask = None):
+    ''' Swaps the identities of the individuals in node features, without modifying x.
+
+        Args:
+            x (torch.Tensor): The node features (n_nodes, n_features).
+            node_mask (torch.Tensor): If given, only the nodes where it is True are swapped.
+
+        Returns:
+            x (torch.Tensor): A copy of the node features with the identities swapped.'''
+    identity = x[:, IDENTITY_FEATURE]
+    swapped = IDENTITY_PERMUTATION.to(x.device, x.dtype)[identity.long()]
+    if node_mask is not None:
+        swapped = torch.where(node_mask, swapped, identity)
+    x = x.clone()
+    x[:, IDENTITY_FEATURE] = swapped
+    return x
+
+
+def apply_identity_swap(batch):
+    ''' Swaps the identities in the graphs of the batch whose swap flag is set (see AugmentedDataset). '''
+    swap = getattr(batch, 'swap', None)
+    if swap is not None and bool(swap.any()):
+        batch.x = swap_identity_features(batch.x, swap.view(-1)[batch.batch])
+    return batch
+
+
+def collate(data_list):
+    ''' Collates graphs in a Batch and applies their swap flags, used as collate_fn of the loaders of an AugmentedDataset. '''
+    return apply_identity_swap(Batch.from_data_list(data_list))
+
+
+class RandomBatchTransform:
+    ''' Random augmentation of a batch of graphs, drawn independently for each graph at every call: the elements of the
+        dihedral group of the (normalized) arena, generated by the flips of x and y and the transposition, and the swap of the
+        identities of the individuals (with the swap of the labels of the resident/visitor behaviours).
+        It replaces rotate_samples, the dataset is not duplicated and every epoch sees new variants. '''
+
+    def __init__(self, p_flip_x = 0.5, p_flip_y = 0.5, p_transpose = 0.5, p_swap = 0.0, swap_pairs = None):
+        ''' Constructor of the RandomBatchTransform class.
+
+            Args:
+                p_flip_x (float): The probability of x -> 1 - x.
+                p_flip_y (float): The probability of y -> 1 - y (with p_flip_x, the 180 degrees rotation).
+                p_transpose (float): The probability of exchanging x and y.
+                p_swap (float): The probability of swapping the identities of the individuals.
+                swap_pairs (list): The pairs (index of the resident behaviour, index of the visitor behaviour) in data.behaviour
+                    whose labels are exchanged when the identities are swapped. Required if p_swap > 0.'''
+        if p_swap > 0 and not swap_pairs:
+            raise ValueError('swap_pairs is required to swap the identities, the labels of the resident and the visitor must be exchanged too')
+        self.p_flip_x = p_flip_x
+        self.p_flip_y = p_flip_y
+        self.p_transpose = p_transpose
+        self.p_swap = p_swap
+        self.swap_pairs = swap_pairs or []
+
+    def __call__(self, batch):
+        n_graphs = batch.num_graphs
+        x = batch.x
+        flip_x, flip_y, transpose, swap = (torch.rand(4, n_graphs, device=x.device) < torch.tensor(
+            [self.p_flip_x, self.p_flip_y, self.p_transpose, self.p_swap], device=x.device).view(4, 1))
+
+        # Per node masks
+        node_graph = batch.batch
+        coord_x = torch.where(flip_x[node_graph], 1 - x[:, 0], x[:, 0])
+        coord_y = torch.where(flip_y[node_graph], 1 - x[:, 1], x[:, 1])
+        transpose_nodes = transpose[node_graph]
+        x = x.clone()
+        x[:, 0] = torch.where(transpose_nodes, coord_y, coord_x)
+        x[:, 1] = torch.where(transpose_nodes, coord_x, coord_y)
+        batch.x = x
+
+        if self.p_swap > 0 and bool(swap.any()):
+            batch.x = swap_identity_features(batch.x, swap[node_graph])
+            labels = batch.behaviour.view(n_graphs, -1)
+            permutation = torch.arange(labels.size(1), device=labels.device)
+            for resident, visitor in self.swap_pairs:
+                permutation[resident], permutation[visitor] = visitor, resident
+            batch.behaviour = torch.where(swap.view(-1, 1), labels[:, permutation], labels).view(-1)
+        return batch
+
+
+class BatchCollater:
+    ''' collate_fn of the train loader: collates the graphs in a Batch, applies the swap flags of an AugmentedDataset
+        and then the random transform (if any). '''
+
+    def __init__(self, transform = None):
+        self.transform = transform
+
+    def __call__(self, data_list):
+        batch = collate(data_list)
+        if self.transform is not None:
+            batch = self.transform(batch)
+        return batch
+
+
+class AugmentedDataset(torch.utils.data.Dataset):
+    ''' Dataset of views of graphs: each sample is a graph of the base dataset, its own label vector and a flag
+        telling whether the identities of the individuals are swapped. The node features are shared with the base
+        graphs, the swap is only applied when the samples are collated (see collate). '''
+
+    def __init__(self, graphs, index = None, swap = None, labels = None):
+        ''' Constructor of the AugmentedDataset class.
+
+            Args:
+                graphs (list): The base graphs.
+                index (torch.Tensor): The base graph of each sample (default: one sample per graph).
+                swap (torch.Tensor): Whether the identities of each sample are swapped (default: False).
+                labels (torch.Tensor): The labels of each sample (n_samples, n_behaviours) (default: the labels of the graphs).'''
+        self.graphs = graphs
+        self.index = index if index is not None else torch.arange(len(graphs))
+        self.swap = swap if swap is not None else torch.zeros(len(self.index), dtype=torch.bool)
+        self.labels = labels if labels is not None else stack_labels(graphs)[self.index]
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        ''' Returns the dataset itself if it is already an AugmentedDataset, else one sample per graph. '''
+        return dataset if isinstance(dataset, cls) else cls(dataset)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        data = copy.copy(self.graphs[int(self.index[i])]) # shallow copy, the tensors are shared
+        data.behaviour = self.labels[i]
+        data.swap = self.swap[i]
+        return data
+
+    def append(self, index, swap, labels):
+        ''' Returns a new AugmentedDataset with the given samples added at the end. '''
+        return AugmentedDataset(self.graphs, torch.cat([self.index, index]), torch.cat([self.swap, swap]), torch.cat([self.labels, labels]))
+
+    def materialize(self):
+        ''' Returns the samples as a list of Data, with the swaps applied (copies of the node features only where swapped). '''
+        out = []
+        for i in range(len(self)):
+            data = self[i]
+            if data.swap:
+                data.x = swap_identity_features(data.x)
+            del data.swap
+            out.append(data)
+        return out
+
+
+def merge_symmetric(dataset, indx_behaviour1, indx_behaviour2, new_samples_only = False):
+    ''' Merges two symetric behaviours (e.g. 'Sniffing_Resident' and 'Sniffing_Visitor') into the first one:
+        the samples where the second behaviour is active are seen with the identities swapped and the first behaviour active.
+        The labels are computed on the stacked label tensor and the new samples are views of the base graphs.
+
+        Args:
+            dataset (list or AugmentedDataset): The graphs.
+            indx_behaviour1 (int): The index of the behaviour that is kept.
+            indx_behaviour2 (int): The index of the symetric behaviour.
+            new_samples_only (bool): If False (merge_symetric_behaviours), a sample where only the second behaviour is active
+                is swapped and relabelled, and a new sample is added when both are active. If True (merge_symetric_behaviours_version2),
+                a swapped sample with only the first behaviour active is added for every sample of the second behaviour,
+                the original samples are kept as they are.
+
+        Returns:
+            dataset (AugmentedDataset): The merged dataset.'''
+    dataset = AugmentedDataset.from_dataset(dataset)
+    labels = dataset.labels
+    active2 = labels[:, indx_behaviour2] == 1
+    new = active2 if new_samples_only else active2 & (labels[:, indx_behaviour1] == 1)
+
+    # New samples: swapped, only the first behaviour active
+    new_labels = torch.zeros((int(new.sum()), labels.size(1)), dtype=labels.dtype)
+    new_labels[:, indx_behaviour1] = 1
+    new_swap = ~dataset.swap[new] # swapping a swapped view gives back the original identities
+
+    index, swap, labels = dataset.index, dataset.swap, labels
+    if not new_samples_only:
+        # Samples of the second behaviour only: swapped and relabelled
+        relabel = active2 & ~new
+        swap = swap ^ relabel
+        labels = labels.clone()
+        labels[relabel, indx_behaviour1] = 1
+
+    merged = AugmentedDataset(dataset.graphs, index, swap, labels)
+    return merged.append(dataset.index[new], new_swap, new_labels)
+
 
 def merge_symetric_behaviours(indx_behaviour1, indx_behaviour2, dataset, device= 'cpu'):
 
@@ -7,40 +208,12 @@ def merge_symetric_behaviours(indx_behaviour1, indx_behaviour2, dataset, device=
     Merge two symetric behaviours in the dataset.
     For example, if the behaviour1 is 'Sniffing_Resident' and behaviour2 is 'Sniffing_Visitor', then the function
     will swap identities in the dataset, and add the events of 'Sniffing_Visitor' to 'Sniffing_Resident', merging them into one behaviour.
+    The list is modified in place, see merge_symmetric for the version without copies of the graphs.
     """
-    # Get index of the two behaviours
-
-
-    indices_beh1 = []
-    indices_beh2 = []
-
-    for i in range(len(dataset)):
-        if dataset[i].behaviour[indx_behaviour1] == 1:
-            indices_beh1.append(i)
-        if dataset[i].behaviour[indx_behaviour2] == 1:
-            indices_beh2.append(i)
-
-    for indx2 in indices_beh2:
-        if dataset[indx2].behaviour[indx_behaviour1] == 1:
-            # We create a new sample, both behaviours are active
-            new_sample = dataset[indx2].clone()
-            # Set all behaviours to 0
-            new_sample.behaviour = torch.zeros(new_sample.behaviour.shape, dtype=torch.long, device=device)
-            new_sample.behaviour[indx_behaviour1] = torch.tensor(1, dtype=torch.long, device=device)
-            # Replace 0 by 1, and 1 by 0
-            new_sample.x[:,3][new_sample.x[:,3] == 0] = torch.tensor(2)
-            new_sample.x[:,3][new_sample.x[:,3] == 1] = torch.tensor(0)
-            new_sample.x[:,3][new_sample.x[:,3] == 2] = torch.tensor(1)
-            # new sample as a Dataset object
-            
-            dataset.append(new_sample)
-        else:
-            # We leave the sample but swap the identity of the individuals and activate the first behaviour
-            dataset[indx2].behaviour[indx_behaviour1] = torch.tensor(1, dtype=torch.long)
-            dataset[indx2].x[:,3][dataset[indx2].x[:,3] == 0] = torch.tensor(2)
-            dataset[indx2].x[:,3][dataset[indx2].x[:,3] == 1] = torch.tensor(0)
-            dataset[indx2].x[:,3][dataset[indx2].x[:,3] == 2] = torch.tensor(1)
-   
+    merged = merge_symmetric(dataset, indx_behaviour1, indx_behaviour2).materialize()
+    for data in merged:
+        data.behaviour = data.behaviour.to(device)
+    dataset[:] = merged
     return
 
 def merge_symetric_behaviours_version2(indx_behaviour1, indx_behaviour2, dataset, device= 'cpu'):
@@ -53,44 +226,18 @@ def merge_symetric_behaviours_version2(indx_behaviour1, indx_behaviour2, dataset
     This function is the same as the previous, except that it does create new samples for all the behaviors occuring in the second individual. 
     This is because I hypothesize that it is important to keep information about the same behaviour in the second individual in order to make the moedel
     learn the difference between the two individuals.
+    The list is modified in place, see merge_symmetric for the version without copies of the graphs.
     """
-    # Get index of the two behaviours
-
-
-    indices_beh1 = []
-    indices_beh2 = []
-
-    for i in range(len(dataset)):
-        if dataset[i].behaviour[indx_behaviour1] == 1:
-            indices_beh1.append(i)
-        if dataset[i].behaviour[indx_behaviour2] == 1:
-            indices_beh2.append(i)
-
-    for indx2 in indices_beh2:
-        # if dataset[indx2].behaviour[indx_behaviour1] == 1:
-        # We create a new sample, both behaviours are active
-        new_sample = dataset[indx2].clone()
-        # Set all behaviours to 0
-        new_sample.behaviour = torch.zeros(new_sample.behaviour.shape, dtype=torch.long, device=device)
-        new_sample.behaviour[indx_behaviour1] = torch.tensor(1, dtype=torch.long, device=device)
-        # Replace 0 by 1, and 1 by 0
-        new_sample.x[:,3][new_sample.x[:,3] == 0] = torch.tensor(2) # 0 -> 2
-        new_sample.x[:,3][new_sample.x[:,3] == 1] = torch.tensor(0) # 1 -> 0
-        new_sample.x[:,3][new_sample.x[:,3] == 2] = torch.tensor(1) # 2 -> 1
-        # new sample as a Dataset object
-        dataset.append(new_sample)
-        # else:
-        #     # We leave the sample but swap the identity of the individuals and activate the first behaviour
-        #     dataset[indx2].behaviour[indx_behaviour1] = torch.tensor(1, dtype=torch.long)
-        #     dataset[indx2].x[:,3][dataset[indx2].x[:,3] == 0] = torch.tensor(2)
-        #     dataset[indx2].x[:,3][dataset[indx2].x[:,3] == 1] = torch.tensor(0)
-        #     dataset[indx2].x[:,3][dataset[indx2].x[:,3] == 2] = torch.tensor(1)
-   
+    merged = merge_symmetric(dataset, indx_behaviour1, indx_behaviour2, new_samples_only=True).materialize()
+    for data in merged:
+        data.behaviour = data.behaviour.to(device)
+    dataset[:] = merged
     return
 
 def rotate_samples(dataset, behaviour, device='cpu'):
     ''' 
     Rotate the samples in the dataset when the behaviour is active.
+    The dataset grows by four copies of every active sample, RandomBatchTransform gives the same variants at batch time without copies.
     '''
     indices = []
     for i in range(len(dataset)):
@@ -122,35 +269,23 @@ def rotate_samples(dataset, behaviour, device='cpu'):
 
     
 def downsample_inactive(dataset, idx_behaviour):
-    ''' Shuffle before downsampling '''
-    indx_inactive = []
-    indx_active = []
+    ''' Shuffle before downsampling. The inactive samples are downsampled to the number of active samples
+    (see samplers.BalancedBehaviourSampler to balance at every epoch without copying the dataset) '''
+    label_index = samplers.LabelIndex.from_dataset(dataset)
+    indx_active = label_index.positives(idx_behaviour)
+    indx_inactive = np.random.choice(label_index.negatives(idx_behaviour), len(indx_active), replace=False)
+    indx = np.random.permutation(np.concatenate((indx_active, indx_inactive)))
 
-    for i in range(len(dataset)):
-        if dataset[i].behaviour[idx_behaviour] == 1:
-            indx_active.append(i)
-        elif dataset[i].behaviour[idx_behaviour] == 0:
-            indx_inactive.append(i)
-
-    indx_inactive = np.random.choice(indx_inactive, len(indx_active), replace=False)
-    indx = np.concatenate((indx_active,  np.random.choice(indx_inactive, len(indx_active), replace=False) ))
-    indx = np.random.permutation(indx)
-    
     # redefine the dataset
     dataset = [dataset[i] for i in indx]
     return dataset
 
 
 def downsample_majority_class(dataset, idx_behaviour):
-    ''' Downsample the majority class '''
-    indx_inactive = []
-    indx_active = []
-
-    for i in range(len(dataset)):
-        if dataset[i].behaviour[idx_behaviour] == 1:
-            indx_active.append(i)
-        elif dataset[i].behaviour[idx_behaviour] == 0:
-            indx_inactive.append(i)
+    ''' Downsample the majority class (see samplers.BalancedBehaviourSampler to balance at every epoch without copying the dataset) '''
+    label_index = samplers.LabelIndex.from_dataset(dataset)
+    indx_active = label_index.positives(idx_behaviour)
+    indx_inactive = label_index.negatives(idx_behaviour)
 
     if len(indx_active) > len(indx_inactive):
         indx_active = np.random.choice(indx_active, len(indx_inactive), replace=False)
@@ -163,5 +298,3 @@ def downsample_majority_class(dataset, idx_behaviour):
     # redefine the dataset
     dataset = [dataset[i] for i in indx]
     return dataset
-    
-
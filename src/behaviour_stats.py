@@ -0,0 +1,160 @@
+# Statistics of the behaviours in the outputs of the inference (one row per frame, one binary column per behaviour)
+# All the behaviours of a video are processed at once from the run-length encoding of the output
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+
+FPS = 15
+BOUT_LENGTH_BINS = [0, 0.5, 1, 2, 5, 10, np.inf] # seconds
+GAP_BINS = [0, 1, 5, 10, 30, 60, np.inf] # seconds
+
+
+def run_lengths(values):
+    ''' Run-length encoding of the active frames of each behaviour.
+
+        Args:
+            values (np.ndarray): The binary outputs (n_frames, n_behaviours).
+
+        Returns:
+            behaviour (np.ndarray): The column of each bout.
+            start (np.ndarray): The first frame of each bout.
+            length (np.ndarray): The number of frames of each bout.
+            The bouts are sorted by behaviour, then by start.'''
+    active = np.asarray(values) > 0
+    n_frames, n_behaviours = active.shape
+    padded = np.zeros((n_behaviours, n_frames + 2), dtype=np.int8)
+    padded[:, 1:-1] = active.T
+    edges = np.diff(padded, axis=1)
+    behaviour, start = np.nonzero(edges == 1)
+    _, end = np.nonzero(edges == -1)
+    return behaviour, start, end - start
+
+
+def histogram_labels(bins):
+    ''' Names of the bins of a histogram, e.g. '0.5-1' and '10-inf'. '''
+    return [f'{low:g}-{high:g}' for low, high in zip(bins[:-1], bins[1:])]
+
+
+def compute_statistics(data, video, fps = FPS, num_intervals = 6, bout_bins = BOUT_LENGTH_BINS, gap_bins = GAP_BINS):
+    ''' Computes the statistics of all the behaviours of a video.
+
+        Args:
+            data (pd.DataFrame): The output of the inference, the first column is the frame, the others the behaviours.
+            video (str): The name of the video.
+            fps (float): The frame rate of the video.
+            num_intervals (int): The number of intervals of the distribution of the active frames over the video.
+            bout_bins (list): The edges (seconds) of the histogram of the bout lengths.
+            gap_bins (list): The edges (seconds) of the histogram of the intervals between two bouts.
+
+        Returns:
+            statistics (pd.DataFrame): Tidy table with the columns video, behavior, statistic, value.'''
+    behaviours = list(data.columns[1:])
+    values = data[behaviours].to_numpy() > 0
+    n_frames, n_behaviours = values.shape
+    behaviour, start, length = run_lengths(values)
+
+    n_bouts = np.bincount(behaviour, minlength=n_behaviours)
+    # Occurrences are the onsets (a 0 followed by a 1, as analyze.get_number_of_occurrences): a bout already active
+    # on the first frame is a bout but not an occurrence
+    n_occurrences = n_bouts - (values[0] if n_frames > 0 else 0)
+    duration = values.sum(axis=0)
+    # First bout of each behaviour (the bouts are sorted by behaviour then start)
+    first = np.full(n_behaviours, np.nan)
+    offsets = np.concatenate(([0], np.cumsum(n_bouts)))
+    has_bouts = n_bouts > 0
+    first[has_bouts] = start[offsets[:-1][has_bouts]]
+
+    length_sum = np.bincount(behaviour, weights=length, minlength=n_behaviours)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_length = length_sum / n_bouts
+    max_length = np.zeros(n_behaviours)
+    np.maximum.at(max_length, behaviour, length)
+
+    # Intervals between consecutive bouts of the same behaviour
+    same = behaviour[1:] == behaviour[:-1]
+    gap_behaviour = behaviour[1:][same]
+    gaps = (start[1:] - (start[:-1] + length[:-1]))[same]
+    gap_sum = np.bincount(gap_behaviour, weights=gaps, minlength=n_behaviours)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_gap = gap_sum / np.maximum(n_bouts - 1, 0)
+
+    columns = {
+        'latency (frames)': first,
+        'latency (s)': first / fps,
+        'duration (frames)': duration,
+        'duration (s)': duration / fps,
+        'number_of_occurrences': n_occurrences,
+        'number of bouts': n_bouts,
+        'mean bout length (s)': mean_length / fps,
+        'max bout length (s)': max_length / fps,
+        'mean interval between bouts (s)': mean_gap / fps,
+    }
+
+    # Active frames per interval of the video (the last frames are dropped if the length is not a multiple)
+    interval = n_frames // num_intervals
+    if interval > 0:
+        per_interval = values[:interval * num_intervals].reshape(num_intervals, interval, n_behaviours).sum(axis=1)
+        for i in range(num_intervals):
+            columns[f'interval {i}'] = per_interval[i]
+
+    # Histograms of the bout lengths and of the intervals between bouts, for all the behaviours at once
+    for name, bins, x, b in (('bout length (s)', bout_bins, length / fps, behaviour),
+                             ('interval between bouts (s)', gap_bins, gaps / fps, gap_behaviour)):
+        counts = np.zeros((n_behaviours, len(bins) - 1), dtype=np.int64)
+        bin_index = np.digitize(x, bins[1:-1])
+        np.add.at(counts, (b, bin_index), 1)
+        for j, label in enumerate(histogram_labels(bins)):
+            columns[f'{name} {label}'] = counts[:, j]
+
+    wide = pd.DataFrame(columns)
+    wide.insert(0, 'behavior', behaviours)
+    wide.insert(0, 'video', video)
+    return wide.melt(id_vars=['video', 'behavior'], var_name='statistic', value_name='value')
+
+
+def summary(statistics):
+    ''' Wide table of the main statistics, one row per video and behaviour (the table displayed by the GUI).
+        It keeps the columns of the statistics.csv written by analyze.get_statistics: the latency in frames is
+        'latancy', 0 for the behaviours never active. '''
+    wide = statistics.pivot_table(index=['video', 'behavior'], columns='statistic', values='value', sort=False, dropna=False)
+    wide = wide.reset_index().rename(columns={'latency (frames)': 'latancy'})
+    wide['latancy'] = wide['latancy'].fillna(0)
+    return wide[['video', 'behavior', 'latancy', 'duration (s)', 'duration (frames)', 'number_of_occurrences']]
+
+
+def distribution(statistics, video):
+    ''' Table of the active frames per interval of a video, one row per behaviour. '''
+    per_video = statistics[(statistics['video'] == video) & statistics['statistic'].str.startswith('interval ')
+                           & ~statistics['statistic'].str.startswith('interval between')]
+    table = per_video.pivot(index='behavior', columns='statistic', values='value')
+    table = table[sorted(table.columns, key=lambda column: int(column.split()[-1]))]
+    return table.reset_index().rename(columns={'behavior': 'Behavior'})
+
+
+def _plot_video(args):
+    ''' Saves the distribution plot of each behaviour of a video (run in a worker process). '''
+    table, video, folder = args
+    for _, row in table.iterrows():
+        values = row.drop('Behavior').to_numpy(dtype=float)
+        # Figure without pyplot: no GUI backend, safe in worker processes
+        fig = Figure()
+        ax = fig.subplots()
+        ax.bar(range(len(values)), values)
+        ax.set_xlabel('Interval')
+        ax.set_ylabel('Number of active frames')
+        ax.set_title('Distribution of ' + row['Behavior'] + ' for video ' + video)
+        fig.savefig(os.path.join(folder, row['Behavior'] + '_distribution.png'))
+
+
+def plot_distributions(statistics, path_to_files, n_workers = 1):
+    ''' Saves the distribution plots of all the videos in <path_to_files>/<video>/, one process per video if n_workers > 1. '''
+    tasks = [(distribution(statistics, video), video, os.path.join(path_to_files, video)) for video in statistics['video'].unique()]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(_plot_video, tasks))
+    else:
+        for task in tasks:
+            _plot_video(task)
@@ -0,0 +1,191 @@
+# Benchmarks of the training and inference building blocks on synthetic graphs
+# Run with: python benchmarks.py <name>
+import argparse
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch_geometric.data import Data
+
+import models
+import train
+from dataloader import SequenceDataset
+
+
+def random_graph(num_nodes, n_features = 4, n_edges_per_node = 8, behaviour = 0):
+    ''' Builds a random graph with the same node features layout as DLCDataLoader.build_graph_5.
+
+        Args:
+            num_nodes (int): The number of nodes of the graph.
+            n_features (int): The number of node features.
+            n_edges_per_node (int): The number of random edges per node.
+            behaviour (int): The label of the graph.
+
+        Returns:
+            data (Data): The random graph.'''
+    x = torch.rand(num_nodes, n_features)
+    x[:, 3] = (torch.arange(num_nodes) >= num_nodes // 2).float() # identity of the individuals
+    edge_index = torch.randint(0, num_nodes, (2, num_nodes * n_edges_per_node))
+    frame_mask = torch.zeros(num_nodes, dtype=torch.int32)
+    return Data(x=x, edge_index=edge_index, frame_mask=frame_mask, behaviour=torch.tensor(behaviour, dtype=torch.long), file='synthetic')
+
+
+def benchmark_gat_lstm(n_graphs = 512, sequence_length = 5, batch_size = 16, num_nodes = 26, hidden_dim = 16, n_repeats = 3):
+    ''' Compares the throughput of GAT_LSTM when fed with a list of sequences (one GAT call per graph)
+        and with a single Batch of all the graphs (SequenceDataset.collate, one GAT call per batch).
+
+        Args:
+            n_graphs (int): The number of graphs of the synthetic dataset.
+            sequence_length (int): The length of the sequences.
+            batch_size (int): The number of sequences per batch.
+            num_nodes (int): The number of nodes per graph.
+            hidden_dim (int): The number of hidden units of the GAT layers.
+            n_repeats (int): The number of passes over the dataset (the best one is kept).
+
+        Returns:
+            results (dict): The throughput in sequences per second of both modes.'''
+    graphs = [random_graph(num_nodes, behaviour=i % 2) for i in range(n_graphs)]
+    dataset = SequenceDataset(graphs, sequence_length)
+    model = models.GAT_LSTM(input_dim=4, hidden_dim=hidden_dim, lstm_hidden_dim=32, num_classes=2, num_nodes=num_nodes, heads=2)
+    model.eval()
+
+    samples = [dataset[i] for i in range(len(dataset))]
+    batches = [samples[i:i + batch_size] for i in range(0, len(samples), batch_size)]
+
+    def run(collated):
+        best = float('inf')
+        for _ in range(n_repeats):
+            start = time.perf_counter()
+            with torch.no_grad():
+                for batch in batches:
+                    if collated:
+                        model(SequenceDataset.collate(batch)[0])
+                    else:
+                        model([sequence for sequence, _ in batch])
+            best = min(best, time.perf_counter() - start)
+        return len(samples) / best
+
+    # Both modes give the same outputs
+    with torch.no_grad():
+        out_loop = model([sequence for sequence, _ in batches[0]])
+        out_batch = model(SequenceDataset.collate(batches[0])[0])
+    assert torch.allclose(out_loop, out_batch, atol=1e-5), 'The batched GAT_LSTM differs from the per-graph loop'
+
+    results = {'per_graph_loop (seq/s)': run(collated=False), 'batched (seq/s)': run(collated=True)}
+    for name, value in results.items():
+        print(f'{name}: {value:.1f}')
+    print(f"Speed-up: {results['batched (seq/s)'] / results['per_graph_loop (seq/s)']:.2f}x")
+    return results
+
+
+def benchmark_node_budget(n_graphs = 1024, frames_per_window = (1, 3, 5, 9), batch_sizes = (16, 64), node_budgets = (1024, 4096, 16384)):
+    ''' Compares the peak RSS and the training throughput of fixed size batches and of NodeBudgetBatchSampler,
+        on a synthetic dataset mixing windows of several lengths (26 nodes per frame as in build_graph_5).
+        The allocator does not always give memory back, so the configurations are run from the smallest to the largest batches.
+
+        Args:
+            n_graphs (int): The number of graphs of the synthetic dataset.
+            frames_per_window (tuple): The window lengths of the graphs.
+            batch_sizes (tuple): The fixed batch sizes to compare.
+            node_budgets (tuple): The budgets of nodes per batch to compare.
+
+        Returns:
+            results (list): For each configuration, the peak RSS (MB) and the throughput (samples per second).'''
+    import psutil
+    process = psutil.Process()
+    dataset = [random_graph(26 * frames_per_window[i % len(frames_per_window)], behaviour=i % 2) for i in range(n_graphs)]
+    for data in dataset:
+        data.behaviour = data.behaviour.view(1)
+
+    configurations = [('max_nodes', max_nodes) for max_nodes in sorted(node_budgets)] + [('batch_size', batch_size) for batch_size in sorted(batch_sizes)]
+    results = []
+    for mode, value in configurations:
+        torch.manual_seed(0)
+        model = train.build_model()
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+        criterion = torch.nn.CrossEntropyLoss()
+        if mode == 'batch_size':
+            loader = train.make_loader(dataset, value, shuffle=True)
+        else:
+            loader = train.make_loader(dataset, None, shuffle=True, max_nodes=value)
+
+        peak_rss = process.memory_info().rss
+        model.train()
+        start = time.perf_counter()
+        for data in loader:
+            optimizer.zero_grad()
+            loss = criterion(model(data), data.behaviour)
+            loss.backward()
+            optimizer.step()
+            peak_rss = max(peak_rss, process.memory_info().rss)
+        elapsed = time.perf_counter() - start
+
+        results.append({'mode': mode, 'value': value, 'batches': len(loader),
+                        'peak_rss (MB)': peak_rss / 2**20, 'samples/s': n_graphs / elapsed})
+        print(f"{mode}={value}: {len(loader)} batches, peak RSS {peak_rss / 2**20:.0f} MB, {n_graphs / elapsed:.1f} samples/s")
+    return results
+
+
+def _ddp_worker(rank, world_size, n_graphs, batch_size, n_epochs, results):
+    ''' Process of benchmark_ddp: trains on its shard of the synthetic dataset and checks that the replicas stay identical. '''
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29501')
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    try:
+        torch.manual_seed(0)
+        dataset = [random_graph(26, behaviour=i % 2) for i in range(n_graphs)]
+        for data in dataset:
+            data.behaviour = data.behaviour.view(1)
+        model = torch.nn.parallel.DistributedDataParallel(train.build_model())
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+        criterion = torch.nn.CrossEntropyLoss()
+        loader = train.make_loader(dataset, batch_size, shuffle=True, num_replicas=world_size, rank=rank)
+
+        samples_per_second = []
+        for epoch in range(n_epochs):
+            train.set_epoch(loader, epoch)
+            metrics = train.train_one_epoch(model, loader, optimizer, criterion, None, torch.device('cpu'))
+            samples_per_second.append(metrics['samples_per_second'])
+
+        # The gradients are all-reduced, so all the replicas must have the same parameters
+        params = torch.cat([p.detach().flatten() for p in model.parameters()])
+        gathered = [torch.empty_like(params) for _ in range(world_size)]
+        dist.all_gather(gathered, params)
+        if rank == 0:
+            assert all(torch.allclose(gathered[0], other) for other in gathered[1:]), 'The replicas diverged'
+            results[world_size] = max(samples_per_second)
+    finally:
+        dist.destroy_process_group()
+
+
+def benchmark_ddp(n_graphs = 2048, batch_size = 32, n_epochs = 2, nprocs = (1, 2, 4)):
+    ''' Trains a GraphClassifier with DistributedDataParallel (gloo backend) on 1, 2, 4... local CPU processes,
+        checks that the replicas stay synchronized and compares the training throughput.
+
+        Args:
+            n_graphs (int): The number of graphs of the synthetic dataset.
+            batch_size (int): The batch size of each process.
+            n_epochs (int): The number of epochs (the best one is kept).
+            nprocs (tuple): The numbers of processes to compare.
+
+        Returns:
+            results (dict): The throughput in samples per second for each number of processes.'''
+    manager = mp.Manager()
+    results = manager.dict()
+    for world_size in nprocs:
+        mp.spawn(_ddp_worker, args=(world_size, n_graphs, batch_size, n_epochs, results), nprocs=world_size)
+        print(f'{world_size} process(es): {results[world_size]:.1f} samples/s')
+    return dict(results)
+
+
+BENCHMARKS = {'gat_lstm': benchmark_gat_lstm, 'node_budget': benchmark_node_budget, 'ddp': benchmark_ddp}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a benchmark on synthetic graphs.')
+    parser.add_argument('name', choices=list(BENCHMARKS.keys()))
+    args = parser.parse_args()
+    BENCHMARKS[args.name]()
@@ -0,0 +1,129 @@
+# Bout-level representation of the behaviour predictions: one row per bout (behaviour, individual, start_frame, end_frame,
+# mean_confidence) instead of one 0/1 value per frame and behaviour. end_frame is exclusive, as in a slice.
+import numpy as np
+import pandas as pd
+
+from behaviour_stats import run_lengths
+
+INDIVIDUALS = {'_R': 'R', '_V': 'V'} # suffix of the columns of the outputs -> individual ('' for both)
+
+
+def split_column(column):
+    ''' Splits a column of the outputs in (behaviour, individual), e.g. 'Sniffing_R' -> ('Sniffing', 'R'). '''
+    for suffix, individual in INDIVIDUALS.items():
+        if column.endswith(suffix):
+            return column[:-len(suffix)], individual
+    return column, ''
+
+
+def join_column(behaviour, individual):
+    ''' Inverse of split_column. '''
+    return behaviour + ('_' + individual if individual else '')
+
+
+class BoutTable:
+    ''' Bouts of the behaviours of a video. The bouts are stored in arrays sorted by start frame, with the column
+        (behaviour and individual) of each bout as an index in self.columns. '''
+
+    def __init__(self, columns, column, start, end, confidence, n_frames):
+        ''' Constructor of the BoutTable class.
+
+            Args:
+                columns (list): The names of the columns of the outputs, e.g. 'Sniffing_R'.
+                column (np.ndarray): The index in columns of each bout.
+                start (np.ndarray): The first frame of each bout.
+                end (np.ndarray): The frame after the last frame of each bout.
+                confidence (np.ndarray): The mean probability of the behaviour over each bout (NaN if unknown).
+                n_frames (int): The number of frames of the video.'''
+        order = np.argsort(start, kind='stable')
+        self.columns = list(columns)
+        self.column = np.asarray(column, dtype=np.int32)[order]
+        self.start = np.asarray(start, dtype=np.int64)[order]
+        self.end = np.asarray(end, dtype=np.int64)[order]
+        self.confidence = np.asarray(confidence, dtype=np.float32)[order]
+        self.n_frames = int(n_frames)
+        self.max_length = int((self.end - self.start).max()) if len(self.start) else 0
+
+    def __len__(self):
+        return len(self.start)
+
+    @classmethod
+    def from_dense(cls, outputs, probabilities = None):
+        ''' Builds the bouts from a dense output of the inference.
+
+            Args:
+                outputs (pd.DataFrame): One row per frame, the column 'Frame' (or the index) and one 0/1 column per behaviour.
+                probabilities (pd.DataFrame): The probability of each behaviour per frame, with the same layout (optional).
+
+            Returns:
+                bouts (BoutTable): The bouts.'''
+        outputs = dense_frames(outputs)
+        columns = list(outputs.columns)
+        values = outputs.to_numpy() > 0
+        column, start, length = run_lengths(values)
+        end = start + length
+
+        confidence = np.full(len(start), np.nan)
+        if probabilities is not None:
+            probabilities = dense_frames(probabilities)
+            known = np.isin(columns, probabilities.columns)
+            probabilities = probabilities.reindex(index=outputs.index, columns=columns).to_numpy(dtype=np.float64)
+            # Mean over each bout from the cumulative sums
+            cumulative = np.zeros((probabilities.shape[0] + 1, probabilities.shape[1]))
+            np.cumsum(np.nan_to_num(probabilities), axis=0, out=cumulative[1:])
+            confidence = (cumulative[end, column] - cumulative[start, column]) / length
+            confidence[~known[column]] = np.nan
+        return cls(columns, column, start, end, confidence, len(outputs))
+
+    def to_dense(self):
+        ''' Returns the dense output (one row per frame, 'Frame' and one 0/1 column per behaviour). '''
+        delta = np.zeros((self.n_frames + 1, len(self.columns)), dtype=np.int32)
+        np.add.at(delta, (self.start, self.column), 1)
+        np.add.at(delta, (self.end, self.column), -1)
+        values = (np.cumsum(delta[:-1], axis=0) > 0).astype(np.int64)
+        outputs = pd.DataFrame(values, columns=self.columns)
+        outputs.insert(0, 'Frame', np.arange(self.n_frames))
+        return outputs
+
+    def overlapping(self, first_frame, last_frame):
+        ''' Returns the indices of the bouts overlapping the frames first_frame to last_frame (included).
+            The bouts are sorted by start and none is longer than max_length, so only the bouts starting in
+            [first_frame - max_length, last_frame] are candidates. '''
+        low = np.searchsorted(self.start, first_frame - self.max_length, side='left')
+        high = np.searchsorted(self.start, last_frame, side='right')
+        candidates = np.arange(low, high)
+        return candidates[self.end[candidates] > first_frame]
+
+    def to_frame(self, indices = None):
+        ''' Returns the bouts (all or the given indices) as a DataFrame
+            (behaviour, individual, start_frame, end_frame, mean_confidence). '''
+        if indices is None:
+            indices = np.arange(len(self))
+        names = [split_column(column) for column in self.columns]
+        column = self.column[indices]
+        return pd.DataFrame({'behaviour': [names[c][0] for c in column],
+                             'individual': [names[c][1] for c in column],
+                             'start_frame': self.start[indices],
+                             'end_frame': self.end[indices],
+                             'mean_confidence': self.confidence[indices]})
+
+    def query(self, first_frame, last_frame):
+        ''' Returns the bouts overlapping the frames first_frame to last_frame as a DataFrame. '''
+        return self.to_frame(self.overlapping(first_frame, last_frame))
+
+    def save(self, path):
+        ''' Saves the bouts in a compressed .npz file. '''
+        np.savez_compressed(path, columns=np.array(self.columns), column=self.column, start=self.start.astype(np.int32),
+                            end=self.end.astype(np.int32), confidence=self.confidence.astype(np.float16), n_frames=self.n_frames)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['columns'].tolist(), f['column'], f['start'], f['end'], f['confidence'], f['n_frames'])
+
+
+def dense_frames(outputs):
+    ''' Returns the outputs indexed by frame, with a row for every frame from 0 (the missing frames are 0). '''
+    if 'Frame' in outputs.columns:
+        outputs = outputs.set_index('Frame')
+    return outputs.reindex(np.arange(int(outputs.index.max()) + 1 if len(outputs) else 0), fill_value=0)
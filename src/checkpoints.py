@@ -0,0 +1,188 @@
+# Checkpoints of the training engine (train.py): saving and loading, retention of the best checkpoints,
+# early stopping and export of the inference-only checkpoints used by analyze.MODELS_PATH
+import glob
+import json
+import os
+import re
+
+import torch
+from torch.nn.parallel import DistributedDataParallel
+
+
+def save_checkpoint(model, optimizer, epoch, loss, path, extra = None):
+    ''' Saves the model, optimizer state, epoch, and loss (and the entries of extra, e.g. the behaviours of a multi-task model). '''
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    checkpoint = {
+        'epoch': epoch,
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'loss': loss,
+    }
+    checkpoint.update(extra or {})
+    torch.save(checkpoint, path)
+    print(f"Checkpoint saved at {path}")
+
+
+def load_checkpoint(path, model, optimizer = None, device = 'cpu', early_stopping = None):
+    ''' Loads a checkpoint written by save_checkpoint.
+
+        Args:
+            path (str): The path to the checkpoint.
+            model (nn.Module): The model, its weights are replaced.
+            optimizer (Optimizer): The optimizer, its state is replaced (if given).
+            device (torch.device): The device on which to load the checkpoint.
+            early_stopping (EarlyStopping): The early stopping, its state is replaced (if given and saved in the checkpoint).
+
+        Returns:
+            epoch (int): The number of epochs already done.'''
+    checkpoint = torch.load(path, map_location=device)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    if optimizer is not None and 'optimizer_state_dict' in checkpoint:
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    if early_stopping is not None and 'early_stopping' in checkpoint:
+        early_stopping.load_state_dict(checkpoint['early_stopping'])
+    print(f"Resuming from {path} (epoch {checkpoint['epoch']})")
+    return checkpoint['epoch']
+
+
+def latest_checkpoint(checkpoint_dir):
+    ''' Returns the path of the checkpoint with the highest epoch in the directory, None if there is none. '''
+    checkpoints = glob.glob(os.path.join(checkpoint_dir, 'checkpoint_epoch_*.pth'))
+    if len(checkpoints) == 0:
+        return None
+    return max(checkpoints, key=lambda path: int(re.findall(r'checkpoint_epoch_(\d+)', path)[-1]))
+
+
+def export_inference_checkpoint(checkpoint_path, output_path):
+    ''' Writes a slim copy of a checkpoint with only what the inference needs: the weights of the model
+        (with the configuration of the model and the behaviour names of a multi-task model), without the optimizer state.
+        The output can be loaded by analyze.load_model like the full checkpoints.
+
+        Args:
+            checkpoint_path (str): The checkpoint written by save_checkpoint.
+            output_path (str): The path of the inference checkpoint.
+
+        Returns:
+            output_path (str): The path of the inference checkpoint.'''
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    slim = {key: checkpoint[key] for key in ('model_state_dict', 'model_config', 'behaviours', 'behaviour_names') if key in checkpoint}
+    torch.save(slim, output_path)
+    print(f"Inference checkpoint (epoch {checkpoint['epoch']}) saved at {output_path}")
+    return output_path
+
+
+def is_better(value, reference, mode, min_delta = 0.0):
+    ''' Returns whether value improves on reference by more than min_delta ('min': lower is better, 'max': higher is better). '''
+    if reference is None:
+        return True
+    if mode == 'min':
+        return value < reference - min_delta
+    return value > reference + min_delta
+
+
+class EarlyStopping:
+    ''' Stops the training when the validation metric has not improved for patience epochs. '''
+
+    def __init__(self, patience, mode = 'min', min_delta = 0.0):
+        ''' Constructor of the EarlyStopping class.
+
+            Args:
+                patience (int): The number of epochs without improvement before stopping.
+                mode (str): 'min' if the metric must decrease (loss), 'max' if it must increase (accuracy).
+                min_delta (float): The minimal change of the metric counted as an improvement.'''
+        self.patience = patience
+        self.mode = mode
+        self.min_delta = min_delta
+        self.best = None
+        self.bad_epochs = 0
+
+    def step(self, value):
+        ''' Records the metric of an epoch, returns True if the training must stop. '''
+        if is_better(value, self.best, self.mode, self.min_delta):
+            self.best = value
+            self.bad_epochs = 0
+        else:
+            self.bad_epochs += 1
+        return self.bad_epochs >= self.patience
+
+    def state_dict(self):
+        return {'best': self.best, 'bad_epochs': self.bad_epochs}
+
+    def load_state_dict(self, state):
+        self.best = state['best']
+        self.bad_epochs = state['bad_epochs']
+
+
+class CheckpointManager:
+    ''' Saves the checkpoints of a training and only keeps the top-k by a validation metric and the latest one,
+        the others are deleted. The metrics of the kept checkpoints are stored in checkpoints.json, so the
+        retention goes on when a training is resumed in the same directory. '''
+
+    def __init__(self, checkpoint_dir, metric = 'loss', mode = 'min', keep_top_k = 3):
+        ''' Constructor of the CheckpointManager class.
+
+            Args:
+                checkpoint_dir (str): The directory of the checkpoints.
+                metric (str): The validation metric used to rank the checkpoints ('loss' or 'accuracy').
+                mode (str): 'min' if lower is better, 'max' if higher is better.
+                keep_top_k (int): The number of best checkpoints kept (the latest one is always kept too).'''
+        self.checkpoint_dir = checkpoint_dir
+        self.metric = metric
+        self.mode = mode
+        self.keep_top_k = keep_top_k
+        self.index_path = os.path.join(checkpoint_dir, 'checkpoints.json')
+        self.records = [] # {'epoch', 'path', 'value'} of the kept checkpoints
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.records = [record for record in json.load(f)['checkpoints'] if os.path.exists(record['path'])]
+
+    def save(self, model, optimizer, epoch, loss, metrics, extra = None):
+        ''' Saves the checkpoint of the epoch and deletes the checkpoints that are neither in the top-k nor the latest.
+
+            Args:
+                model (nn.Module): The model.
+                optimizer (Optimizer): The optimizer.
+                epoch (int): The number of epochs done.
+                loss (float): The training loss.
+                metrics (dict): The validation metrics, metrics[self.metric] ranks the checkpoint.
+                extra (dict): Other entries of the checkpoint.
+
+            Returns:
+                path (str): The path of the checkpoint.'''
+        path = os.path.join(self.checkpoint_dir, f'checkpoint_epoch_{epoch}.pth')
+        save_checkpoint(model, optimizer, epoch, loss, path, dict(extra or {}, val_metrics=metrics))
+        # A resumed training can write again an epoch already recorded
+        self.records = [record for record in self.records if record['epoch'] != epoch]
+        self.records.append({'epoch': epoch, 'path': path, 'value': float(metrics[self.metric])})
+        self.prune()
+        return path
+
+    def ranked(self):
+        ''' Returns the records from the best to the worst (the earliest epoch first on ties). '''
+        sign = 1 if self.mode == 'min' else -1
+        return sorted(self.records, key=lambda record: (sign * record['value'], record['epoch']))
+
+    def is_top_k(self, value):
+        ''' Returns whether a checkpoint with the metric value would be among the top-k kept ones. '''
+        ranked = self.ranked()
+        if len(ranked) < self.keep_top_k:
+            return True
+        return is_better(value, ranked[self.keep_top_k - 1]['value'], self.mode)
+
+    def best(self):
+        ''' Returns the path of the best checkpoint, None if there is none. '''
+        ranked = self.ranked()
+        return ranked[0]['path'] if ranked else None
+
+    def prune(self):
+        ''' Deletes the checkpoints that are neither in the top-k nor the latest, and updates checkpoints.json. '''
+        latest = max(self.records, key=lambda record: record['epoch'])
+        keep = self.ranked()[:self.keep_top_k] + [latest]
+        keep_epochs = {record['epoch'] for record in keep}
+        for record in self.records:
+            if record['epoch'] not in keep_epochs and os.path.exists(record['path']):
+                os.remove(record['path'])
+        self.records = [record for record in self.records if record['epoch'] in keep_epochs]
+        with open(self.index_path, 'w') as f:
+            json.dump({'metric': self.metric, 'mode': self.mode, 'checkpoints': self.records}, f, indent=1)
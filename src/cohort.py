@@ -0,0 +1,212 @@
+# Statistics of a whole cohort: the outputs of the inference of many sessions (result folders, e.g. one per
+# experiment/sex/test) are scanned in a process pool and summarized per group (e.g. genotype and sex) in one pass.
+# The statistics of each output are cached with the modification time of the file, so only the new or changed
+# sessions are recomputed.
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import behaviour_stats
+import postprocessing
+import probability_store
+import video_index
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+CACHE_FILE = 'cohort_cache.pkl'
+DECILES = np.arange(1, 10) / 10
+
+
+def list_videos(folders):
+    ''' Returns the videos of the folders {name without extension: path}, listed once per scan. If two folders have a
+        video with the same name, the first folder wins. '''
+    videos = {}
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for file in os.listdir(folder):
+            stem, extension = os.path.splitext(file)
+            if extension.lower() in VIDEO_EXTENSIONS:
+                videos.setdefault(stem, os.path.join(folder, file))
+    return videos
+
+
+def find_video(video, videos):
+    ''' Returns the path of the video of an output, None if it is not found. The name of the output can be longer
+        than the name of the video (e.g. the suffix added by DeepLabCut), the longest matching name is used.
+
+        Args:
+            video (str): The name of the output.
+            videos (dict): The videos {name: path}, see list_videos.'''
+    matches = [stem for stem in videos if video.startswith(stem)]
+    return videos[max(matches, key=len)] if matches else None
+
+
+def video_fps(video, videos, default = behaviour_stats.FPS):
+    ''' Returns the frame rate of the video of an output, default if the video is not found. The frame rate is read
+        from the index of the video if it exists (see video_index), else from the metadata of the container: the video
+        is never scanned. '''
+    path = find_video(video, videos)
+    if path is None:
+        return default
+    if os.path.exists(video_index.index_path(path)):
+        fps = video_index.VideoIndex.load(video_index.index_path(path)).fps
+    else:
+        capture = cv2.VideoCapture(path)
+        fps = capture.get(cv2.CAP_PROP_FPS) if capture.isOpened() else 0
+        capture.release()
+    return fps if fps > 0 else default
+
+
+def _file_statistics(args):
+    ''' Statistics of one output of the inference (run in a worker process). '''
+    path, session, videos, num_intervals, smoothing = args
+    folder = os.path.dirname(path)
+    video = os.path.basename(path)[:-len('_output.csv')]
+    data = pd.read_csv(path)
+    if smoothing is not None:
+        probabilities_path = probability_store.probabilities_path(folder, video)
+        probabilities = probability_store.load_probabilities(probabilities_path) if os.path.exists(probabilities_path) else None
+        data = postprocessing.postprocess_outputs(data, probabilities, **smoothing)
+    fps = video_fps(video, videos)
+    statistics = behaviour_stats.compute_statistics(data, video, fps, num_intervals)
+    statistics.insert(0, 'session', session)
+    statistics['fps'] = fps
+    return statistics
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+def load_cache(path, params):
+    ''' Returns the cached statistics {output path: ((session, signature), statistics)}, empty if the parameters changed. '''
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as f:
+        cache = pickle.load(f)
+    return cache['files'] if cache['params'] == params else {}
+
+
+def scan_cohort(sessions, video_dirs = (), num_intervals = 10, smoothing = None, n_workers = 1, cache_path = None):
+    ''' Statistics of all the outputs (<video>_output.csv) of all the sessions, only the outputs new or changed since
+        the last scan are computed again (if cache_path is given).
+
+        Args:
+            sessions (dict): {session name: result folder}.
+            video_dirs (list): The folders where the videos are searched (besides the result folder), for their frame rate.
+            num_intervals (int): The number of intervals of the distribution of the active frames (10: deciles of the video).
+            smoothing (dict): The parameters of postprocessing.postprocess_outputs, None to use the raw outputs.
+            n_workers (int): The number of processes.
+            cache_path (str): The file of the cached statistics, None to compute everything.
+
+        Returns:
+            statistics (pd.DataFrame): Tidy table with the columns session, video, behavior, statistic, value, fps.'''
+    params = {'video_dirs': list(video_dirs), 'num_intervals': num_intervals, 'smoothing': smoothing}
+    cached = load_cache(cache_path, params) if cache_path is not None else {}
+
+    files = {}
+    for session, folder in sessions.items():
+        for file in sorted(os.listdir(folder)):
+            if file.endswith('_output.csv'):
+                path = os.path.join(folder, file)
+                files[path] = (session, _signature(path))
+
+    # An output is computed again if it changed or moved to another session
+    stale = [path for path in files if path not in cached or cached[path][0] != files[path]]
+    print(f'{len(files)} outputs in {len(sessions)} sessions, {len(stale)} to compute')
+    # The folders of the videos are listed once per scan (and each result folder once), the videos of the result
+    # folder take precedence, and the map is given to the workers
+    dir_videos = list_videos(video_dirs) if stale else {}
+    folder_videos = {}
+    tasks = []
+    for path in stale:
+        folder = os.path.dirname(path)
+        if folder not in folder_videos:
+            folder_videos[folder] = {**dir_videos, **list_videos([folder])}
+        tasks.append((path, files[path][0], folder_videos[folder], num_intervals, smoothing))
+    if n_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_file_statistics, tasks, chunksize=max(1, len(tasks) // (4 * n_workers))))
+    else:
+        results = [_file_statistics(task) for task in tasks]
+
+    # The outputs deleted since the last scan are dropped from the cache
+    cache = {path: cached[path] for path in files if path in cached}
+    cache.update({path: (files[path], table) for path, table in zip(stale, results)})
+    if cache_path is not None:
+        with open(cache_path, 'wb') as f:
+            pickle.dump({'params': params, 'files': cache}, f)
+
+    tables = [cache[path][1] for path in files]
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=['session', 'video', 'behavior', 'statistic', 'value', 'fps'])
+
+
+def group_summary(statistics, group_columns, confidence = 0.95):
+    ''' Mean, standard deviation and confidence interval of the mean (Student t) of each statistic per group.
+
+        Args:
+            statistics (pd.DataFrame): The statistics with the group columns (see aggregate_cohort).
+            group_columns (list): The columns defining the groups, e.g. ['genotype', 'sex'].
+            confidence (float): The level of the confidence intervals.
+
+        Returns:
+            summary (pd.DataFrame): One row per group, behaviour and statistic.'''
+    grouped = statistics.groupby(list(group_columns) + ['behavior', 'statistic'], sort=False)['value']
+    summary = grouped.agg(n='count', mean='mean', std='std').reset_index()
+    sem = summary['std'] / np.sqrt(summary['n'])
+    # t quantile for all the groups at once (NaN for the groups of one video)
+    t = stats.t.ppf((1 + confidence) / 2, np.maximum(summary['n'] - 1, 1))
+    half_width = np.where(summary['n'] > 1, t * sem, np.nan)
+    summary['ci_low'] = summary['mean'] - half_width
+    summary['ci_high'] = summary['mean'] + half_width
+    return summary
+
+
+def group_deciles(statistics, group_columns):
+    ''' Deciles (10% to 90%) of each statistic over the videos of each group, one column per decile. '''
+    grouped = statistics.groupby(list(group_columns) + ['behavior', 'statistic'], sort=False)['value']
+    deciles = grouped.quantile(DECILES).unstack()
+    deciles.columns = [f'q{int(round(q * 100))}' for q in deciles.columns]
+    return deciles.reset_index()
+
+
+def aggregate_cohort(sessions, path_to_save, video_dirs = (), num_intervals = 10, smoothing = None, n_workers = 1, incremental = True):
+    ''' Statistics of a cohort, per video and per group, saved in csv files in path_to_save:
+        cohort_statistics_long.csv (every statistic of every video), cohort_summary.csv (mean and confidence interval per group)
+        and cohort_deciles.csv (deciles per group). The distribution of the active frames over the video is in the
+        statistics 'interval 0' to 'interval <num_intervals - 1>'.
+
+        Args:
+            sessions (dict): {session name: (result folder, {group column: value})}, e.g.
+                {'DMD_male_Test1': ('results/DMD_male_Test1', {'genotype': 'DMD', 'sex': 'male'})}.
+            path_to_save (str): The folder of the csv files (and of the cache).
+            video_dirs (list): The folders where the videos are searched, for their frame rate.
+            num_intervals (int): The number of intervals of the distribution of the active frames over the video.
+            smoothing (dict): The parameters of postprocessing.postprocess_outputs, None to use the raw outputs.
+            n_workers (int): The number of processes.
+            incremental (bool): Whether to reuse the statistics of the outputs that did not change since the last call.
+
+        Returns:
+            summary (pd.DataFrame): The summary per group.'''
+    os.makedirs(path_to_save, exist_ok=True)
+    cache_path = os.path.join(path_to_save, CACHE_FILE) if incremental else None
+    statistics = scan_cohort({session: folder for session, (folder, _) in sessions.items()}, video_dirs, num_intervals,
+                             smoothing, n_workers, cache_path)
+
+    groups = pd.DataFrame([dict(groups, session=session) for session, (_, groups) in sessions.items()])
+    group_columns = [column for column in groups.columns if column != 'session']
+    statistics = groups.merge(statistics, on='session', how='right')
+
+    summary = group_summary(statistics, group_columns)
+    deciles = group_deciles(statistics, group_columns)
+
+    statistics.to_csv(os.path.join(path_to_save, 'cohort_statistics_long.csv'), index = False, sep=';')
+    summary.to_csv(os.path.join(path_to_save, 'cohort_summary.csv'), index = False, sep=';')
+    deciles.to_csv(os.path.join(path_to_save, 'cohort_deciles.csv'), index = False, sep=';')
+    return summary
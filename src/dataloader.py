@@ -1,9 +1,8 @@
 # DATALOADER CLASS to handle the data loading and preprocessing
 # We load the .h5 files with the trajectories of DeepLabCut and preprocess them to build the graps
-from torch_geometric.data import Data, DataLoader
+from torch_geometric.data import Data, DataLoader, Batch
 from torch_geometric.utils import from_scipy_sparse_matrix
 import time
-import random
 #from statsmodels.tsa.arima.model import ARIMA
 
 import h5py
@@ -323,28 +322,109 @@ class DLCDataLoader:
 
 
 class SequenceDataset(torch.utils.data.Dataset):
+    ''' Dataset of sequences of consecutive graphs, labelled by the behaviour of the central graph.
+        Only the start index of each sequence is stored, the graphs are sliced in __getitem__.
+        A sequence never spans two files (videos). '''
     def __init__(self, graphs, sequence_length):
+        ''' Constructor of the SequenceDataset class.
+
+            Args:
+                graphs (list): The graphs (Data objects), ordered by file and frame.
+                sequence_length (int): The number of graphs per sequence.'''
         self.graphs = graphs
         self.sequence_length = sequence_length
-        self.sequences = self.create_sequences()
+        self.starts = self.create_sequences()
 
     def create_sequences(self):
-        sequences = []
-        # Create sequences of graphs while maintaining temporal coherence
-        for idx in range(len(self.graphs) - self.sequence_length + 1):
-            sequence = self.graphs[idx: idx + self.sequence_length]
-            central_idx = idx + self.sequence_length // 2
-            label = self.graphs[central_idx].behaviour
-            sequences.append((sequence, label))
-        return sequences
+        ''' Function that computes the start index of every sequence while maintaining temporal coherence.
+
+            Returns:
+                starts (np.ndarray): The index of the first graph of each sequence.'''
+        n_graphs = len(self.graphs)
+        files = np.array([getattr(graph, 'file', '') for graph in self.graphs])
+        # Boundaries of the runs of graphs coming from the same file
+        boundaries = np.concatenate(([0], np.flatnonzero(files[1:] != files[:-1]) + 1, [n_graphs]))
+        starts = [np.arange(first, last - self.sequence_length + 1)
+                  for first, last in zip(boundaries[:-1], boundaries[1:])
+                  if last - first >= self.sequence_length]
+        if len(starts) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(starts)
 
     def shuffle(self):
-        random.shuffle(self.sequences)  # Shuffle the sequences
+        ''' Shuffle the order of the sequences (only the start indices are permuted). '''
+        self.starts = np.random.permutation(self.starts)
+
+    def sampler(self, shuffle = True, generator = None):
+        ''' Function that returns a sampler over the sequences, to be given to a torch DataLoader.
+
+            Args:
+                shuffle (bool): If True, the sequences are drawn in a new random order at every epoch.
+                generator (torch.Generator): The generator used to shuffle.
+
+            Returns:
+                sampler (torch.utils.data.Sampler): The sampler.'''
+        if shuffle:
+            return torch.utils.data.RandomSampler(self, generator=generator)
+        return torch.utils.data.SequentialSampler(self)
+
+    def subset(self, starts):
+        ''' Function that returns a SequenceDataset of the given sequences, sharing the graphs.
+
+            Args:
+                starts (np.ndarray): The start indices of the sequences.
+
+            Returns:
+                dataset (SequenceDataset): The dataset of these sequences.'''
+        dataset = SequenceDataset.__new__(SequenceDataset)
+        dataset.graphs = self.graphs
+        dataset.sequence_length = self.sequence_length
+        dataset.starts = np.array(starts, dtype=np.int64)
+        return dataset
+
+    def split(self, fraction):
+        ''' Function that splits the sequences in two subsets, keeping the current order.
+            The subsets hold their own start indices, so shuffling the dataset afterwards does not change them.
+
+            Args:
+                fraction (float): The fraction of sequences in the first subset.
+
+            Returns:
+                first (SequenceDataset), second (SequenceDataset): The two subsets.'''
+        split_idx = int(fraction * len(self))
+        return self.subset(self.starts[:split_idx]), self.subset(self.starts[split_idx:])
+
+    def materialise(self):
+        ''' Function that builds the list of all the (sequence, label) pairs, in one pass over the dataset.
+            Prefer indexing the dataset, which slices a single sequence.
+
+            Returns:
+                sequences (list): The (sequence, label) pairs.'''
+        return [self[idx] for idx in range(len(self))]
 
     def __len__(self):
-        return len(self.sequences)
+        return len(self.starts)
 
     def __getitem__(self, idx):
-        return self.sequences[idx]   
+        start = self.starts[idx]
+        sequence = self.graphs[start: start + self.sequence_length]
+        label = self.graphs[start + self.sequence_length // 2].behaviour
+        return sequence, label
+
+    @staticmethod
+    def collate(samples):
+        ''' Collate function for torch.utils.data.DataLoader. All the graphs of all the sequences are merged
+            in a single torch_geometric Batch, so GAT_LSTM runs the GAT once per batch.
+
+            Args:
+                samples (list): The (sequence, label) pairs of the batch.
+
+            Returns:
+                batch (Batch): The graphs of the sequences, one after the other, with the attribute sequence_length.
+                labels (torch.Tensor): The labels of the sequences.'''
+        batch = Batch.from_data_list([graph for sequence, _ in samples for graph in sequence])
+        batch.sequence_length = len(samples[0][0])
+        labels = torch.stack([label for _, label in samples])
+        return batch, labels
 
 
@@ -0,0 +1,157 @@
+# Cache of the downsampled frames (thumbnails) displayed by the annotation GUI
+# A background thread decodes the thumbnails around the frames the GUI is likely to show next (the current frame and
+# the neighbouring events) into a bounded LRU cache, so scrubbing and jumps are served without touching the decoder.
+# Optionally, all the thumbnails of the video are written once to a memory-mapped file next to the video, used directly
+# by the next sessions.
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def thumbnails_path(video_path, size):
+    ''' Returns the path of the thumbnail file of the video for the (width, height). '''
+    return f'{video_path}.thumbnails_{size[0]}x{size[1]}.npy'
+
+
+class ThumbnailCache:
+    ''' Thumbnails of a video, from the thumbnail file if it exists, else from an LRU cache filled by a background thread.
+        The reader is shared with the thread (guarded by a lock), it must not be used by others while the cache is open. '''
+
+    def __init__(self, reader, size, capacity = 2048, window = 42, use_file = False):
+        ''' Constructor of the ThumbnailCache class.
+
+            Args:
+                reader (video_index.IndexedVideoReader): The reader of the video.
+                size (tuple): The (width, height) of the thumbnails.
+                capacity (int): The maximum number of thumbnails in memory.
+                window (int): The number of frames prefetched around each requested frame.
+                use_file (bool): Whether to use the thumbnail file (see thumbnails_path), built in the background
+                    when the cache is idle if it does not exist yet.'''
+        self.reader = reader
+        self.size = tuple(size)
+        self.capacity = capacity
+        self.window = window
+        self.thumbnails = OrderedDict() # frame -> thumbnail, the most recently used last
+        self.file = None
+        self.file_path = thumbnails_path(reader.video_path, self.size) if use_file else None
+        self.build_pos = 0 if use_file else None # next frame written to the thumbnail file being built
+        if use_file and os.path.exists(self.file_path):
+            self.file = np.load(self.file_path, mmap_mode='r')
+            self.build_pos = None
+
+        self.reader_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.requests = [] # frames to prefetch around, the most urgent first
+        self.generation = 0 # incremented on each request, the thread abandons the outdated ones
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _decode(self, frame):
+        ''' Decodes the thumbnail of the frame (the reader seeks only if the frame is not the next one). '''
+        with self.reader_lock:
+            ret, image = self.reader.read(frame)
+        if not ret:
+            raise Exception(f"Error reading frame {frame}/{self.reader.frame_count}")
+        return cv2.resize(image, self.size)
+
+    def _store(self, frame, thumbnail):
+        with self.lock:
+            self.thumbnails[frame] = thumbnail
+            self.thumbnails.move_to_end(frame)
+            while len(self.thumbnails) > self.capacity:
+                self.thumbnails.popitem(last=False)
+
+    def get(self, frame):
+        ''' Returns the thumbnail of the frame, decoded now if it is not cached. '''
+        if self.file is not None:
+            return np.array(self.file[frame])
+        with self.lock:
+            thumbnail = self.thumbnails.get(frame)
+            if thumbnail is not None:
+                self.thumbnails.move_to_end(frame)
+                return thumbnail
+        thumbnail = self._decode(frame)
+        self._store(frame, thumbnail)
+        return thumbnail
+
+    def get_range(self, start, stop):
+        ''' Returns the thumbnails of the frames start to stop - 1. '''
+        if self.file is not None:
+            return list(np.array(self.file[start:stop]))
+        return [self.get(frame) for frame in range(start, stop)]
+
+    def prefetch(self, frames):
+        ''' Asks the background thread to decode the thumbnails around the frames (the first ones first),
+            the previous requests are dropped. '''
+        if self.file is not None:
+            return
+        with self.lock:
+            self.requests = [int(frame) for frame in frames]
+            self.generation += 1
+            self.wakeup.notify()
+
+    def _missing(self, center):
+        ''' Returns the frames around center (window before and after) that are not cached. '''
+        first = max(center - self.window, 0)
+        last = min(center + self.window + 1, self.reader.frame_count)
+        with self.lock:
+            return [frame for frame in range(first, last) if frame not in self.thumbnails]
+
+    def _build_step(self, n_frames = 32):
+        ''' Writes the next n_frames thumbnails to the thumbnail file, opens it when it is complete. '''
+        tmp_path = self.file_path[:-len('.npy')] + '.tmp.npy'
+        n_total = self.reader.frame_count
+        mode = 'w+' if self.build_pos == 0 else 'r+'
+        if mode == 'w+':
+            thumbnails = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(n_total, self.size[1], self.size[0], 3))
+        else:
+            thumbnails = np.load(tmp_path, mmap_mode='r+')
+        stop = min(self.build_pos + n_frames, n_total)
+        for frame in range(self.build_pos, stop):
+            thumbnails[frame] = self._decode(frame)
+        thumbnails.flush()
+        del thumbnails
+        self.build_pos = stop
+        if stop == n_total:
+            os.replace(tmp_path, self.file_path)
+            self.file = np.load(self.file_path, mmap_mode='r')
+            self.build_pos = None
+            with self.lock:
+                self.thumbnails.clear()
+
+    def _run(self):
+        ''' Background thread: decodes the requested neighbourhoods, else builds the thumbnail file, else waits. '''
+        while True:
+            with self.lock:
+                while not self.closed and not self.requests and self.build_pos is None:
+                    self.wakeup.wait()
+                if self.closed:
+                    return
+                generation = self.generation
+                center = self.requests.pop(0) if self.requests else None
+            try:
+                if center is None:
+                    self._build_step()
+                    continue
+                # Sequential decoding from the first missing frame, stopped as soon as a newer request arrives
+                for frame in self._missing(center):
+                    if self.generation != generation or self.closed:
+                        break
+                    self._store(frame, self._decode(frame))
+            except Exception as e:
+                print(f"Error in the thumbnail cache: {e}")
+                with self.lock:
+                    self.requests = []
+                    self.build_pos = None
+
+    def close(self):
+        ''' Stops the background thread (the reader is not released). '''
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.thread.join()
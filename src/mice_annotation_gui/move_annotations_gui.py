@@ -8,12 +8,23 @@ from PyQt5.QtGui import QImage, QPixmap, QColor
 from PyQt5.QtTest import QTest
 import pandas as pd
 import numpy as np
-import cv2
 import time
 import traceback as tb
 from typing import Optional, List
 import inspect
 
+try:
+    import video_index
+except ImportError:
+    # Run as a script from mice_annotation_gui/
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import video_index
+
+try:
+    from . import frame_cache
+except ImportError:
+    import frame_cache
+
 
 NROW = 7
 NCOL = 6
@@ -21,6 +32,8 @@ NFRAME = NROW * NCOL
 NSIDE = NFRAME // 2
 BIN = 4
 SKIP = 2
+CACHE_SIZE = 2048  # number of thumbnails kept in memory
+THUMBNAIL_FILE = False  # write all the thumbnails of a video once to a file next to it (~1.5 GB for 30 min at 640x480)
 
 COLORS = np.array([
     [1, 0, 0],  # red
@@ -223,8 +236,9 @@ class MovieViewer(QMainWindow):
         # layout within the left column for buttons and controls.
         self.main_layout.addLayout(self.controls_layout)
 
-        # OpenCV video capture object
+        # OpenCV video capture object, and the cache of its thumbnails
         self.cap = None
+        self.frame_cache = None
         self.n_frame = None
         self.nx = self.ny = None
         self.frame_rate = None
@@ -462,6 +476,8 @@ class MovieViewer(QMainWindow):
 
         # Stop movie playing
         self.play_button.setChecked(False)
+        if self.frame_cache is not None:
+            self.frame_cache.close()
 
         event.accept()
     # endregion Window
@@ -570,13 +586,9 @@ class MovieViewer(QMainWindow):
         elif step == 'end':
             self.set_frame(self.n_frame + 1)
         elif step == 'event':
-            # 'event' frames are those with behavior on and a neighbor is off
             if self.current_behavior is None:
                 return
-            on = self.annotations[:, self.current_behavior]
-            off = np.hstack((True, np.logical_not(on), True))
-            events = np.logical_and(
-                on, np.logical_or(off[:-2], off[2:]))
+            events = self._event_frames()
             if n_step == 1:
                 # search for the next event
                 next_event = np.where(events[self.frame_pos + 1:])[0] + 1
@@ -594,6 +606,24 @@ class MovieViewer(QMainWindow):
             else:
                 raise RuntimeError(f'Invalid move_frame arguments {step}, {n_step}')
 
+    def _event_frames(self):
+        # 'event' frames are those with behavior on and a neighbor is off
+        on = self.annotations[:, self.current_behavior]
+        off = np.hstack((True, np.logical_not(on), True))
+        return np.logical_and(on, np.logical_or(off[:-2], off[2:]))
+
+    def _prefetch(self):
+        # decode in the background the frames around the current one and
+        # around the previous and next events
+        frames = [self.frame_pos]
+        if self.annotations is not None and self.current_behavior is not None:
+            events = np.flatnonzero(self._event_frames())
+            next_event = np.searchsorted(events, self.frame_pos, side='right')
+            previous_event = np.searchsorted(events, self.frame_pos) - 1
+            frames += [events[i] for i in (next_event, previous_event)
+                       if 0 <= i < len(events)]
+        self.frame_cache.prefetch(frames)
+
     def previous_frame(self):
         self.move_frame('frame', -1)
 
@@ -686,14 +716,9 @@ class MovieViewer(QMainWindow):
             n_read = self.n_frame - frame_start
             n_miss_right = NFRAME - n_read
 
-        # read full-size current frame and display it
+        # read current frame (binned, from the cache) and display it
         if changed_single_frame:
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, single_frame_pos)
-            ret, single_frame = self.cap.read()
-            if not ret:
-                raise Exception(
-                    f"Error reading frame {self.frame_pos}/{self.n_frame}")
-            self.single_frame = cv2.resize(single_frame, (self.nx, self.ny))
+            self.single_frame = self.frame_cache.get(single_frame_pos)
 
         # read n_read frames and store them in self.frame_stack
         if not changed_frame:
@@ -703,31 +728,15 @@ class MovieViewer(QMainWindow):
             read_frame = frame_start + NFRAME - 1
             if read_frame >= self.n_frame:
                 frame = np.zeros_like(self.frame_stack[0])
-                ret = True
             else:
-                self.cap.set(cv2.CAP_PROP_POS_FRAMES, read_frame)
-                ret, frame = self.cap.read()
-            if ret:
-                # bin frame
-                frame = cv2.resize(frame, (self.nx, self.ny))
-                self.frame_stack.pop(0)
-                self.frame_stack.append(frame)
-            else:
-                raise Exception(
-                    f"Error reading frame {read_frame}/{self.n_frame}")
+                frame = self.frame_cache.get(read_frame)
+            self.frame_stack.pop(0)
+            self.frame_stack.append(frame)
         else:
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_start)
-            self.frame_stack = []
-            frame = None  # to avoid IDE warning below...
-            for i in range(n_read):
-                ret, frame = self.cap.read()
-                if ret:
-                    # bin frame
-                    frame = cv2.resize(frame, (self.nx, self.ny))
-                    self.frame_stack.append(frame)
-                else:
-                    raise Exception(f"Error reading frame "
-                                    f"{frame_start + i}/{self.n_frame}")
+            # binned frames from the cache, decoded only if missing
+            self.frame_stack = self.frame_cache.get_range(
+                frame_start, frame_start + n_read)
+            frame = self.frame_stack[-1]
             if n_miss_left:
                 z = np.zeros_like(frame)
                 self.frame_stack = [z] * n_miss_left + self.frame_stack
@@ -776,6 +785,10 @@ class MovieViewer(QMainWindow):
             frames = frames.reshape(NROW * frames.shape[1],
                                     NCOL * frames.shape[3], frames.shape[4])
             self._display_frames(frames)
+
+        # decode the frames likely to be displayed next
+        if changed_frame:
+            self._prefetch()
     # endregion Display
 
     # region Movie updates
@@ -794,23 +807,29 @@ class MovieViewer(QMainWindow):
         with open('check_pose_gui_last_file.txt', 'w') as file:
             file.write(file_path)
 
-        # Open the video file with OpenCV
+        # Open the video file with OpenCV, the index of the video (built
+        # on the first opening) gives exact seeks and the video info
+        if self.frame_cache is not None:
+            self.frame_cache.close()
+            self.frame_cache = None
         if self.cap is not None:
             self.cap.release()
-        self.cap = cv2.VideoCapture(file_path)
-
-        # Check if the video file was successfully opened
-        if not self.cap.isOpened():
+            self.cap = None
+        try:
+            self.cap = video_index.IndexedVideoReader(file_path)
+        except (IOError, OSError):
             print("Error opening video file")
             return
 
         # Update slider upper bound
-        self.n_frame = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        self.nx0 = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.n_frame = self.cap.frame_count
+        self.nx0, self.ny0 = self.cap.size
         self.nx = self.nx0 // BIN
-        self.ny0 = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         self.ny = self.ny0 // BIN
-        self.frame_rate = self.cap.get(cv2.CAP_PROP_FPS)
+        self.frame_rate = self.cap.fps
+        self.frame_cache = frame_cache.ThumbnailCache(
+            self.cap, (self.nx, self.ny), CACHE_SIZE, NFRAME,
+            THUMBNAIL_FILE)
         self.time_slider.setMaximum(self.n_frame - 1)
         self._prepare_frame_display()
 
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from torch_geometric.nn import GATv2Conv, global_mean_pool
+from torch_geometric.data import Batch
 
 
 
@@ -281,6 +282,12 @@ class GraphClassifier(nn.Module):
         self.readout = readout
 
     def forward(self, batch):
+        embbed = self.embed(batch)
+        # concatenate the embeddings for each frame
+        return self.classifier(embbed)
+
+    def embed(self, batch):
+        ''' Encodes the graphs of the batch and applies the readout, returns one embedding per graph '''
         x, edge_index, frame_mask, graph_batch = batch.x, batch.edge_index, batch.frame_mask, batch.batch
         embbed = self.encoder(x, edge_index)
         if self.readout == 'mean':
@@ -289,9 +296,7 @@ class GraphClassifier(nn.Module):
             embbed = self.max_pooling_per_graph(embbed, graph_batch, frame_mask)
         elif self.readout == 'concatenate':
             embbed = self.concatenate_per_graph(embbed, graph_batch, frame_mask)
-
-        # concatenate the embeddings for each frame
-        return self.classifier(embbed)
+        return embbed
     
     @staticmethod
     def concatenate_per_graph(embbed, batch, frame_mask):
@@ -323,6 +328,51 @@ class GraphClassifier(nn.Module):
         pass
     
 
+class MultiTaskGraphClassifier(GraphClassifier):
+    def __init__(self, encoder, heads, readout = 'mean'):
+        ''' Classifier of several behaviours at once: the encoder and the readout are shared, and each behaviour
+        has its own classification head. The output has shape (n_graphs, n_tasks, n_classes).
+            - encoder: the shared encoder (GATEncoder)
+            - heads: list of ClassificationHead, one per behaviour
+            - readout: the readout method, as in GraphClassifier'''
+        super(MultiTaskGraphClassifier, self).__init__(encoder, None, readout)
+        self.heads = nn.ModuleList(heads)
+
+    def forward(self, batch):
+        embbed = self.embed(batch)
+        return torch.stack([head(embbed) for head in self.heads], dim=1)
+
+    def task(self, i):
+        ''' Returns the GraphClassifier of the i-th behaviour, sharing the weights of this model '''
+        return GraphClassifier(self.encoder, self.heads[i], self.readout)
+
+
+def build_model(nout = 64, nhid = 32, attention_heads = 2, n_in = 4, n_layers = 4, dropout = 0.2, readout = 'mean', n_classes = 2, n_tasks = None):
+    ''' Builds a GraphClassifier (GATEncoder + ClassificationHead), by default with the configuration of the models in analyze.MODELS_PATH.
+        The arguments are stored in the checkpoints of train.py (model_config) to rebuild the model at inference.
+        If n_tasks is given, builds a MultiTaskGraphClassifier with one ClassificationHead per behaviour on a shared GATEncoder.
+
+        Args:
+            nout (int): The dimension of the latent space.
+            nhid (int): The number of hidden units in the GAT layers.
+            attention_heads (int): The number of attention heads in the GAT layers.
+            n_in (int): The number of input features.
+            n_layers (int): The number of GAT layers.
+            dropout (float): The dropout rate.
+            readout (str): The readout method, 'mean', 'max' or 'concatenate'.
+            n_classes (int): The number of classes.
+            n_tasks (int): The number of behaviours of a multi-task model (None for a single behaviour).
+
+        Returns:
+            model (GraphClassifier): The model.'''
+    encoder = GATEncoder(nout=nout, nhid=nhid, attention_heads=attention_heads, n_in=n_in, n_layers=n_layers, dropout=dropout)
+    if n_tasks is not None:
+        heads = [ClassificationHead(n_latent=nout, nhid=nhid, nout=n_classes) for _ in range(n_tasks)]
+        return MultiTaskGraphClassifier(encoder=encoder, heads=heads, readout=readout)
+    classifier = ClassificationHead(n_latent=nout, nhid=nhid, nout=n_classes)
+    return GraphClassifier(encoder=encoder, classifier=classifier, readout=readout)
+
+
 ###### NEW MODEL #########
 
 class GATLayer(nn.Module):
@@ -360,21 +410,25 @@ class GAT_LSTM(nn.Module):
         self.fc = nn.Linear(lstm_hidden_dim, num_classes)
 
     def forward(self, batch):
-        batch_size = len(batch)
-        sequence_len = len(batch[0])  # assuming all sequences are the same length
-
-        gcn_out = []
-        for seq in batch:
-            # Each element in batch is a sequence of graphs (Data objects)
-            seq_out = []
-            for graph in seq:
-                # Process each graph frame in the sequence with GCN
-                x = self.gcn(graph)
-                # Flatten the output to pass into LSTM
-                seq_out.append(x.view(-1))  # Flatten node features for LSTM
-            gcn_out.append(torch.stack(seq_out))  # Stack the sequence
-
-        gcn_out = torch.stack(gcn_out)  # Batch all sequences Shape 
+        ''' The batch is either a torch_geometric Batch with all the graphs of all the sequences (see SequenceDataset.collate),
+            in which case the GAT is run once over all the graphs, or a list of sequences of graphs (Data objects). '''
+        if isinstance(batch, Batch):
+            x = self.gcn(batch) # (n_sequences * sequence_length * num_nodes, hidden_dim)
+            # Flatten node features per graph and split the graphs into sequences for the LSTM
+            gcn_out = x.view(-1, batch.sequence_length, self.num_nodes * x.size(-1))
+        else:
+            gcn_out = []
+            for seq in batch:
+                # Each element in batch is a sequence of graphs (Data objects)
+                seq_out = []
+                for graph in seq:
+                    # Process each graph frame in the sequence with GCN
+                    x = self.gcn(graph)
+                    # Flatten the output to pass into LSTM
+                    seq_out.append(x.view(-1))  # Flatten node features for LSTM
+                gcn_out.append(torch.stack(seq_out))  # Stack the sequence
+
+            gcn_out = torch.stack(gcn_out)  # Batch all sequences Shape 
         lstm_out, (h_n, c_n) = self.lstm(gcn_out)  # Pass through LSTM
 
         # Use the final hidden state of the LSTM to classify
@@ -0,0 +1,205 @@
+# Temporal post-processing of the outputs of the inference: the predictions are independent per window, so they flicker.
+# Every filter works on whole videos and all the behaviours at once, in O(n_frames), and only needs the saved outputs
+# (and the probabilities if available), so it can be re-run with other parameters without running the models again.
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from behaviour_stats import run_lengths
+
+
+def _window_sums(values, window):
+    ''' Sums of the values over a centered window (clipped at the edges of the video), and the size of each window.
+
+        Args:
+            values (np.ndarray): The values (n_frames, n_behaviours).
+            window (int): The size of the window (odd).
+
+        Returns:
+            sums (np.ndarray): The sums (n_frames, n_behaviours).
+            sizes (np.ndarray): The number of frames in each window (n_frames, 1).'''
+    n_frames = values.shape[0]
+    half = window // 2
+    cumulative = np.zeros((n_frames + 1, values.shape[1]))
+    np.cumsum(values, axis=0, out=cumulative[1:])
+    frames = np.arange(n_frames)
+    low = np.clip(frames - half, 0, n_frames)
+    high = np.clip(frames + half + 1, 0, n_frames)
+    return cumulative[high] - cumulative[low], (high - low)[:, None]
+
+
+def majority_filter(values, window):
+    ''' A frame is active if the behaviour is active in more than half of the frames of the window around it
+        (the median filter of binary values).
+
+        Args:
+            values (np.ndarray): The binary outputs (n_frames, n_behaviours).
+            window (int): The size of the window in frames (odd, 1 leaves the outputs unchanged).
+
+        Returns:
+            values (np.ndarray): The filtered binary outputs.'''
+    values = np.asarray(values) > 0
+    if window <= 1 or len(values) == 0:
+        return values
+    sums, sizes = _window_sums(values, window)
+    return 2 * sums > sizes
+
+
+def median_filter(probabilities, window):
+    ''' Median of the probabilities over a centered window (the edges are padded with the first and last frame).
+
+        Args:
+            probabilities (np.ndarray): The probabilities (n_frames, n_behaviours).
+            window (int): The size of the window in frames (odd).
+
+        Returns:
+            probabilities (np.ndarray): The filtered probabilities.'''
+    probabilities = np.asarray(probabilities, dtype=np.float32)
+    if window <= 1 or len(probabilities) == 0:
+        return probabilities
+    half = window // 2
+    padded = np.pad(probabilities, ((half, half), (0, 0)), mode='edge')
+    # (n_frames, n_behaviours, window) view, no copy; the window is a small constant so this stays linear in the frames
+    return np.median(sliding_window_view(padded, window, axis=0), axis=-1)
+
+
+def _set_runs(values, column, start, length, value):
+    ''' Sets the runs (column, start, length) of the values to value, with a difference array. '''
+    delta = np.zeros((values.shape[0] + 1, values.shape[1]), dtype=np.int32)
+    np.add.at(delta, (start, column), 1)
+    np.add.at(delta, (start + length, column), -1)
+    inside = np.cumsum(delta[:-1], axis=0) > 0
+    values = values.copy()
+    values[inside] = value
+    return values
+
+
+def fill_gaps(values, max_gap):
+    ''' Merges the bouts of a behaviour separated by at most max_gap inactive frames.
+
+        Args:
+            values (np.ndarray): The binary outputs (n_frames, n_behaviours).
+            max_gap (int): The longest gap filled, in frames.
+
+        Returns:
+            values (np.ndarray): The binary outputs with the short gaps filled.'''
+    values = np.asarray(values) > 0
+    if max_gap <= 0:
+        return values
+    column, start, length = run_lengths(~values)
+    # Only the gaps between two bouts, not the inactive frames at the start and the end of the video
+    inner = (start > 0) & (start + length < len(values)) & (length <= max_gap)
+    return _set_runs(values, column[inner], start[inner], length[inner], True)
+
+
+def remove_short_bouts(values, min_length):
+    ''' Removes the bouts shorter than min_length frames.
+
+        Args:
+            values (np.ndarray): The binary outputs (n_frames, n_behaviours).
+            min_length (int): The shortest bout kept, in frames.
+
+        Returns:
+            values (np.ndarray): The binary outputs without the short bouts.'''
+    values = np.asarray(values) > 0
+    if min_length <= 1:
+        return values
+    column, start, length = run_lengths(values)
+    short = length < min_length
+    return _set_runs(values, column[short], start[short], length[short], False)
+
+
+def viterbi(probabilities, p_stay = 0.95, eps = 1e-6):
+    ''' Most likely sequence of a two-state (inactive/active) hidden Markov model per behaviour, with the probabilities of
+        the model as emissions and a probability p_stay of staying in the same state from a frame to the next.
+        The behaviours are decoded together: the loop is over the frames only.
+
+        Args:
+            probabilities (np.ndarray): The probability of each behaviour (n_frames, n_behaviours).
+            p_stay (float): The probability of staying in the same state, the higher the smoother.
+            eps (float): Lower bound of the probabilities, to avoid log(0).
+
+        Returns:
+            values (np.ndarray): The binary outputs (n_frames, n_behaviours).'''
+    p = np.clip(np.asarray(probabilities, dtype=np.float64), eps, 1 - eps)
+    n_frames, n_behaviours = p.shape
+    if n_frames == 0:
+        return np.zeros(p.shape, dtype=bool)
+    emissions = np.stack([np.log1p(-p), np.log(p)], axis=-1) # (n_frames, n_behaviours, 2)
+    log_stay, log_switch = np.log(p_stay), np.log1p(-p_stay)
+
+    score = emissions[0].copy()
+    came_from_switch = np.zeros((n_frames, n_behaviours, 2), dtype=bool)
+    for t in range(1, n_frames):
+        stay = score + log_stay
+        switch = score[:, ::-1] + log_switch
+        came_from_switch[t] = switch > stay
+        score = np.maximum(stay, switch) + emissions[t]
+
+    states = np.empty((n_frames, n_behaviours), dtype=bool)
+    state = score.argmax(axis=1).astype(bool)
+    behaviours = np.arange(n_behaviours)
+    for t in range(n_frames - 1, -1, -1):
+        states[t] = state
+        state = state ^ came_from_switch[t, behaviours, state.astype(np.int64)]
+    return states
+
+
+def postprocess(values, probabilities = None, method = 'majority', window = 1, min_length = 0, max_gap = 0, p_stay = 0.95):
+    ''' Smooths the outputs of a video: first the filter (on the probabilities if given, else on the predictions),
+        then the gaps shorter than max_gap are filled and the bouts shorter than min_length are removed.
+
+        Args:
+            values (np.ndarray): The binary outputs (n_frames, n_behaviours).
+            probabilities (np.ndarray): The probabilities of the behaviours, same shape (optional, needed by 'viterbi').
+            method (str): 'majority' (on the predictions), 'median' (on the probabilities, then thresholded at 0.5)
+                or 'viterbi' (two-state HMM on the probabilities).
+            window (int): The size of the window of the majority and median filters, in frames.
+            min_length (int): The shortest bout kept, in frames.
+            max_gap (int): The longest gap between two bouts filled, in frames.
+            p_stay (float): The probability of staying in the same state of the HMM.
+
+        Returns:
+            values (np.ndarray): The smoothed binary outputs.'''
+    if method == 'majority' or probabilities is None:
+        if method == 'viterbi':
+            raise ValueError('The viterbi smoothing needs the probabilities')
+        values = majority_filter(values, window)
+    elif method == 'median':
+        values = median_filter(probabilities, window) > 0.5
+    elif method == 'viterbi':
+        values = viterbi(probabilities, p_stay)
+    else:
+        raise ValueError(f'Unknown smoothing method {method}')
+    values = fill_gaps(values, max_gap)
+    return remove_short_bouts(values, min_length)
+
+
+def postprocess_outputs(outputs, probabilities = None, **params):
+    ''' Smooths an output of the inference (analyze.inference_video), see postprocess for the parameters.
+
+        Args:
+            outputs (pd.DataFrame): The output, the column 'Frame' and one binary column per behaviour.
+            probabilities (pd.DataFrame): The probabilities, the column 'Frame' (or the index) and a column per behaviour.
+                The behaviours without probabilities (Linear models) are smoothed with the majority filter.
+
+        Returns:
+            outputs (pd.DataFrame): The smoothed output, same layout.'''
+    outputs = outputs.copy()
+    behaviours = [column for column in outputs.columns if column != 'Frame']
+    values = outputs[behaviours].to_numpy() > 0
+    smoothed = np.empty_like(values)
+
+    known = [] if probabilities is None else [i for i, behaviour in enumerate(behaviours) if behaviour in probabilities.columns]
+    unknown = [i for i in range(len(behaviours)) if i not in known]
+    if known:
+        if 'Frame' in probabilities.columns:
+            probabilities = probabilities.set_index('Frame')
+        frames = outputs['Frame'] if 'Frame' in outputs.columns else outputs.index
+        p = probabilities.reindex(index=frames, columns=[behaviours[i] for i in known]).fillna(0).to_numpy()
+        smoothed[:, known] = postprocess(values[:, known], p, **params)
+    if unknown:
+        params = dict(params, method='majority') if params.get('method') in ('median', 'viterbi') else params
+        smoothed[:, unknown] = postprocess(values[:, unknown], None, **params)
+
+    outputs[behaviours] = smoothed.astype(np.int64)
+    return outputs
@@ -0,0 +1,71 @@
+# Per-frame probabilities of the behaviours, stored next to the outputs of the inference (<video>_probabilities.npy)
+# One float16 column per behaviour and individual view, one row per frame from frame 0 (NaN for the frames without
+# prediction), and the names of the columns in a sidecar (<video>_probabilities.json). The array is read with a memory
+# map, so thresholding, calibration and smoothing run offline without loading the whole file or running the models.
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+SUFFIX = '_probabilities.npy'
+COLUMNS_SUFFIX = '_probabilities.json'
+
+
+def probabilities_path(path_to_files, video):
+    ''' Returns the path of the probabilities of the video. '''
+    return os.path.join(path_to_files, video + SUFFIX)
+
+
+def save_probabilities(probabilities, path):
+    ''' Saves the probabilities of a video.
+
+        Args:
+            probabilities (pd.DataFrame): The column 'Frame' (or the index) and one column per behaviour, e.g. 'Following_R'.
+            path (str): The path of the .npy file, the columns are saved in the .json next to it.'''
+    if 'Frame' in probabilities.columns:
+        probabilities = probabilities.set_index('Frame')
+    n_frames = int(probabilities.index.max()) + 1 if len(probabilities) else 0
+    array = np.full((n_frames, probabilities.shape[1]), np.nan, dtype=np.float16)
+    array[probabilities.index.to_numpy(dtype=np.int64)] = probabilities.to_numpy(dtype=np.float16)
+    np.save(path, array)
+    with open(path[:-len(SUFFIX)] + COLUMNS_SUFFIX, 'w') as f:
+        json.dump({'columns': [str(column) for column in probabilities.columns]}, f)
+
+
+def load_probabilities(path, as_frame = True):
+    ''' Loads the probabilities of a video.
+
+        Args:
+            path (str): The path of the .npy file.
+            as_frame (bool): If True, returns a DataFrame (float32, column 'Frame' first), else the memory-mapped array.
+
+        Returns:
+            probabilities (pd.DataFrame): The probabilities if as_frame.
+            array (np.memmap), columns (list): The float16 array (n_frames, n_columns) and its columns otherwise.'''
+    array = np.load(path, mmap_mode='r')
+    with open(path[:-len(SUFFIX)] + COLUMNS_SUFFIX) as f:
+        columns = json.load(f)['columns']
+    if not as_frame:
+        return array, columns
+    probabilities = pd.DataFrame(np.asarray(array, dtype=np.float32), columns=columns)
+    probabilities.insert(0, 'Frame', np.arange(len(probabilities)))
+    return probabilities
+
+
+def threshold(probabilities, thresholds = 0.5):
+    ''' Binary outputs from the probabilities (the frames without prediction are 0).
+
+        Args:
+            probabilities (pd.DataFrame): The probabilities, as returned by load_probabilities.
+            thresholds (float or dict): The threshold of all the behaviours, or one per column (0.5 for the missing ones).
+
+        Returns:
+            outputs (pd.DataFrame): The outputs, same layout as the output of the inference.'''
+    columns = [column for column in probabilities.columns if column != 'Frame']
+    if isinstance(thresholds, dict):
+        thresholds = np.array([thresholds.get(column, 0.5) for column in columns])
+    outputs = probabilities.copy()
+    # NaN > threshold is False
+    outputs[columns] = (probabilities[columns].to_numpy() > thresholds).astype(np.int64)
+    return outputs
@@ -0,0 +1,389 @@
+# Fast rendering of videos with overlays and extraction of clips (used by DataDLC.create_video and create_video_per_event),
+# and pose-only rendering from the coordinates alone, without decoding the video (DataDLC.create_pose_video)
+# The coordinates are extracted once to an int array and the body parts are stamped as discs with one fancy-indexing
+# assignment per frame. Decoding, drawing and encoding run in three threads linked by bounded queues (OpenCV releases
+# the GIL while decoding and encoding), so the three stages overlap.
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+from behaviour_stats import run_lengths
+import video_index
+from video_index import IndexedVideoReader
+
+MISSING = -1 # coordinate of the body parts not detected (NaN)
+FRAME_SIZE = (640, 480) # (width, height) of the pose-only videos without background
+SKELETON = [('Nose', 'Left_ear'), ('Left_ear', 'Left_fhip'), ('Left_fhip', 'Left_mid'), ('Left_mid', 'Left_bhip'), ('Left_bhip', 'Tail_base'),
+            ('Nose', 'Right_ear'), ('Right_ear', 'Right_fhip'), ('Right_fhip', 'Right_mid'), ('Right_mid', 'Right_bhip'), ('Right_bhip', 'Tail_base'),
+            ('Tail_base', 'Tail_1'), ('Tail_1', 'Tail_2'), ('Tail_2', 'Tail_3'), ('Tail_3', 'Tail_4'), ('Tail_4', 'Tail_tip')]
+CENTER_OF_MASS = 'Center of mass'
+_DONE = object() # end of a queue
+
+
+def coordinates_array(coords, individuals, body_parts):
+    ''' Extracts the coordinates of a DataDLC table to an array.
+
+        Args:
+            coords (pd.DataFrame): The coordinates, columns (individual, body part, 'x'/'y'/...).
+            individuals (list): The individuals.
+            body_parts (list): The body parts.
+
+        Returns:
+            points (np.ndarray): The coordinates (n_frames, n_individuals, n_body_parts, 2) as int32 (x, y),
+                MISSING for the NaNs.'''
+    columns = [(ind, body_part, axis) for ind in individuals for body_part in body_parts for axis in ('x', 'y')]
+    values = coords.loc[:, columns].to_numpy(dtype=np.float64).reshape(len(coords), len(individuals), len(body_parts), 2)
+    missing = np.isnan(values).any(axis=-1, keepdims=True)
+    return np.where(missing, MISSING, values).astype(np.int32)
+
+
+def disc_offsets(radius):
+    ''' Returns the (dx, dy) offsets of the pixels of a filled disc of the radius, shape (n_pixels, 2). '''
+    d = np.arange(-radius, radius + 1)
+    dx, dy = np.meshgrid(d, d)
+    inside = dx ** 2 + dy ** 2 <= radius ** 2
+    return np.stack([dx[inside], dy[inside]], axis=1)
+
+
+def draw_discs(frame, points, colors, offsets):
+    ''' Draws a filled disc at each point, in place.
+
+        Args:
+            frame (np.ndarray): The image (height, width, 3).
+            points (np.ndarray): The centers (n, 2) as (x, y), the points with a MISSING coordinate are skipped.
+            colors (np.ndarray): The BGR color of each point (n, 3).
+            offsets (np.ndarray): The offsets of the pixels of the disc (see disc_offsets).'''
+    valid = (points != MISSING).all(axis=1)
+    points, colors = points[valid], colors[valid]
+    pixels = points[:, None, :] + offsets[None, :, :] # (n, n_pixels, 2)
+    height, width = frame.shape[:2]
+    inside = (pixels[..., 0] >= 0) & (pixels[..., 0] < width) & (pixels[..., 1] >= 0) & (pixels[..., 1] < height)
+    color = np.broadcast_to(colors[:, None, :], pixels.shape[:2] + (3,))
+    frame[pixels[..., 1][inside], pixels[..., 0][inside]] = color[inside]
+
+
+class PoseOverlay:
+    ''' Draws the body parts of the individuals (and optionally their coordinates before the preprocessing)
+        and the names of the individuals on the frames. '''
+
+    def __init__(self, points, individuals, colors, radius = 4, previous_points = None, previous_colors = None, previous_radius = 6):
+        ''' Constructor of the PoseOverlay class.
+
+            Args:
+                points (np.ndarray): The coordinates (n_frames, n_individuals, n_body_parts, 2), see coordinates_array.
+                individuals (list): The names of the individuals.
+                colors (list): The BGR color of each individual.
+                radius (int): The radius of the discs.
+                previous_points (np.ndarray): Other coordinates drawn below, same shape (optional).
+                previous_colors (list): The BGR color of each individual for previous_points.
+                previous_radius (int): The radius of the discs of previous_points.'''
+        self.points = points
+        self.individuals = list(individuals)
+        self.colors = np.asarray(colors, dtype=np.uint8)
+        self.offsets = disc_offsets(radius)
+        self.previous_points = previous_points
+        if previous_points is not None:
+            self.previous_colors = np.asarray(previous_colors, dtype=np.uint8)
+            self.previous_offsets = disc_offsets(previous_radius)
+        n_body_parts = points.shape[2]
+        # Color of each point of a frame, flattened as the points
+        self.point_colors = np.repeat(self.colors, n_body_parts, axis=0)
+        if previous_points is not None:
+            self.previous_point_colors = np.repeat(self.previous_colors, n_body_parts, axis=0)
+
+    def __call__(self, i, frame):
+        if self.previous_points is not None:
+            draw_discs(frame, self.previous_points[i].reshape(-1, 2), self.previous_point_colors, self.previous_offsets)
+        draw_discs(frame, self.points[i].reshape(-1, 2), self.point_colors, self.offsets)
+        for j, ind in enumerate(self.individuals):
+            color = tuple(int(c) for c in self.colors[j])
+            cv2.putText(frame, ind, (50, 50 + 50*j), cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2, cv2.LINE_AA)
+        return frame
+
+
+def _put(q, item, stop):
+    ''' Puts the item in the bounded queue, gives up if stop is set (another stage failed). '''
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _items(q, stop):
+    ''' Yields the items of the queue until its end, or until stop is set. '''
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _DONE:
+            return
+        yield item
+
+
+def run_pipeline(items, work, consume, queue_size = 16):
+    ''' Runs a three-stage pipeline: the items are produced in a thread, work is applied in a second thread and
+        consume is called in the calling thread, in order. The queues between the stages are bounded, so at most
+        2 * queue_size items are in memory. An error in any stage stops the others and is raised.
+
+        Args:
+            items (iterable): The items, e.g. the decoded frames.
+            work (callable): Applied to each item, e.g. drawing.
+            consume (callable): Called on the result of work for each item, e.g. encoding.
+            queue_size (int): The size of the queues.'''
+    produced, worked = queue.Queue(queue_size), queue.Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def produce():
+        try:
+            for item in items:
+                if not _put(produced, item, stop):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put(produced, _DONE, stop)
+
+    def transform():
+        try:
+            for item in _items(produced, stop):
+                if not _put(worked, work(item), stop):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put(worked, _DONE, stop)
+
+    threads = [threading.Thread(target=produce, daemon=True), threading.Thread(target=transform, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        for result in _items(worked, stop):
+            consume(result)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+def render_video(video_path, output_path, draw, frames = None, fps = 20.0, fourcc = 'XVID', queue_size = 16, progress = None):
+    ''' Renders a video with an overlay: decoding, drawing and encoding run in three threads (see run_pipeline).
+
+        Args:
+            video_path (str): The path to the video.
+            output_path (str): The path of the rendered video.
+            draw (callable): draw(frame index, image) -> image, called in order on every frame.
+            frames (tuple): The range of frames (start, stop) to render, all the frames if None.
+            fps (float): The frame rate of the rendered video.
+            fourcc (str): The codec of the rendered video.
+            queue_size (int): The number of frames buffered between two stages.
+            progress (callable): Called with 1 after each frame written (optional, e.g. tqdm.update).
+
+        Returns:
+            n_frames (int): The number of frames written.'''
+    reader = IndexedVideoReader(video_path)
+    start, stop = (0, reader.frame_count) if frames is None else frames
+    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps, reader.size)
+    n_written = 0
+
+    def write(image):
+        nonlocal n_written
+        writer.write(image)
+        n_written += 1
+        if progress is not None:
+            progress(1)
+
+    try:
+        run_pipeline(reader.frames(start, stop), lambda item: draw(*item), write, queue_size)
+    finally:
+        reader.release()
+        writer.release()
+    return n_written
+
+
+def active_segments(active):
+    ''' Returns the (start, stop) of the runs of frames where any column is active, from the run-length encoding. '''
+    _, start, length = run_lengths(np.asarray(active).any(axis=1, keepdims=True))
+    return list(zip(start.tolist(), (start + length).tolist()))
+
+
+def extract_clips(video_path, active, output_paths, fps = 20.0, fourcc = 'XVID', queue_size = 16, progress = None):
+    ''' Writes, for each column of active, a video with the frames where it is active. The video is decoded once:
+        the reader seeks to the start of each run of active frames (of any column) and skips the inactive spans,
+        and each frame is written to the videos of all the columns active on it.
+
+        Args:
+            video_path (str): The path to the video.
+            active (np.ndarray): Whether each column is active on each frame (n_frames, n_columns).
+            output_paths (list): The path of the video of each column (the columns never active are not written).
+            fps (float): The frame rate of the videos.
+            fourcc (str): The codec of the videos.
+            queue_size (int): The number of frames buffered between the decoding and the encoding.
+            progress (callable): Called with 1 after each frame decoded (optional, e.g. tqdm.update).
+
+        Returns:
+            n_frames (np.ndarray): The number of frames written in each video.'''
+    active = np.asarray(active, dtype=bool)
+    segments = active_segments(active)
+    reader = IndexedVideoReader(video_path)
+    writers = [cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, reader.size) if active[:, k].any() else None
+               for k, path in enumerate(output_paths)]
+
+    def decode():
+        for start, stop in segments:
+            for item in reader.frames(start, stop):
+                yield item
+
+    def write(item):
+        i, image = item
+        for k in np.flatnonzero(active[i]):
+            writers[k].write(image)
+        if progress is not None:
+            progress(1)
+
+    try:
+        run_pipeline(decode(), lambda item: item, write, queue_size)
+    finally:
+        reader.release()
+        for writer in writers:
+            if writer is not None:
+                writer.release()
+    return active.sum(axis=0)
+
+
+def skeleton_edges(body_parts, skeleton = SKELETON):
+    ''' Returns the edges of the skeleton as pairs of indices in body_parts (the edges of missing body parts are dropped). '''
+    index = {body_part: i for i, body_part in enumerate(body_parts)}
+    return np.array([(index[a], index[b]) for a, b in skeleton if a in index and b in index], dtype=np.int64).reshape(-1, 2)
+
+
+def video_size(video_path):
+    ''' Returns the (width, height) of the frames of the video, from its index if it exists, else from the metadata
+        of the container (the video is not scanned). '''
+    if os.path.exists(video_index.index_path(video_path)):
+        index = video_index.VideoIndex.load(video_index.index_path(video_path))
+        return index.width, index.height
+    capture = cv2.VideoCapture(video_path)
+    try:
+        return int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        capture.release()
+
+
+def cached_background(video_path, n_samples = 15):
+    ''' Returns a background of the video: the median of n_samples frames spread over the video (the mice move, so they
+        mostly disappear). It is computed once and stored next to the video (<video>.background.png).
+        The exact frames do not matter, so the video is read with a plain cv2.VideoCapture, without index. '''
+    path = video_path + '.background.png'
+    if os.path.exists(path):
+        return cv2.imread(path)
+    capture = cv2.VideoCapture(video_path)
+    frames = []
+    try:
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        for i in np.linspace(0, max(frame_count - 1, 0), n_samples).astype(int):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, int(i))
+            ret, image = capture.read()
+            if ret:
+                frames.append(image)
+    finally:
+        capture.release()
+    if not frames:
+        raise IOError(f'Cannot read the frames of {video_path}')
+    background = np.median(np.stack(frames), axis=0).astype(np.uint8)
+    cv2.imwrite(path, background)
+    return background
+
+
+class SkeletonOverlay(PoseOverlay):
+    ''' Draws the skeletons, the centers of mass (larger discs), the names of the individuals and the labels of
+        the behaviours active on the frame. '''
+
+    def __init__(self, points, individuals, body_parts, colors, labels = None, label_names = None, radius = 3, center_radius = 6):
+        ''' Constructor of the SkeletonOverlay class.
+
+            Args:
+                points (np.ndarray): The coordinates (n_frames, n_individuals, n_body_parts, 2), see coordinates_array.
+                individuals (list): The names of the individuals.
+                body_parts (list): The names of the body parts (the center of mass is CENTER_OF_MASS).
+                colors (list): The BGR color of each individual.
+                labels (np.ndarray): Whether each behaviour is active on each frame (n_frames, n_behaviours), optional.
+                label_names (list): The names of the behaviours.
+                radius (int): The radius of the body parts.
+                center_radius (int): The radius of the centers of mass.'''
+        body_parts = list(body_parts)
+        self.center = body_parts.index(CENTER_OF_MASS) if CENTER_OF_MASS in body_parts else None
+        parts = [j for j in range(len(body_parts)) if j != self.center]
+        super().__init__(points[:, :, parts], individuals, colors, radius)
+        self.edges = skeleton_edges([body_parts[j] for j in parts])
+        self.centers = points[:, :, self.center] if self.center is not None else None
+        self.center_offsets = disc_offsets(center_radius)
+        self.labels = labels
+        self.label_names = np.array(label_names) if label_names is not None else None
+
+    def __call__(self, i, frame):
+        for j in range(len(self.individuals)):
+            color = tuple(int(c) for c in self.colors[j])
+            segments = self.points[i, j][self.edges] # (n_edges, 2, 2)
+            segments = segments[(segments != MISSING).all(axis=(1, 2))]
+            if len(segments):
+                # All the bones of an individual in one call
+                cv2.polylines(frame, list(segments), False, color, 1, cv2.LINE_AA)
+        frame = super().__call__(i, frame)
+        if self.centers is not None:
+            draw_discs(frame, self.centers[i], self.colors, self.center_offsets)
+        if self.labels is not None:
+            for e, name in enumerate(self.label_names[self.labels[i]]):
+                cv2.putText(frame, name, (frame.shape[1] - 250, 30 + 25*e), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 0), 1, cv2.LINE_AA)
+        return frame
+
+
+def render_pose_video(output_path, draw, n_frames, background = None, size = FRAME_SIZE, frames = None, fps = 15.0, fourcc = 'MJPG', queue_size = 16, progress = None):
+    ''' Renders a video from the overlay alone, on a copy of the background (black if None), without decoding any video.
+        Drawing and encoding run in two threads (see run_pipeline). MJPG encodes each frame independently, which is
+        much faster than XVID and lighter on the CPU.
+
+        Args:
+            output_path (str): The path of the video.
+            draw (callable): draw(frame index, image) -> image.
+            n_frames (int): The number of frames.
+            background (np.ndarray): The background image (height, width, 3), optional.
+            size (tuple): The (width, height) of the video without background.
+            frames (tuple): The range of frames (start, stop) to render, all the frames if None.
+            fps (float): The frame rate of the video.
+            fourcc (str): The codec of the video.
+            queue_size (int): The number of frames buffered between two stages.
+            progress (callable): Called with 1 after each frame written (optional).
+
+        Returns:
+            n_frames (int): The number of frames written.'''
+    if background is None:
+        background = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+    height, width = background.shape[:2]
+    start, stop = (0, n_frames) if frames is None else frames
+    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+    n_written = 0
+
+    def write(image):
+        nonlocal n_written
+        writer.write(image)
+        n_written += 1
+        if progress is not None:
+            progress(1)
+
+    try:
+        run_pipeline(range(start, stop), lambda i: draw(i, background.copy()), write, queue_size)
+    finally:
+        writer.release()
+    return n_written
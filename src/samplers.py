@@ -0,0 +1,292 @@
+# Samplers used by the training engine (train.py) to build the batches of graphs
+import copy
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+
+
+def node_counts(dataset):
+    ''' Returns the number of nodes of each graph of the dataset.
+
+        Args:
+            dataset (list): The graphs (Data objects).
+
+        Returns:
+            num_nodes (np.ndarray): The number of nodes per graph.'''
+    return np.array([data.num_nodes for data in dataset], dtype=np.int64)
+
+
+class NodeBudgetBatchSampler(torch.utils.data.Sampler):
+    ''' Batch sampler that groups graphs with the same number of nodes and fills each batch up to a budget of nodes,
+        so the memory used by a batch is bounded whatever the window size of the graphs.
+        The batches are reshuffled at every epoch (see set_epoch), and sharded between processes in distributed training. '''
+
+    def __init__(self, num_nodes, max_nodes, shuffle = True, drop_last = False, seed = 0, num_replicas = 1, rank = 0, even_shards = True):
+        ''' Constructor of the NodeBudgetBatchSampler class.
+
+            Args:
+                num_nodes (array): The number of nodes of each graph (see node_counts).
+                max_nodes (int): The maximal number of nodes per batch. A graph larger than the budget is alone in its batch.
+                shuffle (bool): If True, the graphs and the batches are shuffled at every epoch.
+                drop_last (bool): If True, the last incomplete batch of each group of graphs is dropped.
+                seed (int): The seed of the shuffle, it must be the same in all the processes of a distributed training.
+                num_replicas (int): The number of processes of the distributed training, each one gets every num_replicas-th batch.
+                rank (int): The rank of the current process.
+                even_shards (bool): If True, the last batches are dropped so every process gets the same number of batches.
+                    If False (evaluation), every batch is in exactly one shard.'''
+        self.num_nodes = np.asarray(num_nodes)
+        self.max_nodes = max_nodes
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.even_shards = even_shards
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        ''' Sets the epoch, which seeds the shuffle of the next iteration. '''
+        self.epoch = epoch
+        self._batches = None
+
+    def build_batches(self):
+        ''' Builds the batches of the current epoch.
+
+            Returns:
+                batches (list): The indices of the graphs of each batch.'''
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = rng.permutation(len(self.num_nodes)) if self.shuffle else np.arange(len(self.num_nodes))
+        # Group the graphs by number of nodes, keeping the random order inside each group
+        order = order[np.argsort(self.num_nodes[order], kind='stable')]
+
+        batches = []
+        batch = []
+        batch_nodes = 0
+        graph_nodes = 0
+        for idx in order:
+            n = self.num_nodes[idx]
+            if batch and (n != graph_nodes or batch_nodes + n > self.max_nodes):
+                # The batch is full if another graph of the same size does not fit
+                if not self.drop_last or batch_nodes + graph_nodes > self.max_nodes:
+                    batches.append(batch)
+                batch, batch_nodes = [], 0
+            batch.append(int(idx))
+            batch_nodes += n
+            graph_nodes = n
+        if batch and (not self.drop_last or batch_nodes + graph_nodes > self.max_nodes):
+            batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        # Same number of batches in every process
+        n_batches = len(batches) // self.num_replicas * self.num_replicas if self.even_shards else len(batches)
+        return batches[self.rank:n_batches:self.num_replicas]
+
+    def __iter__(self):
+        if self._batches is None:
+            self._batches = self.build_batches()
+        batches, self._batches = self._batches, None
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        if self._batches is None:
+            self._batches = self.build_batches()
+        return len(self._batches)
+
+
+class LabelIndex:
+    ''' Index of the samples of a dataset by label: for each behaviour, the indices of the samples where it is active
+        (label 1) and inactive (label 0). It is built once, the samplers then never read the graphs. '''
+
+    def __init__(self, labels):
+        ''' Constructor of the LabelIndex class.
+
+            Args:
+                labels (array): The labels of the samples (n_samples, n_behaviours).'''
+        labels = np.asarray(labels)
+        self.n_samples = labels.shape[0]
+        self.positive = [np.flatnonzero(labels[:, b] == 1) for b in range(labels.shape[1])]
+        self.negative = [np.flatnonzero(labels[:, b] == 0) for b in range(labels.shape[1])]
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        ''' Builds the index of a list of graphs (data.behaviour) or of an augmentation.AugmentedDataset (its labels tensor). '''
+        if hasattr(dataset, 'labels'):
+            labels = dataset.labels
+        else:
+            labels = torch.stack([data.behaviour.view(-1).cpu() for data in dataset])
+        return cls(labels.cpu().numpy())
+
+    def positives(self, behaviour):
+        return self.positive[behaviour]
+
+    def negatives(self, behaviour):
+        return self.negative[behaviour]
+
+
+class BalancedBehaviourSampler(torch.utils.data.Sampler):
+    ''' Sampler drawing as many active as inactive samples of a behaviour at every epoch, from a LabelIndex.
+        By default the majority class is downsampled to the size of the minority class (as downsample_majority_class),
+        with num_samples the classes are sampled with replacement if needed (as a WeightedRandomSampler with class weights).
+        The dataset is never copied and each epoch draws a new subset. '''
+
+    def __init__(self, label_index, behaviour, num_samples = None, seed = 0, num_replicas = 1, rank = 0):
+        ''' Constructor of the BalancedBehaviourSampler class.
+
+            Args:
+                label_index (LabelIndex): The index of the dataset.
+                behaviour (int): The index of the behaviour to balance.
+                num_samples (int): The number of samples per epoch (default: twice the size of the minority class).
+                seed (int): The seed of the sampling, it must be the same in all the processes of a distributed training.
+                num_replicas (int): The number of processes of the distributed training, each one gets a shard of the samples.
+                rank (int): The rank of the current process.'''
+        self.positive = label_index.positives(behaviour)
+        self.negative = label_index.negatives(behaviour)
+        if len(self.positive) == 0 or len(self.negative) == 0:
+            raise ValueError(f'The behaviour {behaviour} has {len(self.positive)} active and {len(self.negative)} inactive samples, it cannot be balanced')
+        self.per_class = num_samples // 2 if num_samples is not None else min(len(self.positive), len(self.negative))
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        ''' Sets the epoch, which seeds the sampling of the next iteration. '''
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        positive = rng.choice(self.positive, self.per_class, replace=self.per_class > len(self.positive))
+        negative = rng.choice(self.negative, self.per_class, replace=self.per_class > len(self.negative))
+        indices = rng.permutation(np.concatenate((positive, negative)))
+        self.epoch += 1
+        return iter(indices[self.rank:len(self) * self.num_replicas:self.num_replicas].tolist())
+
+    def __len__(self):
+        return 2 * self.per_class // self.num_replicas
+
+
+class IndexedDataset(torch.utils.data.Dataset):
+    ''' Wraps a dataset so that each graph carries its position in the dataset (data.sample_idx, batch.sample_idx once
+        collated), used to record the loss of each sample in a LossTracker. The graphs are not copied. '''
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, i):
+        data = copy.copy(self.dataset[i]) # shallow copy, the tensors are shared
+        data.sample_idx = i
+        return data
+
+
+def sample_losses(outputs, labels):
+    ''' Returns the cross-entropy of each sample (averaged over the behaviours of a multi-task model). '''
+    n_classes = outputs.size(-1)
+    losses = F.cross_entropy(outputs.reshape(-1, n_classes), labels.reshape(-1), reduction='none')
+    return losses.view(labels.size(0), -1).mean(dim=1)
+
+
+class LossTracker:
+    ''' Last training loss of each sample of the dataset, in one float32 array indexed by the position of the sample
+        (NaN for the samples not seen yet). The losses of the current epoch stay on the device of the training,
+        they are copied to the host once per epoch (synchronize). '''
+
+    def __init__(self, n_samples, device = None):
+        self.losses = torch.full((n_samples,), float('nan'))
+        # Losses of the current epoch, -1 where not updated
+        self._updates = torch.full((n_samples,), -1.0, device=device)
+
+    def update(self, sample_idx, losses):
+        ''' Records the losses of a batch.
+
+            Args:
+                sample_idx (torch.Tensor): The positions of the samples in the dataset (batch.sample_idx).
+                losses (torch.Tensor): The loss of each sample (see sample_losses).'''
+        self._updates.index_copy_(0, sample_idx.to(self._updates.device), losses.detach().float())
+
+    def synchronize(self):
+        ''' Merges the losses of the epoch in the array, gathering the updates of all the processes in distributed training.
+            Called at the end of each epoch. '''
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self._updates, op=dist.ReduceOp.MAX)
+        updates = self._updates.cpu()
+        updated = updates >= 0
+        self.losses[updated] = updates[updated]
+        self._updates.fill_(-1.0)
+
+
+class HardNegativeSampler(torch.utils.data.Sampler):
+    ''' Sampler drawing as many active as inactive samples of a behaviour at every epoch (as BalancedBehaviourSampler),
+        where a fraction of the inactive samples is drawn with a probability proportional to their last loss in a LossTracker,
+        so the hard negatives are seen more often than the easy ones. The probabilities are only recomputed every refresh_every epochs.
+        The negatives not seen yet get the highest loss, so they are explored first. '''
+
+    def __init__(self, label_index, behaviour, loss_tracker, num_samples = None, hard_fraction = 0.5, refresh_every = 1,
+                 warmup_epochs = 1, seed = 0, num_replicas = 1, rank = 0):
+        ''' Constructor of the HardNegativeSampler class.
+
+            Args:
+                label_index (LabelIndex): The index of the dataset.
+                behaviour (int): The index of the behaviour.
+                loss_tracker (LossTracker): The losses of the samples, updated by the training loop.
+                num_samples (int): The number of samples per epoch (default: twice the size of the minority class).
+                hard_fraction (float): The fraction of the negatives drawn according to their loss, the others are drawn uniformly.
+                refresh_every (int): The number of epochs between two updates of the sampling probabilities.
+                warmup_epochs (int): The number of epochs with uniform negatives, before the losses are meaningful.
+                seed (int): The seed of the sampling, it must be the same in all the processes of a distributed training.
+                num_replicas (int): The number of processes of the distributed training, each one gets a shard of the samples.
+                rank (int): The rank of the current process.'''
+        self.positive = label_index.positives(behaviour)
+        self.negative = label_index.negatives(behaviour)
+        if len(self.positive) == 0 or len(self.negative) == 0:
+            raise ValueError(f'The behaviour {behaviour} has {len(self.positive)} active and {len(self.negative)} inactive samples, it cannot be balanced')
+        self.loss_tracker = loss_tracker
+        self.per_class = num_samples // 2 if num_samples is not None else min(len(self.positive), len(self.negative))
+        self.hard_fraction = hard_fraction
+        self.refresh_every = refresh_every
+        self.warmup_epochs = warmup_epochs
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._probabilities = None
+        self._refreshed_at = None
+
+    def set_epoch(self, epoch):
+        ''' Sets the epoch, which seeds the sampling of the next iteration. '''
+        self.epoch = epoch
+
+    def refresh(self):
+        ''' Recomputes the sampling probabilities of the negatives from the losses of the tracker. '''
+        losses = self.loss_tracker.losses.numpy()[self.negative].astype(np.float64)
+        seen = ~np.isnan(losses)
+        losses[~seen] = losses[seen].max() if seen.any() else 1.0
+        losses += 1e-6
+        self._probabilities = losses / losses.sum()
+        self._refreshed_at = self.epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        positive = rng.choice(self.positive, self.per_class, replace=self.per_class > len(self.positive))
+
+        n_hard = int(self.hard_fraction * self.per_class) if self.epoch >= self.warmup_epochs else 0
+        n_uniform = self.per_class - n_hard
+        negative = [rng.choice(self.negative, n_uniform, replace=n_uniform > len(self.negative))]
+        if n_hard > 0:
+            if self._refreshed_at is None or self.epoch - self._refreshed_at >= self.refresh_every:
+                self.refresh()
+            negative.append(rng.choice(self.negative, n_hard, replace=True, p=self._probabilities))
+
+        indices = rng.permutation(np.concatenate([positive] + negative))
+        self.epoch += 1
+        return iter(indices[self.rank:len(self) * self.num_replicas:self.num_replicas].tolist())
+
+    def __len__(self):
+        return 2 * self.per_class // self.num_replicas
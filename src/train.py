@@ -0,0 +1,518 @@
+# Training engine for the GAT behaviour classifiers
+# Example: python train.py --dataset dataset_large.pkl --behaviour 2 --output-dir Checkpoints/Sniffing_R
+# All the behaviours in one model: python train.py --dataset dataset_large.pkl --multitask --output-dir Checkpoints/MultiTask
+# Data-parallel on 4 local processes: add --nprocs 4 (or launch with torchrun --nproc_per_node 4 for several nodes)
+import argparse
+import contextlib
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from torch_geometric.data import DataLoader
+# PyTorch TensorBoard support
+from torch.utils.tensorboard import SummaryWriter
+
+import augmentation
+import samplers
+from models import build_model
+from checkpoints import CheckpointManager, EarlyStopping, export_inference_checkpoint, latest_checkpoint, load_checkpoint
+
+
+def split_dataset(dataset, train_fraction = 0.8, seed = 0):
+    ''' Shuffles the dataset and splits it in a train and a test dataset (the graphs are not copied).
+
+        Args:
+            dataset (list): The graphs.
+            train_fraction (float): The fraction of graphs in the train dataset.
+            seed (int): The seed of the shuffle.
+
+        Returns:
+            train_dataset (list), test_dataset (list): The two datasets.'''
+    indices = np.random.RandomState(seed).permutation(len(dataset))
+    train_size = int(train_fraction * len(dataset))
+    return [dataset[i] for i in indices[:train_size]], [dataset[i] for i in indices[train_size:]]
+
+
+def make_loader(dataset, batch_size, shuffle, num_workers = 0, prefetch_factor = 2, pin_memory = False, max_nodes = None, seed = 0,
+                num_replicas = 1, rank = 0, collate_fn = None, sampler = None, even_shards = True):
+    ''' Builds a torch_geometric DataLoader, with worker processes that prefetch the batches if num_workers > 0.
+
+        Args:
+            dataset (list): The graphs.
+            batch_size (int): The number of graphs per batch (ignored if max_nodes is given).
+            shuffle (bool): If True, the graphs are shuffled at every epoch.
+            num_workers (int): The number of worker processes collating the batches.
+            prefetch_factor (int): The number of batches prefetched by each worker.
+            pin_memory (bool): If True, the batches are copied to pinned memory (faster transfers to the GPU).
+            max_nodes (int): If given, the batches are built by samplers.NodeBudgetBatchSampler with this budget of nodes per batch.
+            seed (int): The seed of the samplers.
+            num_replicas (int): The number of processes of the distributed training, each one gets a shard of the dataset.
+            rank (int): The rank of the current process.
+            collate_fn (callable): If given, replaces the collate of torch_geometric (e.g. augmentation.collate).
+            sampler (Sampler): If given, the sampler of the graphs (e.g. samplers.BalancedBehaviourSampler, already sharded).
+            even_shards (bool): If True, every process gets the same number of batches (DistributedSampler pads the shards
+                with repeated graphs). If False (evaluation), every graph is in exactly one shard, the shards can be uneven.
+
+        Returns:
+            loader (DataLoader): The loader.'''
+    kwargs = {}
+    if num_workers > 0:
+        kwargs = {'prefetch_factor': prefetch_factor, 'persistent_workers': True}
+    loader_class = DataLoader
+    if collate_fn is not None:
+        # The DataLoader of torch_geometric always uses its own collate
+        loader_class = torch.utils.data.DataLoader
+        kwargs['collate_fn'] = collate_fn
+    if sampler is not None:
+        return loader_class(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers, pin_memory=pin_memory, **kwargs)
+    if max_nodes is not None:
+        batch_sampler = samplers.NodeBudgetBatchSampler(samplers.node_counts(dataset), max_nodes, shuffle=shuffle, seed=seed,
+                                                        num_replicas=num_replicas, rank=rank, even_shards=even_shards)
+        return loader_class(dataset, batch_sampler=batch_sampler, num_workers=num_workers, pin_memory=pin_memory, **kwargs)
+    if num_replicas > 1:
+        if even_shards:
+            sampler = DistributedSampler(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        else:
+            sampler = range(rank, len(dataset), num_replicas)
+        return loader_class(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers, pin_memory=pin_memory, **kwargs)
+    return loader_class(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, pin_memory=pin_memory, **kwargs)
+
+
+def select_labels(batch, behaviour):
+    ''' Returns the labels of the behaviour for each graph of the batch.
+
+        Args:
+            batch (Batch): The batch of graphs, with the full behaviour vector of each graph.
+            behaviour (int or list): The index of the behaviour, or the indices of the behaviours of a multi-task model.
+                If None, batch.behaviour already holds one label per graph.
+
+        Returns:
+            labels (torch.Tensor): The labels (n_graphs,), or (n_graphs, n_tasks) for a list of behaviours.'''
+    if behaviour is None:
+        return batch.behaviour
+    return batch.behaviour.view(batch.num_graphs, -1)[:, behaviour]
+
+
+class MultiTaskLoss(nn.Module):
+    ''' Weighted average of the cross-entropy losses of the behaviours of a MultiTaskGraphClassifier. '''
+
+    def __init__(self, weights):
+        ''' Constructor of the MultiTaskLoss class.
+
+            Args:
+                weights (list): The weight of each behaviour in the loss.'''
+        super(MultiTaskLoss, self).__init__()
+        weights = torch.as_tensor(weights, dtype=torch.float)
+        self.register_buffer('weights', weights / weights.sum())
+
+    def forward(self, outputs, labels):
+        ''' outputs (n_graphs, n_tasks, n_classes), labels (n_graphs, n_tasks) '''
+        losses = nn.functional.cross_entropy(outputs.transpose(1, 2), labels, reduction='none').mean(dim=0)
+        return (losses * self.weights).sum()
+
+
+def count_correct(outputs, labels):
+    ''' Returns the number of correct predictions, per behaviour for a multi-task model. '''
+    return (outputs.argmax(dim=-1) == labels).sum(dim=0)
+
+
+def reduce_metrics(loss_sum, correct, total, device):
+    ''' Sums the metrics over the processes and returns the average loss, the number of samples
+        and the accuracy (the mean accuracy of the behaviours and the accuracy of each one for a multi-task model). '''
+    correct = torch.as_tensor(correct, device=device).reshape(-1).to(loss_sum.dtype)
+    sums = reduce_sums(torch.cat([loss_sum.view(1), torch.tensor([float(total)], device=device), correct])).tolist()
+    loss_sum, total, correct = sums[0], sums[1], sums[2:]
+    metrics = {'loss': loss_sum / max(total, 1), 'accuracy': sum(correct) / len(correct) / max(total, 1), 'samples': int(total)}
+    if len(correct) > 1:
+        metrics['task_accuracy'] = [c / max(total, 1) for c in correct]
+    return metrics
+
+
+def set_epoch(loader, epoch):
+    ''' Sets the epoch of the samplers of the loader that reshuffle per epoch (DistributedSampler, NodeBudgetBatchSampler). '''
+    for sampler in (loader.sampler, loader.batch_sampler):
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+
+
+def reduce_sums(sums):
+    ''' Sums a tensor of metrics over the processes of the distributed training (no-op otherwise). '''
+    if dist.is_available() and dist.is_initialized():
+        dist.all_reduce(sums, op=dist.ReduceOp.SUM)
+    return sums
+
+
+def is_main_process():
+    ''' Returns whether the current process is the one that logs and saves the checkpoints (rank 0). '''
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+
+def train_one_epoch(model, loader, optimizer, criterion, behaviour, device, accumulation_steps = 1, loss_tracker = None):
+    ''' Trains the model for one epoch. The metrics are accumulated on the device and only read back at
+        the end of the epoch, so there is no host synchronization per step.
+        With accumulation_steps > 1, the gradients of several batches are accumulated before each optimizer step,
+        so the effective batch size is accumulation_steps times the size of the batches.
+        With a loss_tracker (samplers.LossTracker), the loss of each sample is recorded at the position batch.sample_idx
+        (see samplers.IndexedDataset) for the HardNegativeSampler.
+
+        Returns:
+            metrics (dict): The average loss, the accuracy, the number of samples and the samples per second (over all the processes),
+                and the accuracy of each behaviour (task_accuracy) for a multi-task model.'''
+    model.train()
+    train_loss = torch.zeros((), device=device)
+    correct = 0
+    total = 0
+    n_batches = len(loader)
+    start = time.perf_counter()
+
+    optimizer.zero_grad(set_to_none=True)
+    for step, data in enumerate(loader):
+        data = data.to(device, non_blocking=True)
+        labels = select_labels(data, behaviour)
+
+        do_step = (step + 1) % accumulation_steps == 0 or step + 1 == n_batches
+        # The last group of the epoch can have fewer batches, its gradient is the mean over the batches it has
+        group_size = min(accumulation_steps, n_batches - step + step % accumulation_steps)
+        # With DistributedDataParallel, the gradients are only all-reduced on the steps of the optimizer
+        sync = model.no_sync() if isinstance(model, DistributedDataParallel) and not do_step else contextlib.nullcontext()
+        with sync:
+            outputs = model(data)
+            loss = criterion(outputs, labels)
+            (loss / group_size).backward()
+        if do_step:
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        train_loss += loss.detach() * labels.size(0)
+        correct = correct + count_correct(outputs.detach(), labels)
+        total += labels.size(0)
+        if loss_tracker is not None:
+            loss_tracker.update(data.sample_idx, samplers.sample_losses(outputs.detach(), labels))
+
+    if loss_tracker is not None:
+        loss_tracker.synchronize()
+    metrics = reduce_metrics(train_loss, correct, total, device)
+    metrics['samples_per_second'] = metrics['samples'] / (time.perf_counter() - start)
+    return metrics
+
+
+def evaluate(model, loader, criterion, behaviour, device):
+    ''' Evaluates the model on the loader. The shards of the processes can have different numbers of batches, so the
+        model runs without its DistributedDataParallel wrapper (no collective per batch), the sums are reduced at the end.
+
+        Returns:
+            metrics (dict): The average loss and the accuracy (over all the processes), and task_accuracy for a multi-task model.'''
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    model.eval()
+    val_loss = torch.zeros((), device=device)
+    correct = 0
+    total = 0
+    with torch.no_grad():
+        for val_data in loader:
+            val_data = val_data.to(device, non_blocking=True)
+            val_labels = select_labels(val_data, behaviour)
+            val_outputs = model(val_data)
+            val_loss += criterion(val_outputs, val_labels) * val_labels.size(0)
+            correct = correct + count_correct(val_outputs, val_labels)
+            total += val_labels.size(0)
+    return reduce_metrics(val_loss, correct, total, device)
+
+
+def train(dataset, behaviour, output_dir, model_config = None, num_epochs = 200, lr = 0.001, batch_size = 32,
+          num_workers = 0, prefetch_factor = 2, pin_memory = None, train_fraction = 0.8, seed = 0,
+          checkpoint_every = 5, resume = None, log_dir = None, device = None, accumulation_steps = 1, max_nodes = None,
+          task_weights = None, monitor = 'loss', keep_top_k = 3, patience = None, min_delta = 0.0, merge_symmetric = None,
+          transform = None, balance = False, hard_negatives = None):
+    ''' Trains a GraphClassifier on one behaviour of the dataset, or a MultiTaskGraphClassifier on several behaviours
+        (one shared encoder, one head per behaviour, trained jointly on the weighted sum of their losses).
+        If the default process group is initialized (see main), the model is wrapped in DistributedDataParallel,
+        each process trains on a shard of the dataset and only the process of rank 0 logs and saves the checkpoints.
+
+        Args:
+            dataset (list): The graphs, each with the full behaviour vector in data.behaviour.
+            behaviour (int or list): The index of the behaviour to classify, or the indices of the behaviours of a multi-task model.
+            output_dir (str): The directory where the checkpoints are saved.
+            model_config (dict): The arguments of build_model.
+            num_epochs (int): The total number of epochs (including the epochs of the resumed checkpoint).
+            lr (float): The learning rate.
+            batch_size (int): The number of graphs per batch.
+            num_workers (int): The number of worker processes of the data loaders.
+            prefetch_factor (int): The number of batches prefetched by each worker.
+            pin_memory (bool): If True, the batches are pinned. If None, only when training on GPU.
+            train_fraction (float): The fraction of the dataset used for training.
+            seed (int): The seed of the train/test split.
+            checkpoint_every (int): The number of epochs between the checkpoints saved for resuming (the epochs entering
+                the top-k of the monitored metric are always saved).
+            resume (str): A checkpoint to resume from, or 'latest' for the last checkpoint in output_dir.
+            log_dir (str): The TensorBoard directory (if None, output_dir/runs).
+            device (torch.device): The device on which to train.
+            accumulation_steps (int): The number of batches whose gradients are accumulated before each optimizer step.
+            max_nodes (int): If given, the batches are built with a budget of nodes instead of a fixed number of graphs.
+            task_weights (list): The weight of each behaviour in the loss of a multi-task model (default: equal weights).
+            monitor (str): The validation metric that ranks the checkpoints and drives the early stopping, 'loss' or 'accuracy'.
+            keep_top_k (int): The number of best checkpoints kept in output_dir, besides the latest one.
+            patience (int): If given, the training stops after patience epochs without improvement of the monitored metric.
+            min_delta (float): The minimal change of the monitored metric counted as an improvement.
+            merge_symmetric (tuple): If given, the indices (behaviour1, behaviour2) of two symetric behaviours merged in the train dataset
+                (augmentation.merge_symmetric, the swapped samples are views of the graphs, swapped when collated).
+            transform (callable): If given, a random transform of the train batches (e.g. augmentation.RandomBatchTransform),
+                applied by the collate of the train loader.
+            balance (bool): If True, each epoch draws as many active as inactive train samples of the behaviour
+                (samplers.BalancedBehaviourSampler), instead of downsampling the dataset beforehand.
+            hard_negatives (dict): If given, the train samples are balanced by samplers.HardNegativeSampler, which draws the
+                negatives with high training loss more often. The dict holds its options (hard_fraction, refresh_every, warmup_epochs).
+
+        At the end, the best checkpoint is exported without the optimizer state to output_dir/best_inference.pth.
+
+        Returns:
+            model (GraphClassifier): The trained model (the weights of the last epoch).'''
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if pin_memory is None:
+        pin_memory = device.type == 'cuda'
+    distributed = dist.is_available() and dist.is_initialized()
+    rank = dist.get_rank() if distributed else 0
+    world_size = dist.get_world_size() if distributed else 1
+    main_process = rank == 0
+    os.makedirs(output_dir, exist_ok=True)
+
+    train_dataset, test_dataset = split_dataset(dataset, train_fraction, seed)
+    train_collate = None
+    if merge_symmetric is not None:
+        train_dataset = augmentation.merge_symmetric(train_dataset, *merge_symmetric, new_samples_only=True)
+    if merge_symmetric is not None or transform is not None:
+        train_collate = augmentation.BatchCollater(transform)
+    if main_process:
+        print('The train dataset has %d samples' % len(train_dataset))
+        print('The test dataset has %d samples' % len(test_dataset))
+        if distributed:
+            print(f'Distributed training on {world_size} processes')
+
+    train_sampler = None
+    loss_tracker = None
+    if balance or hard_negatives is not None:
+        if isinstance(behaviour, (list, tuple)) or max_nodes is not None:
+            raise ValueError('balance and hard_negatives need a single behaviour and a fixed batch size')
+        label_index = samplers.LabelIndex.from_dataset(train_dataset)
+        if hard_negatives is not None:
+            loss_tracker = samplers.LossTracker(len(train_dataset), device)
+            train_sampler = samplers.HardNegativeSampler(label_index, behaviour, loss_tracker, seed=seed,
+                                                         num_replicas=world_size, rank=rank, **hard_negatives)
+            train_dataset = samplers.IndexedDataset(train_dataset)
+        else:
+            train_sampler = samplers.BalancedBehaviourSampler(label_index, behaviour, seed=seed, num_replicas=world_size, rank=rank)
+    train_loader = make_loader(train_dataset, batch_size, True, num_workers, prefetch_factor, pin_memory, max_nodes, seed, world_size, rank,
+                               train_collate, train_sampler)
+    # Unpadded shards: a graph repeated to even out the shards would be scored twice in the validation metrics
+    test_loader = make_loader(test_dataset, batch_size, False, num_workers, prefetch_factor, pin_memory, max_nodes, seed, world_size, rank,
+                              even_shards=False)
+
+    multitask = isinstance(behaviour, (list, tuple))
+    # Stored in the checkpoints, to rebuild the model at inference (analyze.load_multitask_model)
+    extra = {'model_config': dict(model_config or {})}
+    if multitask:
+        behaviour = list(behaviour)
+        model = build_model(**dict(model_config or {}, n_tasks=len(behaviour)))
+        criterion = MultiTaskLoss(task_weights if task_weights is not None else [1.0] * len(behaviour)).to(device)
+        names = getattr(dataset[0], 'behaviour_names', None)
+        task_names = [str(names[b]) for b in behaviour] if names is not None else [str(b) for b in behaviour]
+        # Stored in the checkpoints, to know which head is which behaviour at inference
+        extra.update({'behaviours': behaviour, 'behaviour_names': task_names})
+    else:
+        model = build_model(**(model_config or {}))
+        criterion = nn.CrossEntropyLoss()
+    model.to(device)
+    if main_process:
+        print('The model has %d trainable parameters' % sum(p.numel() for p in model.parameters() if p.requires_grad))
+
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+
+    mode = 'min' if monitor == 'loss' else 'max'
+    early_stopping = EarlyStopping(patience, mode, min_delta) if patience is not None else None
+    manager = CheckpointManager(output_dir, monitor, mode, keep_top_k) if main_process else None
+
+    start_epoch = 0
+    if resume == 'latest':
+        resume = latest_checkpoint(output_dir)
+    if resume is not None:
+        start_epoch = load_checkpoint(resume, model, optimizer, device, early_stopping)
+
+    if distributed:
+        model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+
+    writer = SummaryWriter(log_dir=log_dir or os.path.join(output_dir, 'runs')) if main_process else None  # TensorBoard writer
+
+    start_time = time.time()  # Time the training
+    train_metrics = {'loss': None}
+    last_epoch = start_epoch
+    for epoch in range(start_epoch, num_epochs):
+        last_epoch = epoch + 1
+        set_epoch(train_loader, epoch)
+        train_metrics = train_one_epoch(model, train_loader, optimizer, criterion, behaviour, device, accumulation_steps, loss_tracker)
+        val_metrics = evaluate(model, test_loader, criterion, behaviour, device)
+
+        # The validation metrics are the same in all the processes, so they all stop at the same epoch
+        stop = early_stopping is not None and early_stopping.step(val_metrics[monitor])
+
+        if main_process:
+            print(f"Epoch {epoch + 1}, Training Loss: {train_metrics['loss']:.4f}, Training Accuracy: {train_metrics['accuracy']:.4f}, "
+                  f"Validation Loss: {val_metrics['loss']:.4f}, Validation Accuracy: {val_metrics['accuracy']:.4f}, "
+                  f"{train_metrics['samples_per_second']:.1f} samples/s")
+
+            writer.add_scalar('Loss/Train', train_metrics['loss'], epoch)
+            writer.add_scalar('Accuracy/Train', train_metrics['accuracy'], epoch)
+            writer.add_scalar('Loss/Validation', val_metrics['loss'], epoch)
+            writer.add_scalar('Accuracy/Validation', val_metrics['accuracy'], epoch)
+            writer.add_scalar('Throughput/Train (samples per second)', train_metrics['samples_per_second'], epoch)
+            writer.add_scalar('Learning Rate', optimizer.param_groups[0]['lr'], epoch)
+            if multitask:
+                for name, train_accuracy, val_accuracy in zip(task_names, train_metrics['task_accuracy'], val_metrics['task_accuracy']):
+                    writer.add_scalar(f'Accuracy/Train/{name}', train_accuracy, epoch)
+                    writer.add_scalar(f'Accuracy/Validation/{name}', val_accuracy, epoch)
+
+            # Save checkpoint when the epoch enters the top-k (so the best epoch is always saved), and for resuming
+            # after each checkpoint_every epochs, after the last one and when stopping early
+            periodic = (epoch + 1) % checkpoint_every == 0 or epoch + 1 == num_epochs or stop
+            if periodic or manager.is_top_k(val_metrics[monitor]):
+                checkpoint_extra = dict(extra or {})
+                if early_stopping is not None:
+                    checkpoint_extra['early_stopping'] = early_stopping.state_dict()
+                manager.save(model, optimizer, epoch + 1, train_metrics['loss'], val_metrics, checkpoint_extra)
+
+        if stop:
+            if main_process:
+                print(f"No improvement of the validation {monitor} for {patience} epochs, stopping at epoch {epoch + 1}")
+            break
+
+    if main_process:
+        # Time the training
+        print(f"Training took {time.time() - start_time} seconds, for {last_epoch - start_epoch} epochs")
+        if manager.best() is not None:
+            export_inference_checkpoint(manager.best(), os.path.join(output_dir, 'best_inference.pth'))
+        # Close the TensorBoard writer
+        writer.close()
+
+    return model.module if distributed else model
+
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description='Train a GAT classifier on one or several behaviours of a graph dataset.')
+    parser.add_argument('--dataset', required=True, help='Path to the .pkl dataset (list of Data built by DLCDataLoader)')
+    parser.add_argument('--behaviour', type=int, nargs='+', default=None,
+                        help='Index of the behaviour in data.behaviour (several indices train a multi-task model)')
+    parser.add_argument('--multitask', action='store_true', help='Train one multi-task model on all the behaviours of the dataset')
+    parser.add_argument('--task-weights', type=float, nargs='+', default=None, help='Weight of each behaviour in the multi-task loss')
+    parser.add_argument('--output-dir', required=True, help='Directory of the checkpoints')
+    parser.add_argument('--log-dir', default=None, help='TensorBoard directory (default: <output-dir>/runs)')
+    parser.add_argument('--resume', default=None, help="Checkpoint to resume from, or 'latest'")
+    # Model configuration
+    parser.add_argument('--nout', type=int, default=64)
+    parser.add_argument('--nhid', type=int, default=32)
+    parser.add_argument('--attention-heads', type=int, default=2)
+    parser.add_argument('--n-layers', type=int, default=4)
+    parser.add_argument('--dropout', type=float, default=0.2)
+    parser.add_argument('--readout', default='mean', choices=['mean', 'max', 'concatenate'])
+    # Optimization
+    parser.add_argument('--epochs', type=int, default=200)
+    parser.add_argument('--lr', type=float, default=0.001)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--accumulation-steps', type=int, default=1, help='Batches accumulated per optimizer step')
+    parser.add_argument('--max-nodes', type=int, default=None, help='Budget of nodes per batch (replaces --batch-size)')
+    parser.add_argument('--train-fraction', type=float, default=0.8)
+    parser.add_argument('--merge-symmetric', type=int, nargs=2, default=None, metavar=('BEHAVIOUR1', 'BEHAVIOUR2'),
+                        help='Add the samples of BEHAVIOUR2 with swapped identities as samples of BEHAVIOUR1 to the train dataset')
+    parser.add_argument('--balance', action='store_true', help='Draw as many active as inactive train samples at every epoch')
+    parser.add_argument('--hard-negatives', action='store_true', help='Balance the train samples and oversample the negatives with high loss')
+    parser.add_argument('--hard-fraction', type=float, default=0.5, help='Fraction of the negatives drawn according to their loss')
+    parser.add_argument('--refresh-every', type=int, default=1, help='Epochs between two updates of the hard negative probabilities')
+    parser.add_argument('--warmup-epochs', type=int, default=1, help='Epochs with uniform negatives before the hard negatives are drawn')
+    # Random augmentation of the train batches
+    parser.add_argument('--flip-prob', type=float, default=0.0, help='Probability of each of the x flip, y flip and transposition')
+    parser.add_argument('--swap-prob', type=float, default=0.0, help='Probability of swapping the identities of the individuals')
+    parser.add_argument('--swap-pairs', type=int, nargs='+', default=None,
+                        help='Indices of the resident/visitor behaviours exchanged by the swap: R1 V1 R2 V2 ...')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--checkpoint-every', type=int, default=5)
+    parser.add_argument('--monitor', default='loss', choices=['loss', 'accuracy'], help='Validation metric ranking the checkpoints')
+    parser.add_argument('--keep-top-k', type=int, default=3, help='Number of best checkpoints kept besides the latest one')
+    parser.add_argument('--patience', type=int, default=None, help='Stop after this number of epochs without improvement')
+    parser.add_argument('--min-delta', type=float, default=0.0, help='Minimal improvement of the monitored metric')
+    # Data loading
+    parser.add_argument('--num-workers', type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument('--prefetch-factor', type=int, default=2)
+    parser.add_argument('--pin-memory', action=argparse.BooleanOptionalAction, default=None)
+    parser.add_argument('--device', default=None, help="'cpu' or 'cuda' (default: cuda if available)")
+    # Distributed training
+    parser.add_argument('--nprocs', type=int, default=1, help='Number of local processes of the data-parallel training')
+    parser.add_argument('--backend', default='gloo', help='Backend of torch.distributed')
+    args = parser.parse_args(argv)
+    if args.behaviour is None and not args.multitask:
+        parser.error('one of --behaviour or --multitask is required')
+    return args
+
+
+def run(args):
+    ''' Loads the dataset and trains the model with the parsed command line arguments. '''
+    device = torch.device(args.device) if args.device else None
+    dataset = torch.load(args.dataset)
+    if args.multitask and args.behaviour is None:
+        behaviour = list(range(dataset[0].behaviour.numel()))
+    elif args.multitask or len(args.behaviour) > 1:
+        behaviour = args.behaviour
+    else:
+        behaviour = args.behaviour[0]
+    transform = None
+    if args.flip_prob > 0 or args.swap_prob > 0:
+        swap_pairs = list(zip(args.swap_pairs[::2], args.swap_pairs[1::2])) if args.swap_pairs else None
+        transform = augmentation.RandomBatchTransform(args.flip_prob, args.flip_prob, args.flip_prob, args.swap_prob, swap_pairs)
+    model_config = {'nout': args.nout, 'nhid': args.nhid, 'attention_heads': args.attention_heads,
+                    'n_layers': args.n_layers, 'dropout': args.dropout, 'readout': args.readout}
+    train(dataset, behaviour, args.output_dir, model_config=model_config, num_epochs=args.epochs, lr=args.lr,
+          batch_size=args.batch_size, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor,
+          pin_memory=args.pin_memory, train_fraction=args.train_fraction, seed=args.seed,
+          checkpoint_every=args.checkpoint_every, resume=args.resume, log_dir=args.log_dir, device=device,
+          accumulation_steps=args.accumulation_steps, max_nodes=args.max_nodes, task_weights=args.task_weights,
+          merge_symmetric=args.merge_symmetric, transform=transform, balance=args.balance,
+          hard_negatives={'hard_fraction': args.hard_fraction, 'refresh_every': args.refresh_every,
+                          'warmup_epochs': args.warmup_epochs} if args.hard_negatives else None,
+          monitor=args.monitor, keep_top_k=args.keep_top_k, patience=args.patience, min_delta=args.min_delta)
+
+
+def distributed_worker(rank, args):
+    ''' Entry point of each local process spawned by main when --nprocs > 1. '''
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    dist.init_process_group(args.backend, rank=rank, world_size=args.nprocs)
+    # Share the cores between the processes
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.nprocs))
+    try:
+        run(args)
+    finally:
+        dist.destroy_process_group()
+
+
+def main(argv = None):
+    args = parse_args(argv)
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        # Launched by torchrun (possibly on several nodes), the rendezvous is given by the environment
+        dist.init_process_group(args.backend)
+        try:
+            run(args)
+        finally:
+            dist.destroy_process_group()
+    elif args.nprocs > 1:
+        mp.spawn(distributed_worker, args=(args,), nprocs=args.nprocs)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
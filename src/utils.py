@@ -1,10 +1,13 @@
 import os
-import cv2
+import copy
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import models
 import torch
 import dataloader
+import augmentation
+import video_index
 import matplotlib.pyplot as plt
 
 def from_time_to_frame(time, fps):
@@ -15,17 +18,43 @@ def from_time_to_frame(time, fps):
 def from_time_to_frame_s(time, fps):
     return int(time*fps)
 
+def from_times_to_frames(times, fps):
+    ''' Vectorized from_time_to_frame: converts a column of times 'hh:mm:ss.ms' to frame indices.
+
+        times: pd.Series of str, the times
+        fps: float, the frame rate of the video
+    '''
+    parts = times.astype(str).str.split(r'[:.]', expand=True).iloc[:, :4].astype(np.int64).to_numpy()
+    frames = parts[:, 0]*3600*fps + parts[:, 1]*60*fps + parts[:, 2]*fps + (parts[:, 3]/1000)*fps
+    return frames.astype(np.int64)
+
+def intervals_to_frames(starts, values, num_frames):
+    ''' Builds the per frame values of a report where each row holds from its starting frame to the starting frame of the next row
+        (the last one to the end of the video). The frames before the first row are 0. The starting frames are sorted.
+
+        starts: np.ndarray, the starting frame of each row
+        values: np.ndarray, the value of each row
+        num_frames: int, the number of frames of the video
+    '''
+    out = np.zeros(num_frames)
+    if len(starts) == 0:
+        return out
+    starts = np.clip(starts, 0, num_frames)
+    ends = np.append(starts[1:], num_frames)
+    lengths = np.maximum(ends - starts, 0)
+    out[starts[0]:starts[0] + lengths.sum()] = np.repeat(values, lengths)
+    return out
+
 def get_video_info(path):
-    ''' Return the number of frames and the frame rate of the video in the path'''
+    ''' Return the number of frames and the frame rate of the video in the path.
+        They are read from the index of the video (see video_index), built on the first call. '''
 
-    cap = cv2.VideoCapture(path)
-    if not cap.isOpened():
+    try:
+        index = video_index.load_index(path)
+    except (IOError, OSError):
         print("Error: Could not open video.")
         return
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    cap.release()
-    return frame_count, fps
+    return index.frame_count, index.fps
 
 def compress_csv(experiment, sex, test, path_to_csvs):
     ''' This creates a single csv file for each video/test with all the behaviour data
@@ -75,6 +104,7 @@ def compress_csv(experiment, sex, test, path_to_csvs):
     # Dataframe to store the compressed data wit a row per frame
     compress_df = pd.DataFrame()
     compress_df['Frame'] = np.arange(num_frames, dtype=int)
+    columns = {} # Per frame values of each behaviour
 
     
     # Different files
@@ -123,21 +153,52 @@ def compress_csv(experiment, sex, test, path_to_csvs):
 
         for df in df_list:
             # We need to see if in each frame, each behaviour is present or not
+            # Starting frame of each row, the row holds until the next one
+            starts = from_times_to_frames(df['Time'], fps)
             for behaviour in df.columns[1:]:
-                compress_df[behaviour] = np.zeros(num_frames)
-                # Get instances of the behaviour
-                for i in range(len(df)):
-
-                    starting_frame = from_time_to_frame(df['Time'][i], fps)
-                    if i == len(df) - 1:
-                        ending_frame = num_frames
-                    else:
-                        ending_frame = from_time_to_frame(df['Time'][i+1], fps)
-                    compress_df[behaviour][starting_frame:ending_frame] = df[behaviour][i]
+                columns[behaviour] = intervals_to_frames(starts, df[behaviour].to_numpy(), num_frames)
 
+    compress_df = pd.concat([compress_df, pd.DataFrame(columns)], axis=1)
     return compress_df
 
 
+def _compress_csv_task(args):
+    experiment, sex, test, path_to_csvs = args
+    return compress_csv(experiment, sex, test, path_to_csvs)
+
+def compress_csvs(combinations, path_to_csvs, output_path = None, n_workers = 1):
+    ''' Runs compress_csv on several experiment/sex/test combinations in parallel and consolidates the results
+        in a single table indexed by (experiment, sex, test, Frame). The behaviours missing in a video are 0.
+
+        combinations: list of (experiment, sex, test), the arguments of compress_csv
+        path_to_csvs: str, path to the folder where the csv files are stored
+        output_path: str, if given, the table is saved there (pickle, see load_label_store)
+        n_workers: int, the number of processes
+    '''
+    tasks = [(experiment, sex, test, path_to_csvs) for experiment, sex, test in combinations]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            tables = list(executor.map(_compress_csv_task, tasks))
+    else:
+        tables = [_compress_csv_task(task) for task in tasks]
+
+    labels = pd.concat([table.set_index('Frame') for table in tables], keys=[tuple(c) for c in combinations],
+                       names=['experiment', 'sex', 'test'])
+    labels = labels.fillna(0)
+    if output_path is not None:
+        labels.to_pickle(output_path)
+    return labels
+
+def load_label_store(path, experiment = None, sex = None, test = None):
+    ''' Loads the table written by compress_csvs. If the experiment, the sex and the test are given,
+        returns the per frame table of this video, as compress_csv does.
+    '''
+    labels = pd.read_pickle(path)
+    if experiment is None:
+        return labels
+    return labels.loc[(experiment, sex, test)].reset_index()
+
+
 def periodogram(signal, method='standard',display = False, window_size=None, overlap=None, window=None):
     """
     Compute and plot the periodogram of a given input signal using the standard, Bartlett, or Welch method.
@@ -201,13 +262,26 @@ def periodogram(signal, method='standard',display = False, window_size=None, ove
 
     return periodogram
 
-def swap_identities(dataset):
+def swap_identities(dataset, inplace = False):
     """
     Swap the identities of the resident in the dataset. This is used to analyze the behaviour of the visitor when doing inference.
 
     Parameters:
         dataset list of torch.geometric.data.Data: The dataset to swap the identities of the resident.
+        inplace bool: If True, the node features of the graphs are modified. Otherwise the graphs are left untouched and
+            shallow copies with swapped node features are returned.
+
+    Returns:
+        list of torch.geometric.data.Data: The graphs with the identities swapped (the same graphs if inplace is True).
     """
+    if inplace:
+        for data in dataset:
+            data.x.copy_(augmentation.swap_identity_features(data.x))
+        return dataset
 
+    swapped = []
     for data in dataset:
-        data.x[:, 3] = 1 - data.x[:, 3]
+        data = copy.copy(data)
+        data.x = augmentation.swap_identity_features(data.x)
+        swapped.append(data)
+    return swapped
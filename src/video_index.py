@@ -0,0 +1,276 @@
+# Index of the frames of a video, built once and stored next to the video (<video>.index.npz)
+# It gives the video info without opening the video, and frame-accurate seeks: with PyAV (in environment.yaml) the
+# keyframes and timestamps are read from the packets and a seek goes to the previous keyframe and decodes forward.
+# Without PyAV only the container metadata is read, and the frame reached by a seek is checked from its timestamp.
+import os
+
+import cv2
+import numpy as np
+
+try:
+    import av # PyAV, optional: reads the keyframes and the timestamps from the packets without decoding
+except ImportError:
+    av = None
+
+INDEX_SUFFIX = '.index.npz'
+
+
+def index_path(video_path):
+    ''' Returns the path of the sidecar index of the video. '''
+    return video_path + INDEX_SUFFIX
+
+
+class VideoIndex:
+    ''' Metadata of a video: number of frames (counted, not the estimate of the container), frame rate, size,
+        timestamp of each frame and the frames that are keyframes. '''
+
+    def __init__(self, frame_count, fps, width, height, timestamps, keyframes, source_mtime = 0.0, source_size = 0, scanner = 'pyav'):
+        ''' Constructor of the VideoIndex class.
+
+            Args:
+                frame_count (int): The number of frames.
+                fps (float): The frame rate.
+                width (int): The width of the frames.
+                height (int): The height of the frames.
+                timestamps (np.ndarray): The timestamp of each frame in seconds.
+                keyframes (np.ndarray): The sorted indices of the keyframes (empty if unknown).
+                source_mtime (float): The modification time of the video when it was indexed.
+                source_size (int): The size of the video when it was indexed.
+                scanner (str): 'pyav' (exact frame count, timestamps and keyframes) or 'opencv' (metadata of the
+                    container only: estimated frame count, no timestamps nor keyframes).'''
+        self.frame_count = int(frame_count)
+        self.fps = float(fps)
+        self.width = int(width)
+        self.height = int(height)
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.keyframes = np.asarray(keyframes, dtype=np.int64)
+        self.source_mtime = float(source_mtime)
+        self.source_size = int(source_size)
+        self.scanner = str(scanner)
+
+    def keyframe_before(self, frame):
+        ''' Returns the last keyframe at or before the frame, None if the keyframes are unknown. '''
+        if len(self.keyframes) == 0:
+            return None
+        i = np.searchsorted(self.keyframes, frame, side='right') - 1
+        return int(self.keyframes[max(i, 0)])
+
+    def frame_at(self, seconds):
+        ''' Returns the frame with the timestamp (the nearest one, or from the frame rate if the timestamps are unknown). '''
+        if len(self.timestamps) == 0:
+            return int(round(seconds * self.fps))
+        i = int(np.clip(np.searchsorted(self.timestamps, seconds), 1, len(self.timestamps) - 1)) if len(self.timestamps) > 1 else 0
+        if i > 0 and seconds - self.timestamps[i - 1] < self.timestamps[i] - seconds:
+            i -= 1
+        return i
+
+    def matches(self, video_path):
+        ''' Returns whether the index was built from the current version of the video. '''
+        stat = os.stat(video_path)
+        return self.source_size == stat.st_size and abs(self.source_mtime - stat.st_mtime) < 1e-3
+
+    def save(self, path):
+        np.savez(path, frame_count=self.frame_count, fps=self.fps, width=self.width, height=self.height,
+                 timestamps=self.timestamps, keyframes=self.keyframes,
+                 source_mtime=self.source_mtime, source_size=self.source_size, scanner=self.scanner)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            # Indexes written before the scanner was saved: only PyAV finds keyframes
+            scanner = f['scanner'] if 'scanner' in f else ('pyav' if len(f['keyframes']) else 'opencv')
+            return cls(f['frame_count'], f['fps'], f['width'], f['height'], f['timestamps'], f['keyframes'],
+                       f['source_mtime'], f['source_size'], scanner)
+
+
+def _scan_with_pyav(video_path):
+    ''' Reads the timestamps and the keyframes from the packets of the first video stream (no decoding). '''
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        fps = float(stream.average_rate) if stream.average_rate else 0.0
+        width, height = stream.codec_context.width, stream.codec_context.height
+        pts, is_key = [], []
+        for packet in container.demux(stream):
+            if packet.pts is None: # flushing packet
+                continue
+            pts.append(packet.pts)
+            is_key.append(packet.is_keyframe)
+        time_base = float(stream.time_base)
+    # Packets come in decoding order, frames are in presentation order
+    order = np.argsort(pts, kind='stable')
+    pts = np.asarray(pts, dtype=np.float64)[order]
+    timestamps = (pts - pts[0]) * time_base if len(pts) else pts
+    keyframes = np.flatnonzero(np.asarray(is_key, dtype=bool)[order])
+    return len(timestamps), fps, width, height, timestamps, keyframes, 'pyav'
+
+
+def _scan_with_opencv(video_path):
+    ''' Reads the metadata of the container, without decoding (decoding all the frames to count them would block the
+        GUI on the first opening). The frame count is the estimate of the container, timestamps and keyframes stay unknown. '''
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f'Could not open the video {video_path}')
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return frame_count, fps, width, height, np.zeros(0), np.zeros(0, dtype=np.int64), 'opencv'
+
+
+def build_index(video_path):
+    ''' Indexes the video (one pass over it) with PyAV if available, else with OpenCV.
+
+        Args:
+            video_path (str): The path to the video.
+
+        Returns:
+            index (VideoIndex): The index.'''
+    scan = _scan_with_pyav if av is not None else _scan_with_opencv
+    frame_count, fps, width, height, timestamps, keyframes, scanner = scan(video_path)
+    stat = os.stat(video_path)
+    return VideoIndex(frame_count, fps, width, height, timestamps, keyframes, stat.st_mtime, stat.st_size, scanner)
+
+
+def load_index(video_path, rebuild = False):
+    ''' Returns the index of the video, from its sidecar file if it is up to date, else builds it and writes the sidecar.
+        An index built without PyAV is built again once PyAV is installed.
+
+        Args:
+            video_path (str): The path to the video.
+            rebuild (bool): If True, the video is indexed again.
+
+        Returns:
+            index (VideoIndex): The index.'''
+    path = index_path(video_path)
+    if not rebuild and os.path.exists(path):
+        index = VideoIndex.load(path)
+        if index.matches(video_path) and (index.scanner == 'pyav' or av is None):
+            return index
+    index = build_index(video_path)
+    try:
+        index.save(path)
+    except OSError:
+        print(f'Could not write the index of {video_path}, it will be rebuilt next time')
+    return index
+
+
+class IndexedVideoReader:
+    ''' Random access reader of a video. A read at the next position is a plain read, a read a few frames ahead decodes
+        forward, and any other read seeks before the frame and decodes forward up to it (seeking directly with
+        CAP_PROP_POS_FRAMES is not exact for some mp4). With a PyAV index the seek goes to the previous keyframe.
+        Without it, the frame reached by the seek is identified from its timestamp (CAP_PROP_POS_MSEC) and the seek
+        starts earlier while it lands after the requested frame; the frame returned is the requested one as long as
+        the timestamps match the frame rate (constant frame rate videos). '''
+
+    def __init__(self, video_path, index = None):
+        ''' Constructor of the IndexedVideoReader class.
+
+            Args:
+                video_path (str): The path to the video.
+                index (VideoIndex): The index of the video (default: load_index(video_path)).'''
+        self.video_path = video_path
+        self.index = index if index is not None else load_index(video_path)
+        self.cap = cv2.VideoCapture(video_path)
+        if not self.cap.isOpened():
+            raise IOError(f'Could not open the video {video_path}')
+        self.position = 0 # index of the next frame returned by cap.read()
+
+    @property
+    def frame_count(self):
+        return self.index.frame_count
+
+    @property
+    def fps(self):
+        return self.index.fps
+
+    @property
+    def size(self):
+        return self.index.width, self.index.height
+
+    def seek(self, frame):
+        ''' Moves to the frame, the next read returns it. '''
+        if frame == self.position:
+            return
+        keyframe = self.index.keyframe_before(frame)
+        if keyframe is None:
+            # Unknown keyframes (no PyAV): decode forward if close, else seek and check where the seek landed
+            if not (self.position < frame <= self.position + int(self.index.fps or 25)):
+                self._seek_before(frame)
+        elif not (self.position < frame and keyframe <= self.position):
+            # Going backward or past a keyframe: seek to the keyframe
+            self._seek_keyframe(keyframe, frame)
+        while self.position < frame:
+            if not self.cap.grab():
+                break
+            self.position += 1
+
+    def _seek_keyframe(self, keyframe, frame):
+        ''' Moves to the keyframe by its timestamp in the index, and checks the frame the seek landed on (B-frames or a
+            non-zero start time can make the decoder land elsewhere), falls back to _seek_before if it is after the frame. '''
+        if keyframe == 0:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self.position = 0
+            return
+        msec = self.index.timestamps[keyframe] * 1000
+        self.cap.set(cv2.CAP_PROP_POS_MSEC, msec)
+        if self.cap.grab():
+            landed = self.index.frame_at(self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000)
+            if landed < frame:
+                self.position = landed + 1 # the frame landed on was grabbed
+                return
+            if landed == frame:
+                # The same seek lands on the same frame, done again so the next read returns it
+                self.cap.set(cv2.CAP_PROP_POS_MSEC, msec)
+                self.position = frame
+                return
+        self._seek_before(frame)
+
+    def _seek_before(self, frame):
+        ''' Moves to a frame at or before the frame (without keyframes), the position is then exact.
+            The seek starts margin frames earlier, and the margin doubles while the seek lands after the frame. '''
+        margin = 1
+        while True:
+            start = max(frame - margin, 0)
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+            if start == 0:
+                # Seeking to the start of the video is exact
+                self.position = 0
+                return
+            if self.cap.grab():
+                landed = self.index.frame_at(self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000)
+                if landed < frame:
+                    self.position = landed + 1 # the frame landed on was grabbed
+                    return
+            margin *= 2
+
+    def read(self, frame = None):
+        ''' Reads the frame (the next one if None).
+
+            Returns:
+                ret (bool), frame (np.ndarray): As cv2.VideoCapture.read.'''
+        if frame is not None:
+            self.seek(frame)
+        ret, image = self.cap.read()
+        if ret:
+            self.position += 1
+        return ret, image
+
+    def frames(self, start = 0, stop = None):
+        ''' Yields (index, frame) for the frames start to stop - 1. '''
+        stop = self.frame_count if stop is None else min(stop, self.frame_count)
+        self.seek(start)
+        for i in range(start, stop):
+            ret, image = self.read()
+            if not ret:
+                return
+            yield i, image
+
+    def release(self):
+        self.cap.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()